@@ -1,8 +1,10 @@
-from scispacy_functions import get_abbreviations, get_hyponyms, get_linked_entities, get_named_entities, get_pos_tagging
-from transformer_functions import get_translation, get_supported_translation_languages, get_single_summary, get_multi_summary_joint, get_med_question, get_span_answer,get_question,get_choice,get_layman_text,get_dialogpt,get_pos_tagging_hf
-from utils import get_sents_stanza, get_multiple_sents_stanza, get_sents_pyrush, get_sents_scispacy
-from multi_doc_functions import get_clusters, get_similar_documents
-from transformers_translationMT5 import get_mT5_translation
+from scispacy_functions import get_abbreviations, get_hyponyms, get_linked_entities, get_named_entities, get_pos_tagging, batch_abbreviations, batch_named_entities
+from transformer_functions import get_translation, iter_translation, get_supported_translation_languages, get_single_summary, get_multi_summary_joint, get_med_question, get_span_answer,get_question,get_choice,get_layman_text,get_dialogpt,get_pos_tagging_hf, batch_single_summary, batch_layman_text
+from utils import get_sents_stanza, get_multiple_sents_stanza, get_sents_pyrush, get_sents_scispacy, batch_sents_stanza, batch_sents_scispacy
+from multi_doc_functions import get_clusters, get_similar_documents, search_similar_documents, cluster_documents
+from embedding_store import EmbeddingStore
+from transformers_translationMT5 import get_mT5_translation, iter_mT5_translation
+from model_registry import registry, load_hf_pipeline
 from anthropic import Anthropic
 import google.generativeai as genai
 from huggingface_hub import login
@@ -14,10 +16,13 @@ import numpy as np
 from stanza_functions import (
     get_named_entities_stanza_biomed,
     get_sents_stanza_biomed,
+    batch_named_entities_stanza_biomed,
+    batch_sents_stanza_biomed,
     get_tokens_stanza_biomed,
     get_part_of_speech_and_morphological_features,
     get_lemmas_stanza_biomed,
-    get_dependency_stanza_biomed
+    get_dependency_stanza_biomed,
+    get_stanza_annotations
 )
 
 class Ascle:
@@ -31,19 +36,22 @@ class Ascle:
         scispacy_model (str): default model for scispacy tasks
         bert_model (str): default model for pre-trained transformers
         marian_model (str): default model for translation
+        embedding_store (str or EmbeddingStore): optional on-disk cache of document embeddings used by multi-document tasks
     """
     def __init__(self,
                  main_record="",
                  supporting_records=[],
                  scispacy_model="en_core_sci_sm",
                  bert_model="microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract",
-                 marian_model="Helsinki-NLP/opus-mt-en-ROMANCE"):
+                 marian_model="Helsinki-NLP/opus-mt-en-ROMANCE",
+                 embedding_store=None):
 
         self.main_record = main_record
         self.supporting_records = supporting_records
         self.scispacy_model = scispacy_model
         self.bert_model = bert_model
         self.marian_model = marian_model
+        self.update_embedding_store(embedding_store)
 
     ''' Functions for manipulating records and default models '''
     def update_and_delete_main_record(self, main_record):
@@ -85,6 +93,24 @@ class Ascle:
 
     def update_marian_model(self, marian_model):
         self.marian_model = marian_model
+
+    def update_embedding_store(self, embedding_store):
+        if isinstance(embedding_store, str):
+            embedding_store = EmbeddingStore(embedding_store)
+        self.embedding_store = embedding_store
+
+    ''' Functions for the shared model registry '''
+    def get_model_stats(self):
+        """
+        returns hit/miss counts, load time and memory usage of the process-wide model registry
+        """
+        return registry.stats()
+
+    def clear_model_cache(self):
+        """
+        unloads every model held by the process-wide model registry
+        """
+        registry.clear()
     
     ''' Functions for textual record processing '''
     def get_abbreviations(self):
@@ -106,10 +132,16 @@ class Ascle:
             named_entities = get_named_entities_stanza_biomed(self.main_record)
         return named_entities
 
-    def get_translation(self, target_language='Spanish'):
-        translation = get_translation(self.main_record, self.marian_model, target_language)
+    def get_translation(self, target_language='Spanish', max_tokens_per_batch=4096):
+        translation = get_translation(self.main_record, self.marian_model, target_language, max_tokens_per_batch)
         return translation
 
+    def iter_translation(self, target_language='Spanish', max_tokens_per_batch=4096):
+        """
+        yields the translation of the main record sentence by sentence
+        """
+        return iter_translation(self.main_record, self.marian_model, target_language, max_tokens_per_batch)
+
     def get_supported_translation_languages(self):
         return get_supported_translation_languages()
 
@@ -145,20 +177,42 @@ class Ascle:
             dependencies = get_dependency_stanza_biomed(self.main_record)
         return dependencies
 
-    def get_clusters(self, k=2):
+    def get_stanza_annotations(self, views=None):
+        """
+        returns {view: annotations} for the main record from a single stanza-biomed parse,
+        views can be any of 'sentences', 'tokens', 'pos', 'lemmas', 'dependencies' (all by default)
+        """
+        return get_stanza_annotations(self.main_record, views)
+
+    def get_clusters(self, k=2, method='kmeans', n_components=None):
         # combine main record and candidate records for clustering
         docs = [self.main_record] + self.supporting_records
-        clusters = get_clusters(self.bert_model, docs, k)
+        clusters = get_clusters(self.bert_model, docs, k, store=self.embedding_store, method=method, n_components=n_components)
         return clusters
 
+    def cluster_records(self, k=2, method='minibatch', n_components=None, sample_size=10000):
+        """
+        clusters the main and supporting records, returns labels and centroids without copying the records
+        """
+        docs = [self.main_record] + self.supporting_records
+        return cluster_documents(self.bert_model, docs, k, store=self.embedding_store, method=method,
+                                 n_components=n_components, sample_size=sample_size)
+
     def get_similar_documents(self, k=2):
         query_note = self.main_record
         candidate_notes = self.supporting_records
         # ids of candidates
         candidates = np.array(range(len(candidate_notes)))
-        similar_docs = get_similar_documents(self.bert_model, query_note, candidate_notes, candidates, top_k=k)
+        similar_docs = get_similar_documents(self.bert_model, query_note, candidate_notes, candidates, top_k=k, store=self.embedding_store)
         return similar_docs
 
+    def search_similar_documents(self, index, k=10, subject_id=None, category=None):
+        """
+        returns the k notes of a vector index (e.g. built from NOTEEVENTS) most similar to the main record
+        """
+        return search_similar_documents(self.bert_model, self.main_record, index, top_k=k, subject_id=subject_id,
+                                        category=category, store=self.embedding_store)
+
     def get_single_record_summary(self):
         summary = get_single_summary(self.main_record)
         return summary
@@ -168,10 +222,46 @@ class Ascle:
         summary = get_multi_summary_joint(docs)
         return summary
 
-    def get_translation_mt5(self, target_language = 'Spanish'):
-        translation = get_mT5_translation(self.main_record, target_language)
+    ''' Batch functions: process a list of records in one pass, results are yielded in the order of records '''
+    def batch_abbreviations(self, records, batch_size=64, n_process=1):
+        return batch_abbreviations(self.scispacy_model, records, batch_size, n_process)
+
+    def batch_named_entities(self, records, tool='scispacy', batch_size=64, n_process=1):
+        if tool == 'scispacy':
+            named_entities = batch_named_entities(self.scispacy_model, records, batch_size, n_process)
+        elif tool == 'stanza':
+            named_entities = batch_named_entities_stanza_biomed(records, batch_size)
+        else:
+            raise ValueError("Unsupported tool '%s' for batch_named_entities, use 'scispacy' or 'stanza'" % tool)
+        return named_entities
+
+    def batch_sentences(self, records, tool='stanza', batch_size=32, n_process=1):
+        if tool == 'pyrush':
+            sents = ([record[sent.begin:sent.end] for sent in get_sents_pyrush(record)] for record in records)
+        elif tool == 'stanza':
+            sents = batch_sents_stanza(records, batch_size)
+        elif tool == 'scispacy':
+            sents = batch_sents_scispacy(records, batch_size, n_process)
+        elif tool == 'stanza-biomed':
+            sents = batch_sents_stanza_biomed(records, batch_size)
+        else:
+            raise ValueError("Unsupported tool '%s' for batch_sentences, use 'pyrush', 'stanza', 'scispacy' or "
+                             "'stanza-biomed'" % tool)
+        return sents
+
+    def batch_single_record_summary(self, records, batch_size=8):
+        return batch_single_summary(records, batch_size=batch_size)
+
+    def batch_layman_text(self, records, model_name="ireneli1024/bart-large-elife-finetuned", min_length=50, max_length=200, batch_size=8):
+        return batch_layman_text(records, model_name, min_length, max_length, batch_size)
+
+    def get_translation_mt5(self, target_language = 'Spanish', max_tokens_per_batch=4096):
+        translation = get_mT5_translation(self.main_record, target_language, max_tokens_per_batch)
         return translation
 
+    def iter_translation_mt5(self, target_language='Spanish', max_tokens_per_batch=4096):
+        return iter_mT5_translation(self.main_record, target_language, max_tokens_per_batch)
+
     def get_med_question(self, model_name="AnonymousSub/SciFive_MedQuAD_question_generation"):
         med_question = get_med_question(self.main_record,model_name)
         return med_question
@@ -227,18 +317,16 @@ class Ascle:
     
     def call_LlaMa(self, model_name="meta-llama/Llama-2-7b-chat-hf", api_key=""):
         login(token=api_key, add_to_git_credential=True)
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
         device = 0 if torch.cuda.is_available() else -1
-        llama_model = AutoModelForCausalLM.from_pretrained(model_name)
         
-        model_pipeline = pipeline(
+        model_pipeline = load_hf_pipeline(
             "text-generation", 
-            model=llama_model,
+            model=model_name,
             device=device,  # 0 for first GPU
             do_sample=True,  # Enable sampling for more varied output
             temperature=0.7,  # Adjust temperature for sampling
             top_p=0.9,  # Enable nucleus sampling (top-p sampling)
-            tokenizer=tokenizer,
+            tokenizer=model_name,
             pad_token_id=50256
         )
         
@@ -0,0 +1,298 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import numpy as np
+
+# name of the pooling used by transformer_functions.get_bert_embeddings (mean of pooled sentence embeddings)
+DEFAULT_POOLING = 'sentence_pooler_mean'
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Content-addressed, on-disk cache of document embeddings.
+
+    Embeddings are keyed by (model name, sha1 of the text, pooling strategy). Vectors are kept in one
+    memory-mapped float32 file per embedding size (vectors_<dim>.f32) and their rows are tracked in a
+    small SQLite index (index.sqlite), so the store survives between runs and only new texts have to
+    be encoded. Once max_entries is exceeded, the least recently used embeddings are evicted and
+    their rows are reused.
+
+    Args:
+        path (str): directory of the store, created if it does not exist
+        max_entries (int): maximum number of cached embeddings, None for no limit
+    """
+    def __init__(self, path, max_entries=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.RLock()
+        self._vectors = {}
+        self._db = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                model TEXT NOT NULL, pooling TEXT NOT NULL, hash TEXT NOT NULL,
+                dim INTEGER NOT NULL, row INTEGER NOT NULL, last_used INTEGER NOT NULL,
+                PRIMARY KEY (model, pooling, hash));
+            CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+            CREATE TABLE IF NOT EXISTS free_rows (dim INTEGER NOT NULL, row INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS files (dim INTEGER PRIMARY KEY, used INTEGER NOT NULL);
+        ''')
+        self._clock = self._db.execute('SELECT COALESCE(MAX(last_used), 0) FROM entries').fetchone()[0]
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    ''' memory-mapped vector files '''
+    def _file(self, dim):
+        return os.path.join(self.path, f'vectors_{dim}.f32')
+
+    def _open(self, dim, min_rows=0):
+        """
+        returns the memmap for vectors of size dim, growing the file (doubling) to hold at least min_rows rows
+        """
+        vectors = self._vectors.get(dim)
+        capacity = len(vectors) if vectors is not None else 0
+        if vectors is None and os.path.exists(self._file(dim)):
+            capacity = os.path.getsize(self._file(dim)) // (4 * dim)
+        if vectors is not None and capacity >= min_rows:
+            return vectors
+
+        if capacity < min_rows:
+            if vectors is not None:
+                vectors.flush()
+            capacity = max(min_rows, 2 * capacity, 1024)
+            with open(self._file(dim), 'ab') as f:
+                f.truncate(capacity * dim * 4)
+        vectors = np.memmap(self._file(dim), dtype=np.float32, mode='r+', shape=(capacity, dim))
+        self._vectors[dim] = vectors
+        return vectors
+
+    def _allocate(self, dim, n):
+        rows = [row for row, in self._db.execute('SELECT row FROM free_rows WHERE dim = ? LIMIT ?', (dim, n))]
+        self._db.executemany('DELETE FROM free_rows WHERE dim = ? AND row = ?', [(dim, row) for row in rows])
+
+        used = self._db.execute('SELECT used FROM files WHERE dim = ?', (dim,)).fetchone()
+        used = used[0] if used else 0
+        new_rows = n - len(rows)
+        rows += range(used, used + new_rows)
+        self._db.execute('INSERT OR REPLACE INTO files (dim, used) VALUES (?, ?)', (dim, used + new_rows))
+        return rows, used + new_rows
+
+    ''' lookups '''
+    def get(self, model_name, texts, pooling=DEFAULT_POOLING):
+        """
+        returns a list with the cached embedding (float32 numpy array) of each text, None for texts not in the store
+        """
+        hashes = [text_hash(text) for text in texts]
+        with self._lock:
+            found = {}
+            for start in range(0, len(hashes), 500):
+                chunk = list(set(hashes[start:start + 500]))
+                query = (f'SELECT hash, dim, row FROM entries WHERE model = ? AND pooling = ? '
+                         f'AND hash IN ({",".join("?" * len(chunk))})')
+                for h, dim, row in self._db.execute(query, [model_name, pooling] + chunk):
+                    found[h] = (dim, row)
+
+            self._clock += 1
+            self._db.executemany('UPDATE entries SET last_used = ? WHERE model = ? AND pooling = ? AND hash = ?',
+                                 [(self._clock, model_name, pooling, h) for h in found])
+            self._db.commit()
+
+            output = []
+            for h in hashes:
+                if h in found:
+                    dim, row = found[h]
+                    output.append(np.array(self._open(dim)[row]))
+                else:
+                    output.append(None)
+            missing = sum(vector is None for vector in output)
+            self._hits += len(output) - missing
+            self._misses += missing
+        return output
+
+    def put(self, model_name, texts, vectors, pooling=DEFAULT_POOLING):
+        """
+        stores one embedding per text, vectors is a (number of texts, dim) matrix
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(texts) == 0:
+            return
+        dim = vectors.shape[1]
+
+        with self._lock:
+            new = {}
+            for text, vector in zip(texts, vectors):
+                new[text_hash(text)] = vector
+            existing = {}
+            freed = []
+            hashes = list(new)
+            for start in range(0, len(hashes), 500):
+                chunk = hashes[start:start + 500]
+                query = (f'SELECT hash, dim, row FROM entries WHERE model = ? AND pooling = ? '
+                         f'AND hash IN ({",".join("?" * len(chunk))})')
+                for h, entry_dim, row in self._db.execute(query, [model_name, pooling] + chunk):
+                    if entry_dim == dim:
+                        existing[h] = row
+                    else:
+                        # re-stored with another size: the row in the old file is reused by later puts of that size
+                        freed.append((entry_dim, row))
+            self._db.executemany('INSERT INTO free_rows (dim, row) VALUES (?, ?)', freed)
+
+            missing = [h for h in new if h not in existing]
+            rows, used = self._allocate(dim, len(missing))
+            existing.update(zip(missing, rows))
+
+            store = self._open(dim, min_rows=used)
+            for h, row in existing.items():
+                store[row] = new[h]
+            store.flush()
+
+            self._clock += 1
+            self._db.executemany('INSERT OR REPLACE INTO entries (model, pooling, hash, dim, row, last_used) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)',
+                                 [(model_name, pooling, h, dim, row, self._clock) for h, row in existing.items()])
+            self._db.commit()
+            self._evict()
+
+    def encode(self, model_name, texts, encoder, pooling=DEFAULT_POOLING):
+        """
+        returns a float32 matrix with the embedding of each text; only texts missing from the store are
+        passed to encoder (a function from a list of texts to a matrix), their embeddings are stored for later calls
+        """
+        texts = list(texts)
+        cached = self.get(model_name, texts, pooling)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+
+        if missing:
+            encoded = np.asarray(encoder(missing), dtype=np.float32)
+            self.put(model_name, missing, encoded, pooling)
+            encoded = dict(zip(missing, encoded))
+            cached = [vector if vector is not None else encoded[text] for text, vector in zip(texts, cached)]
+
+        if not cached:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.vstack(cached)
+
+    def iter_embeddings(self, model_name, pooling=DEFAULT_POOLING, batch_size=10000):
+        """
+        yields (text hashes, float32 matrix) batches of every embedding stored for model_name, read straight
+        from the memory-mapped file so the whole store never has to fit in memory
+        """
+        with self._lock:
+            entries = self._db.execute('SELECT hash, dim, row FROM entries WHERE model = ? AND pooling = ? '
+                                       'ORDER BY dim, row', (model_name, pooling)).fetchall()
+        for start in range(0, len(entries), batch_size):
+            batch = entries[start:start + batch_size]
+            dims = set(dim for _, dim, _ in batch)
+            if len(dims) > 1:
+                raise ValueError(f'embeddings of {model_name} have different sizes: {sorted(dims)}')
+            rows = np.array([row for _, _, row in batch], dtype=np.int64)
+            with self._lock:
+                vectors = np.asarray(self._open(batch[0][1])[rows], dtype=np.float32)
+            yield [h for h, _, _ in batch], vectors
+
+    ''' size limits and eviction '''
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def _evict(self):
+        if self.max_entries is None:
+            return
+        extra = len(self) - self.max_entries
+        if extra > 0:
+            self.evict(extra)
+
+    def evict(self, n):
+        """
+        removes the n least recently used embeddings, their rows are reused by later puts
+        """
+        with self._lock:
+            entries = self._db.execute('SELECT model, pooling, hash, dim, row FROM entries '
+                                       'ORDER BY last_used LIMIT ?', (n,)).fetchall()
+            self._db.executemany('DELETE FROM entries WHERE model = ? AND pooling = ? AND hash = ?',
+                                 [entry[:3] for entry in entries])
+            self._db.executemany('INSERT INTO free_rows (dim, row) VALUES (?, ?)', [entry[3:] for entry in entries])
+            self._db.commit()
+            self._evictions += len(entries)
+        return len(entries)
+
+    def set_max_entries(self, max_entries):
+        with self._lock:
+            self.max_entries = max_entries
+            self._evict()
+
+    def clear(self):
+        """
+        removes every embedding and the vector files
+        """
+        with self._lock:
+            self._db.executescript('DELETE FROM entries; DELETE FROM free_rows; DELETE FROM files;')
+            self._db.commit()
+            for dim in list(self._vectors):
+                del self._vectors[dim]
+            for name in os.listdir(self.path):
+                if name.startswith('vectors_') and name.endswith('.f32'):
+                    os.remove(os.path.join(self.path, name))
+
+    def stats(self):
+        """
+        returns hit/miss counts, number of cached embeddings and the size of the vector files in bytes
+        """
+        with self._lock:
+            size = sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path)
+                       if name.startswith('vectors_'))
+            lookups = self._hits + self._misses
+            return {'hits': self._hits,
+                    'misses': self._misses,
+                    'hit_rate': self._hits / lookups if lookups else 0.0,
+                    'evictions': self._evictions,
+                    'entries': len(self),
+                    'max_entries': self.max_entries,
+                    'disk_usage': size}
+
+    def close(self):
+        with self._lock:
+            for vectors in self._vectors.values():
+                vectors.flush()
+            self._vectors.clear()
+            self._db.close()
+
+
+def warm_up(store, notes_file, bert_model, chunksize=1000, category=None):
+    """
+    precomputes the embeddings of every note in a NOTEEVENTS csv, notes already in the store are skipped
+    """
+    import pandas as pd
+    from multi_doc_functions import embed_documents
+
+    total = 0
+    for chunk in pd.read_csv(notes_file, usecols=['CATEGORY', 'TEXT'], chunksize=chunksize):
+        if category is not None:
+            chunk = chunk[chunk['CATEGORY'] == category]
+        embed_documents(bert_model, chunk['TEXT'].fillna('').tolist(), store)
+        total += len(chunk)
+        print(f'{total} notes embedded, {len(store)} embeddings in store')
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute document embeddings for the notes in NOTEEVENTS.csv')
+    parser.add_argument('--notes_file', default='NOTEEVENTS.csv', type=str, help='path to NOTEEVENTS.csv')
+    parser.add_argument('--store', default='./embedding_store', type=str, help='directory of the embedding store')
+    parser.add_argument('--bert_model', default='microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract', type=str, help='pre-trained transformer used to encode the notes')
+    parser.add_argument('--chunksize', default=1000, type=int, help='number of notes read and encoded at a time')
+    parser.add_argument('--category', default=None, type=str, help='only embed notes of this CATEGORY')
+    parser.add_argument('--max_entries', default=None, type=int, help='maximum number of embeddings kept in the store')
+
+    args = parser.parse_args()
+    embedding_store = EmbeddingStore(args.store, max_entries=args.max_entries)
+    warm_up(embedding_store, args.notes_file, args.bert_model, args.chunksize, args.category)
+    print(embedding_store.stats())
+    embedding_store.close()
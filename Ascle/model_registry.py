@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# default memory budget for cached models, can be overridden with ASCLE_MODEL_MEMORY_BUDGET (in bytes)
+DEFAULT_MEMORY_BUDGET = 8 * 1024 ** 3
+
+
+def _freeze(value):
+    """
+    turns (nested) dicts, lists and sets into tuples so that model configs can be used as part of a registry key
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_freeze(v) for v in value))
+    return value
+
+
+def _torch_module_size(module):
+    size = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        size += tensor.numel() * tensor.element_size()
+    return size
+
+
+def _spacy_size(nlp):
+    size = nlp.vocab.vectors.data.nbytes
+    for _, pipe in nlp.pipeline:
+        model = getattr(pipe, 'model', None)
+        if model is None or not hasattr(model, 'walk'):
+            continue
+        for node in model.walk():
+            for name in node.param_names:
+                if node.has_param(name):
+                    size += node.get_param(name).nbytes
+    return size
+
+
+def estimate_model_size(obj, _seen=None):
+    """
+    returns a best-effort estimate (in bytes) of the memory held by a loaded model;
+    supports torch modules, huggingface pipelines/tokenizers, stanza pipelines and spacy Language objects.
+    Objects that cannot be measured count as 0 bytes.
+    """
+    if _seen is None:
+        _seen = set()
+    if obj is None or id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+
+    try:
+        if isinstance(obj, (tuple, list)):
+            return sum(estimate_model_size(item, _seen) for item in obj)
+        # torch.nn.Module (transformers models, flair taggers, ...)
+        if callable(getattr(obj, 'parameters', None)) and callable(getattr(obj, 'buffers', None)):
+            return _torch_module_size(obj)
+        # spacy Language
+        if hasattr(obj, 'vocab') and hasattr(obj, 'pipeline'):
+            return _spacy_size(obj)
+        # stanza Pipeline
+        if isinstance(getattr(obj, 'processors', None), dict):
+            size = 0
+            for processor in obj.processors.values():
+                model = getattr(processor, '_model', None)
+                if model is None:
+                    model = getattr(getattr(processor, '_trainer', None), 'model', None)
+                size += estimate_model_size(model, _seen)
+            return size
+        # huggingface pipelines
+        if hasattr(obj, 'model'):
+            return estimate_model_size(obj.model, _seen)
+    except Exception:
+        pass
+
+    return 0
+
+
+class ModelRegistry:
+    """
+    Process-wide, thread-safe cache of loaded models.
+
+    Models are keyed by (library, model name, config) and evicted in least-recently-used order
+    once the estimated memory of all cached models exceeds memory_budget. The most recently
+    loaded model is never evicted, so a single model larger than the budget still works.
+
+    Args:
+        memory_budget (int): maximum estimated memory (bytes) of cached models
+    """
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self._models = OrderedDict()
+        self._lock = threading.RLock()
+        self._loading = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._load_time = 0.0
+
+    @staticmethod
+    def make_key(library, model_name, config=None):
+        return (library, model_name, _freeze(config or {}))
+
+    def get(self, library, model_name, loader, config=None, size=None):
+        """
+        returns the cached model for (library, model_name, config), calling loader() to create it on a miss.
+        Concurrent requests for the same key wait for a single load instead of loading the model twice.
+        """
+        key = self.make_key(library, model_name, config)
+
+        with self._lock:
+            if key in self._models:
+                return self._hit(key)
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                if key in self._models:
+                    return self._hit(key)
+                self._misses += 1
+
+            start = time.perf_counter()
+            model = loader()
+            load_time = time.perf_counter() - start
+
+            if size is None:
+                size = estimate_model_size(model)
+
+            with self._lock:
+                self._models[key] = {'model': model, 'size': size, 'load_time': load_time, 'hits': 0}
+                self._load_time += load_time
+                self._loading.pop(key, None)
+                self._evict()
+
+        return model
+
+    def _hit(self, key):
+        self._hits += 1
+        entry = self._models[key]
+        entry['hits'] += 1
+        self._models.move_to_end(key)
+        return entry['model']
+
+    def _evict(self):
+        while len(self._models) > 1 and self.memory_usage() > self.memory_budget:
+            self._models.popitem(last=False)
+            self._evictions += 1
+
+    def memory_usage(self):
+        with self._lock:
+            return sum(entry['size'] for entry in self._models.values())
+
+    def set_memory_budget(self, memory_budget):
+        with self._lock:
+            self.memory_budget = memory_budget
+            self._evict()
+
+    def evict(self, library, model_name, config=None):
+        """
+        drops a single model from the registry, returns True if it was cached
+        """
+        key = self.make_key(library, model_name, config)
+        with self._lock:
+            return self._models.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+    def stats(self):
+        """
+        returns a dictionary with hit/miss counts, total load time (seconds), memory usage (bytes)
+        and one entry per cached model
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+                'load_time': self._load_time,
+                'memory_usage': self.memory_usage(),
+                'memory_budget': self.memory_budget,
+                'models': [{'library': key[0], 'model': key[1], 'config': key[2], 'size': entry['size'],
+                            'load_time': entry['load_time'], 'hits': entry['hits']}
+                           for key, entry in self._models.items()],
+            }
+
+
+registry = ModelRegistry(int(os.environ.get('ASCLE_MODEL_MEMORY_BUDGET', DEFAULT_MEMORY_BUDGET)))
+
+
+def get_model_stats():
+    return registry.stats()
+
+
+def clear_models():
+    registry.clear()
+
+
+''' Loaders for the libraries used in Ascle '''
+def load_spacy(model, pipes=()):
+    """
+    returns a spacy pipeline for model with the given pipes added, e.g.
+    pipes=[("hyponym_detector", {"last": True, "config": {"extended": True}})]
+    """
+    pipes = [(pipe, {}) if isinstance(pipe, str) else pipe for pipe in pipes]
+
+    def _load():
+        import spacy
+        nlp = spacy.load(model)
+        for name, kwargs in pipes:
+            nlp.add_pipe(name, **kwargs)
+        return nlp
+
+    return registry.get('spacy', model, _load, config={'pipes': pipes})
+
+
+def load_stanza(lang='en', **kwargs):
+    """
+    returns a stanza.Pipeline(lang, **kwargs), built offline-first from the local stanza model directory
+    """
+    def _load():
+        from stanza_resources import build_stanza_pipeline
+        return build_stanza_pipeline(lang, **kwargs)
+
+    return registry.get('stanza', lang, _load, config=kwargs)
+
+
+def load_hf_pipeline(task=None, model=None, **kwargs):
+    """
+    returns a transformers.pipeline(task, model=model, **kwargs)
+    """
+    def _load():
+        from transformers import pipeline
+        return pipeline(task, model=model, **kwargs)
+
+    return registry.get('transformers.pipeline', model, _load, config=dict(kwargs, task=task))
+
+
+def load_pretrained(model_class, model_name, **kwargs):
+    """
+    returns model_class.from_pretrained(model_name, **kwargs), works for both models and tokenizers
+    """
+    def _load():
+        return model_class.from_pretrained(model_name, **kwargs)
+
+    class_name = model_class.__module__ + '.' + model_class.__qualname__
+    return registry.get('transformers', model_name, _load, config=dict(kwargs, model_class=class_name))
+
+
+def load_model(library, model_name, loader, **config):
+    """
+    generic entry point for libraries without a dedicated loader (flair, PyRuSH, ...)
+    """
+    return registry.get(library, model_name, loader, config=config)
@@ -1,25 +1,41 @@
 from transformer_functions import get_bert_embeddings
 from utils import get_sents_pyrush, get_multiple_sents_stanza, get_sents_stanza
 from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.metrics import silhouette_score
 import numpy as np
 import pandas as pd
 from utils import get_multiple_sents_stanza
+from vector_index import top_k_indices
 
-def get_similar_documents(bert_model, query_note, candidate_notes, candidates, top_k=2):
+def embed_documents(bert_model, notes, store=None):
+    """
+    returns a float32 matrix with one embedding per note;
+    with an EmbeddingStore, only notes that are not in the store yet are split into sentences and encoded
+    """
+    def encode(texts):
+        return get_bert_embeddings(bert_model, get_multiple_sents_stanza(texts))
+
+    if store is None:
+        return encode(list(notes))
+    return store.encode(bert_model, notes, encode)
+
+def get_similar_documents(bert_model, query_note, candidate_notes, candidates, top_k=2, store=None):
     """
     retrieve top_k documents in candidate_notes that are most similar to query_note
     returns a dataframe with candidate_note_id, similarity_score, and candidate_text
     """
 
-    candidate_vectors = np.array(get_bert_embeddings(bert_model, get_multiple_sents_stanza(candidate_notes)))
-    query_vector = get_bert_embeddings(bert_model, [get_sents_stanza(query_note)])
+    # encode query and candidates in one pass, row 0 is the query
+    vectors = embed_documents(bert_model, [query_note] + list(candidate_notes), store)
+    query_vector = vectors[:1]
+    candidate_vectors = vectors[1:]
 
     # compute cosine similarity
     similarities = cosine_similarity(query_vector, candidate_vectors)[0]
 
-    sorted_args = np.argsort(similarities)[::-1]
-    top_args = sorted_args[:top_k]
+    top_args = top_k_indices(similarities, top_k)
 
     selected_rows = np.array(candidates)[top_args]
     selected_similarities = np.array(similarities)[top_args]
@@ -31,20 +47,150 @@ def get_similar_documents(bert_model, query_note, candidate_notes, candidates, t
 
     return output_df
 
-def get_clusters(bert_model, notes, k=2):
+def search_similar_documents(bert_model, query_note, index, top_k=10, subject_id=None, category=None, store=None):
+    """
+    retrieve the top_k documents of a vector index (see vector_index.py) most similar to query_note,
+    optionally restricted to a SUBJECT_ID and/or CATEGORY
+    returns a dataframe with candidate_id and similarity_score
+    """
+    query_vector = embed_documents(bert_model, [query_note], store)[0]
+    ids, similarities = index.search(query_vector, top_k, subject_id=subject_id, category=category)
+
+    output_df = pd.DataFrame({'candidate_id': ids,
+                              'similarity_score': similarities})
+
+    return output_df
+
+def get_clusters(bert_model, notes, k=2, store=None, method='kmeans', n_components=None):
     """
     performs k-means clustering with documents represented using pre-trained transformers
     returns a dataframe with 2 columns: note and assigned cluster id
     """
 
     # performs k-means clustering on notes
-    tokenized_texts = get_multiple_sents_stanza(notes)
-    encoded_texts = get_bert_embeddings(bert_model, tokenized_texts)
-
-    kmeans = KMeans(n_clusters=k)
-    kmeans.fit(encoded_texts)
-    labels = kmeans.labels_
+    encoded_texts = embed_documents(bert_model, notes, store)
+    labels = cluster_embeddings(encoded_texts, k, method=method, n_components=n_components, sample_size=0)['labels']
 
     output_df = pd.DataFrame(list(zip(notes, labels)), columns=['note', 'cluster'])
 
-    return output_df
\ No newline at end of file
+    return output_df
+
+def _sample_scores(vectors, labels, centroids, sample_size, random_state):
+    """
+    inertia and silhouette score computed on (at most) sample_size points, so they stay cheap for large collections
+    """
+    if sample_size == 0 or len(vectors) < 2:
+        return {'inertia': None, 'silhouette': None, 'sample_size': 0}
+    rng = np.random.RandomState(random_state)
+    if len(vectors) > sample_size:
+        sample = np.sort(rng.choice(len(vectors), sample_size, replace=False))
+        vectors, labels = vectors[sample], labels[sample]
+    inertia = float(((vectors - centroids[labels]) ** 2).sum())
+    silhouette = None
+    if 1 < len(np.unique(labels)) < len(vectors):
+        silhouette = float(silhouette_score(vectors, labels))
+    return {'inertia': inertia, 'silhouette': silhouette, 'sample_size': len(vectors)}
+
+def cluster_embeddings(vectors, k=2, method='minibatch', n_components=None, batch_size=1024, sample_size=10000, random_state=0):
+    """
+    clusters a (number of documents, dim) embedding matrix
+    method: 'kmeans' (sklearn KMeans) or 'minibatch' (MiniBatchKMeans, for 10^5 and more documents)
+    n_components: optionally reduce the embeddings with PCA before clustering
+    returns a dictionary with labels (one cluster id per row), centroids (in the clustering space),
+    and inertia/silhouette computed on a sample of sample_size rows (0 to skip them)
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    pca = None
+    if n_components is not None:
+        pca = PCA(n_components=n_components, svd_solver='randomized', random_state=random_state)
+        vectors = pca.fit_transform(vectors).astype(np.float32)
+
+    if method == 'kmeans':
+        kmeans = KMeans(n_clusters=k, random_state=random_state)
+    elif method == 'minibatch':
+        kmeans = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, random_state=random_state)
+    else:
+        raise ValueError(f"unknown clustering method '{method}', choose 'kmeans' or 'minibatch'")
+    labels = kmeans.fit_predict(vectors).astype(np.int32)
+
+    output = {'labels': labels, 'centroids': kmeans.cluster_centers_, 'pca': pca}
+    output.update(_sample_scores(vectors, labels, kmeans.cluster_centers_, sample_size, random_state))
+    return output
+
+def cluster_documents(bert_model, notes, k=2, store=None, method='minibatch', n_components=None, sample_size=10000):
+    """
+    clusters notes without copying their text into the output, see cluster_embeddings for the returned dictionary
+    """
+    encoded_texts = embed_documents(bert_model, notes, store)
+    return cluster_embeddings(encoded_texts, k, method=method, n_components=n_components, sample_size=sample_size)
+
+def _min_row_batches(batches, min_rows):
+    """
+    merges consecutive batches so that each has at least min_rows rows (one batch with all of them if there are fewer)
+    """
+    pending, ready = [], None
+    for vectors in batches:
+        pending.append(vectors)
+        if sum(len(v) for v in pending) >= min_rows:
+            if ready is not None:
+                yield ready
+            ready, pending = np.vstack(pending), []
+    if pending:
+        ready = np.vstack(pending if ready is None else [ready] + pending)
+    if ready is not None:
+        yield ready
+
+def cluster_store(store, bert_model, k=2, n_components=None, batch_size=10000, sample_size=10000, random_state=0):
+    """
+    streaming clustering of every embedding of bert_model in an EmbeddingStore: IncrementalPCA (optional) and
+    MiniBatchKMeans are fitted with partial_fit one batch at a time, so memory stays bounded by batch_size
+    returns a dictionary with hashes (text hash of each clustered note), labels, centroids, and sampled inertia/silhouette
+    raises ValueError if the store has fewer than k (or n_components) embeddings of bert_model
+    """
+    def embeddings():
+        for _, vectors in store.iter_embeddings(bert_model, batch_size=batch_size):
+            yield vectors
+
+    pca = None
+    if n_components is not None:
+        pca = IncrementalPCA(n_components=n_components)
+        # IncrementalPCA needs at least n_components rows per batch
+        for vectors in _min_row_batches(embeddings(), n_components):
+            if len(vectors) < n_components:
+                raise ValueError(f'the store has {len(vectors)} embeddings of {bert_model}, '
+                                 f'fewer than n_components={n_components}')
+            pca.partial_fit(vectors)
+
+    def transform(vectors):
+        return pca.transform(vectors).astype(np.float32) if pca is not None else vectors
+
+    kmeans = MiniBatchKMeans(n_clusters=k, batch_size=min(batch_size, 1024), random_state=random_state)
+    total = 0
+    # the first partial_fit needs at least k rows to initialize the centroids
+    for vectors in _min_row_batches(embeddings(), k):
+        if len(vectors) < k:
+            raise ValueError(f'the store has {len(vectors)} embeddings of {bert_model}, fewer than k={k}')
+        kmeans.partial_fit(transform(vectors))
+        total += len(vectors)
+    if total == 0:
+        raise ValueError(f'the store has no embeddings of {bert_model}')
+
+    # assign labels; the rows of a uniform sample, drawn up front, are kept for the scores
+    rng = np.random.RandomState(random_state)
+    sample = np.sort(rng.choice(total, min(sample_size, total), replace=False))
+    all_hashes, all_labels, sample_vectors, sample_labels, offset = [], [], [], [], 0
+    for hashes, vectors in store.iter_embeddings(bert_model, batch_size=batch_size):
+        vectors = transform(vectors)
+        labels = kmeans.predict(vectors).astype(np.int32)
+        all_hashes.extend(hashes)
+        all_labels.append(labels)
+        rows = sample[np.searchsorted(sample, offset):np.searchsorted(sample, offset + len(vectors))] - offset
+        sample_vectors.append(vectors[rows])
+        sample_labels.append(labels[rows])
+        offset += len(vectors)
+
+    output = {'hashes': all_hashes, 'labels': np.concatenate(all_labels), 'centroids': kmeans.cluster_centers_,
+              'pca': pca}
+    output.update(_sample_scores(np.vstack(sample_vectors), np.concatenate(sample_labels), kmeans.cluster_centers_,
+                                 sample_size, random_state))
+    return output
\ No newline at end of file
@@ -3,6 +3,7 @@ from scispacy.abbreviation import AbbreviationDetector
 from scispacy.hyponym_detector import HyponymDetector
 from scispacy.linking import EntityLinker
 from negspacy.negation import Negex
+from model_registry import load_spacy
 
 def get_abbreviations(model, text):
     """
@@ -15,8 +16,7 @@ def get_abbreviations(model, text):
     print(f"Input text (truncated): {partial_input}\n...")
 
     # abbreviation detection with scispacy
-    nlp = spacy.load(model)
-    nlp.add_pipe("abbreviation_detector")
+    nlp = load_spacy(model, pipes=["abbreviation_detector"])
     doc = nlp(text)
     abbreviations = [(abrv.text, abrv._.long_form.text) for abrv in doc._.abbreviations]
 
@@ -33,8 +33,7 @@ def get_hyponyms(model, text):
     print(f"Input text (truncated): {partial_input}\n...")
 
     # hyponym detection with scispacy
-    nlp = spacy.load(model)
-    nlp.add_pipe("hyponym_detector", last=True, config={"extended": True})
+    nlp = load_spacy(model, pipes=[("hyponym_detector", {"last": True, "config": {"extended": True}})])
     doc = nlp(text)
     hearst_patterns = [tuple([str(element) for element in pattern]) for pattern in doc._.hearst_patterns]
 
@@ -53,8 +52,7 @@ def get_linked_entities(model, text):
     # entity linking with scispacy
     output = {}
 
-    nlp = spacy.load(model)
-    nlp.add_pipe("scispacy_linker", config={"resolve_abbreviations": True, "linker_name": "umls"})
+    nlp = load_spacy(model, pipes=[("scispacy_linker", {"config": {"resolve_abbreviations": True, "linker_name": "umls"}})])
     doc = nlp(text)
 
     ents = doc.ents
@@ -79,7 +77,7 @@ def get_named_entities(model, text):
     print(f"Input text (truncated): {partial_input}\n...")
 
     # named recognition with scispacy
-    nlp = spacy.load(model)
+    nlp = load_spacy(model)
     doc = nlp(text)
     named_entities = [str(ent) for ent in doc.ents]
 
@@ -102,8 +100,7 @@ def get_negation_entities(model, text):
     print(f"Input text (truncated): {partial_input}\n...")
 
     # named recognition with scispacy
-    nlp = spacy.load(model)
-    nlp.add_pipe("negex", config={"ent_types":["PERSON","ORG","NORP","GPE"]})
+    nlp = load_spacy(model, pipes=[("negex", {"config": {"ent_types":["PERSON","ORG","NORP","GPE"]}})])
     doc = nlp(text)
     pairs = [(ent._.negex,ent.text) for ent in doc.ents]
 
@@ -119,7 +116,7 @@ def get_pos_tagging(model, text):
     >>get_pos_tagging("en_core_sci_sm",'The patient presented with a persistent cough and shortness of breath.')
     [(The, 'DET'), (patient, 'NOUN'), (presented, 'VERB'), (with, 'ADP'), (a, 'DET'), (persistent, 'ADJ'), (cough, 'NOUN'), (and, 'CCONJ'), (shortness, 'NOUN'), (of, 'ADP'), (breath, 'NOUN'), (., 'PUNCT')]
     """
-    nlp = spacy.load(model)
+    nlp = load_spacy(model)
     
     doc = nlp(text)
     predicted = []
@@ -127,4 +124,33 @@ def get_pos_tagging(model, text):
         predicted.append((token,token.pos_))
     return predicted
     
-    
\ No newline at end of file
+    
+
+''' Batch functions: process a list (or any iterable) of texts with nlp.pipe, results are yielded in input order '''
+def batch_abbreviations(model, texts, batch_size=64, n_process=1):
+    """
+    yields, for every text, a list of tuples in the form (abbreviation, expanded form)
+    """
+    print(f"Identifying abbrevations in batches using {model}")
+
+    if n_process > 1:
+        # spans can not be sent back from worker processes, keep the serializable form of the abbreviations instead
+        nlp = load_spacy(model, pipes=[("abbreviation_detector", {"config": {"make_serializable": True}})])
+    else:
+        nlp = load_spacy(model, pipes=["abbreviation_detector"])
+
+    for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process):
+        if n_process > 1:
+            yield [(abrv["short_text"], abrv["long_text"]) for abrv in doc._.abbreviations]
+        else:
+            yield [(abrv.text, abrv._.long_form.text) for abrv in doc._.abbreviations]
+
+def batch_named_entities(model, texts, batch_size=64, n_process=1):
+    """
+    yields, for every text, a list of strings, each string is an identified named entity
+    """
+    print(f"Extracting named entities in batches using {model}")
+
+    nlp = load_spacy(model)
+    for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process):
+        yield [str(ent) for ent in doc.ents]
@@ -1,75 +1,130 @@
+import hashlib
+import threading
+from collections import OrderedDict
 import stanza
+from model_registry import load_stanza
+from utils import batch_stanza_documents
+
+# number of parsed documents kept by parse_stanza_biomed
+CRAFT_CACHE_SIZE = 32
+_craft_cache = OrderedDict()
+_craft_lock = threading.Lock()
 
 def get_named_entities_stanza_biomed(text):
     """
     returns a list of tuples in the form (named entity, type), each being a str
     """
-    stanza.download('en', package='mimic', processors={'ner': 'i2b2'})
-    nlp = stanza.Pipeline('en', package='mimic', processors={'ner': 'i2b2'})
+    nlp = load_stanza('en', package='mimic', processors={'ner': 'i2b2'})
     doc = nlp(text)
 
     named_entities = [(ent.text, ent.type) for ent in  doc.entities]
 
     return named_entities
 
-def get_sents_stanza_biomed(text):
-    stanza.download('en', package='craft')
-    nlp = stanza.Pipeline('en', package='craft')
-    doc = nlp(text)
+def batch_named_entities_stanza_biomed(texts, batch_size=32):
+    """
+    yields, for every text, a list of tuples in the form (named entity, type), each being a str
+    """
+    nlp = load_stanza('en', package='mimic', processors={'ner': 'i2b2'})
 
-    sents = [sentence.text for sentence in doc.sentences]
+    for doc in batch_stanza_documents(nlp, texts, batch_size):
+        yield [(ent.text, ent.type) for ent in doc.entities]
 
-    return sents
+def parse_stanza_biomed(text):
+    """
+    returns the stanza Document of text parsed with the biomedical craft pipeline.
+    Parses are cached by a hash of the text, so asking for the tokens, pos tags, lemmas and dependencies
+    of the same note only parses it once.
+    """
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
 
-def get_tokens_stanza_biomed(text):
-    stanza.download('en', package='craft')
-    nlp = stanza.Pipeline('en', package='craft')
+    with _craft_lock:
+        if key in _craft_cache:
+            _craft_cache.move_to_end(key)
+            return _craft_cache[key]
+
+    nlp = load_stanza('en', package='craft')
     doc = nlp(text)
 
-    tokens = [[token.text for token in sentence.tokens] for sentence in doc.sentences]
+    with _craft_lock:
+        _craft_cache[key] = doc
+        while len(_craft_cache) > CRAFT_CACHE_SIZE:
+            _craft_cache.popitem(last=False)
 
-    return tokens
+    return doc
 
-def get_part_of_speech_and_morphological_features(text):
+def clear_stanza_biomed_cache():
+    with _craft_lock:
+        _craft_cache.clear()
+
+def _sentences_view(doc):
+    return [sentence.text for sentence in doc.sentences]
+
+def _tokens_view(doc):
+    return [[token.text for token in sentence.tokens] for sentence in doc.sentences]
+
+def _pos_view(doc):
+    return [[(word.text, word.upos, word.xpos, word.feats if word.feats else '_')
+             for word in sent.words] for sent in doc.sentences]
+
+def _lemmas_view(doc):
+    return [[(word.text, word.lemma) for word in sent.words] for sent in doc.sentences]
+
+def _dependencies_view(doc):
+    return [[(word.id, word.text, word.head, sent.words[word.head-1].text if word.head > 0 else "root", word.deprel)
+             for word in sent.words] for sent in doc.sentences]
+
+STANZA_VIEWS = {'sentences': _sentences_view,
+                'tokens': _tokens_view,
+                'pos': _pos_view,
+                'lemmas': _lemmas_view,
+                'dependencies': _dependencies_view}
+
+def get_stanza_annotations(text, views=None):
     """
-    returns a list of lists of tuples of length 4: word, universal POS (UPOS) tags, treebank-specific POS (XPOS) tags,
-    and universal morphological features (UFeats)
+    returns a dictionary {view: annotations} computed from a single craft parse of text.
+    views is a list of names from STANZA_VIEWS ('sentences', 'tokens', 'pos', 'lemmas', 'dependencies'),
+    all of them by default. Each view has the same format as the corresponding get_*_stanza_biomed function.
     """
-    stanza.download('en', package='craft')
-    nlp = stanza.Pipeline('en', package='craft')
-    doc = nlp(text)
+    if views is None:
+        views = list(STANZA_VIEWS)
+    unknown = [view for view in views if view not in STANZA_VIEWS]
+    if unknown:
+        raise ValueError(f"Unknown stanza views {unknown}, choose from {list(STANZA_VIEWS)}")
 
-    tags = [[(word.text, word.upos, word.xpos, word.feats if word.feats else '_')
-             for word in sent.words] for sent in doc.sentences]
+    doc = parse_stanza_biomed(text)
 
-    return tags
+    return {view: STANZA_VIEWS[view](doc) for view in views}
 
-def get_lemmas_stanza_biomed(text):
-    stanza.download('en', package='craft')
-    nlp = stanza.Pipeline('en', package='craft')
-    doc = nlp(text)
+def get_sents_stanza_biomed(text):
+    return _sentences_view(parse_stanza_biomed(text))
 
-    lemmas = [[(word.text, word.lemma) for word in sent.words] for sent in doc.sentences]
+def batch_sents_stanza_biomed(texts, batch_size=32):
+    nlp = load_stanza('en', package='craft')
 
-    return lemmas
+    for doc in batch_stanza_documents(nlp, texts, batch_size):
+        yield _sentences_view(doc)
 
-def get_dependency_stanza_biomed(text):
+def get_tokens_stanza_biomed(text):
+    return _tokens_view(parse_stanza_biomed(text))
+
+def get_part_of_speech_and_morphological_features(text):
     """
-    tuple of length 5:  word id, word text, head id, head text, deprel
+    returns a list of lists of tuples of length 4: word, universal POS (UPOS) tags, treebank-specific POS (XPOS) tags,
+    and universal morphological features (UFeats)
     """
+    return _pos_view(parse_stanza_biomed(text))
 
-    stanza.download('en', package='craft')
-    nlp = stanza.Pipeline('en', package='craft')
-    doc = nlp(text)
-
-    dependencies = [[(word.id, word.text, word.head, sent.words[word.head-1].text if word.head > 0 else "root", word.deprel)
-                     for word in sent.words] for sent in doc.sentences ]
+def get_lemmas_stanza_biomed(text):
+    return _lemmas_view(parse_stanza_biomed(text))
 
-    return dependencies
+def get_dependency_stanza_biomed(text):
+    """
+    tuple of length 5:  word id, word text, head id, head text, deprel
+    """
+    return _dependencies_view(parse_stanza_biomed(text))
 
 def get_denpendencies(text):
-    stanza.download('en', package='craft')
-    nlp = stanza.Pipeline('en', package='craft')
-    doc = nlp(text)
+    doc = parse_stanza_biomed(text)
     dependencies = [sent.print_dependencies() for sent in doc.sentences]
-    return dependencies
\ No newline at end of file
+    return dependencies
@@ -0,0 +1,85 @@
+import os
+import threading
+import stanza
+from stanza.pipeline.core import DownloadMethod
+from stanza.resources.common import DEFAULT_MODEL_DIR
+
+# downloads are opt-in: set ASCLE_STANZA_DOWNLOAD=1 or call set_allow_download(True)
+_allow_download = os.environ.get('ASCLE_STANZA_DOWNLOAD', '0').lower() in ('1', 'true', 'yes')
+_checked_dirs = {}
+_resolved = set()
+_lock = threading.Lock()
+
+
+class StanzaResourcesNotFound(FileNotFoundError):
+    pass
+
+
+def set_allow_download(allow_download):
+    """
+    allow (or forbid) downloading missing stanza models, downloads are disabled by default
+    """
+    global _allow_download
+    _allow_download = allow_download
+
+
+def get_model_dir():
+    return os.environ.get('STANZA_RESOURCES_DIR', DEFAULT_MODEL_DIR)
+
+
+def _key(lang, kwargs):
+    return (lang,) + tuple(sorted((k, repr(v)) for k, v in kwargs.items()))
+
+
+def _download(lang, model_dir, kwargs):
+    print(f"Downloading missing stanza resources for '{lang}' to {model_dir}")
+    stanza.download(lang, model_dir=model_dir, package=kwargs.get('package', 'default'),
+                    processors=kwargs.get('processors', {}))
+
+
+def _missing_message(lang, model_dir, kwargs):
+    return (f"stanza resources for lang='{lang}', {kwargs} are not available in {model_dir}. "
+            f"Download them once with stanza.download(...), or allow Ascle to download missing resources "
+            f"with ASCLE_STANZA_DOWNLOAD=1 or stanza_resources.set_allow_download(True).")
+
+
+def has_local_resources(model_dir=None):
+    """
+    returns True if the local stanza model directory has a resources.json, checked once per directory and process
+    """
+    model_dir = model_dir or get_model_dir()
+    if model_dir not in _checked_dirs:
+        _checked_dirs[model_dir] = os.path.exists(os.path.join(model_dir, 'resources.json'))
+    return _checked_dirs[model_dir]
+
+
+def build_stanza_pipeline(lang='en', **kwargs):
+    """
+    builds stanza.Pipeline(lang, **kwargs) from the local model directory without contacting the stanza servers.
+    Missing resources are only downloaded if downloads are allowed; a successful resolution is memoized per
+    process, so later pipelines with the same arguments skip the checks.
+    """
+    model_dir = kwargs.pop('dir', None) or get_model_dir()
+    key = _key(lang, kwargs) + (model_dir,)
+
+    with _lock:
+        if key not in _resolved and not has_local_resources(model_dir):
+            if not _allow_download:
+                raise StanzaResourcesNotFound(_missing_message(lang, model_dir, kwargs))
+            _download(lang, model_dir, kwargs)
+            _checked_dirs.pop(model_dir, None)
+
+    try:
+        nlp = stanza.Pipeline(lang, dir=model_dir, download_method=DownloadMethod.NONE, **kwargs)
+    except FileNotFoundError as error:
+        # resources.json is there but some of the models for this pipeline are not
+        if not _allow_download:
+            raise StanzaResourcesNotFound(_missing_message(lang, model_dir, kwargs)) from error
+        with _lock:
+            _download(lang, model_dir, kwargs)
+        nlp = stanza.Pipeline(lang, dir=model_dir, download_method=DownloadMethod.NONE, **kwargs)
+
+    with _lock:
+        _resolved.add(key)
+
+    return nlp
@@ -1,5 +1,6 @@
 from transformers import pipeline
 from summa.summarizer import summarize
+from model_registry import load_hf_pipeline
 
 def get_single_summary(text, model_name="t5-small", min_length=50, max_length=200):
     '''
@@ -11,7 +12,7 @@ def get_single_summary(text, model_name="t5-small", min_length=50, max_length=20
     :return: a list of string
     '''
     # choices: '`bart-large-cnn`', '`t5-small`', '`t5-base`', '`t5-large`', '`t5-3b`', '`t5-11b`'
-    classifier = pipeline("summarization",model=model_name,tokenizer=model_name)
+    classifier = load_hf_pipeline("summarization", model=model_name, tokenizer=model_name)
     res = classifier(text,min_length=min_length,max_length=max_length)
     final_summary = []
     for summary in res:
@@ -29,7 +30,7 @@ def get_multi_summary_joint(text, model_name="osama7/t5-summarization-multinews"
     :return: a list of string
     '''
     # choices: '`bart-large-cnn`', '`t5-small`', '`t5-base`', '`t5-large`', '`t5-3b`', '`t5-11b`'
-    classifier = pipeline("summarization", model=model_name, tokenizer=model_name)
+    classifier = load_hf_pipeline("summarization", model=model_name, tokenizer=model_name)
     text = ' '.join(text)
     res = classifier(text, min_length=min_length, max_length=max_length)
     final_summary = []
@@ -5,6 +5,7 @@ from utils import get_sents_stanza, get_multiple_sents_stanza
 from transformers import pipeline
 from flair.data import Sentence
 from flair.models import SequenceTagger
+from model_registry import load_hf_pipeline, load_model, load_pretrained
 
 LANG_CODE = {'Malay_written_with_Latin': '>>zlm_Latn<<', 'Mauritian_Creole': '>>mfe<<', 'Haitian': '>>hat<<',
              'Papiamento': '>>pap<<', 'Asturian': '>>ast<<', 'Catalan': '>>cat<<', 'Indonesian': '>>ind<<',
@@ -15,7 +16,63 @@ LANG_CODE = {'Malay_written_with_Latin': '>>zlm_Latn<<', 'Mauritian_Creole': '>>
 def get_supported_translation_languages():
     return list(LANG_CODE.keys())
 
-def get_translation(text, model_name, target_language):
+def _length_buckets(lengths, max_tokens_per_batch):
+    """
+    groups indices into batches of similar length so that (batch size * longest input) <= max_tokens_per_batch;
+    an input longer than the budget gets a batch of its own
+    """
+    batches = []
+    batch = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # inputs are sorted by length, so lengths[i] is the padded length of the batch once i is added
+        if batch and lengths[i] * (len(batch) + 1) > max_tokens_per_batch:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def generate_in_batches(model, tokenizer, texts, max_tokens_per_batch=4096, window_size=256, max_input_length=512, **generate_kwargs):
+    '''
+    runs model.generate over texts with bounded memory and yields the decoded output of each text, in input order.
+    Texts are read window_size at a time; inside a window they are sorted by length and grouped into batches
+    of at most max_tokens_per_batch padded input tokens, so one long sentence no longer pads all the short ones.
+    :param texts: a list of input strings (e.g. sentences of a note)
+    :param max_tokens_per_batch: upper bound on (batch size * longest input) for a single generate call
+    :param window_size: number of texts buffered before their outputs are yielded
+    :param max_input_length: inputs are truncated to this many tokens
+    :param generate_kwargs: passed on to model.generate
+    '''
+    for start in range(0, len(texts), window_size):
+        window = texts[start:start + window_size]
+        input_ids = tokenizer(window, truncation=True, max_length=max_input_length)["input_ids"]
+        outputs = [None] * len(window)
+
+        for batch in _length_buckets([len(ids) for ids in input_ids], max_tokens_per_batch):
+            inputs = tokenizer.pad({"input_ids": [input_ids[i] for i in batch]}, return_tensors="pt")
+            inputs = {k: v.to(model.device) for k, v in inputs.items()}
+
+            with torch.inference_mode():
+                generated = model.generate(**inputs, **generate_kwargs)
+
+            for i, ids in zip(batch, generated):
+                outputs[i] = tokenizer.decode(ids, skip_special_tokens=True)
+
+        yield from outputs
+
+def iter_translation(text, model_name, target_language, max_tokens_per_batch=4096):
+    '''
+    translates text sentence by sentence, yields the translated sentences in order
+    '''
+    tokenizer = load_pretrained(MarianTokenizer, model_name)
+    model = load_pretrained(MarianMTModel, model_name)
+
+    sents = [f'{LANG_CODE[target_language]} ' + sent for sent in get_sents_stanza(text)]
+
+    yield from generate_in_batches(model, tokenizer, sents, max_tokens_per_batch)
+
+def get_translation(text, model_name, target_language, max_tokens_per_batch=4096):
     '''
     returns a string, which is the translated version of text
     '''
@@ -25,38 +82,45 @@ def get_translation(text, model_name, target_language):
     partial_input = '\n'.join(text.split('\n')[:5])
     print(f"Input text (truncated): {partial_input}\n...")
 
-    # translation using MarianMT
-    tokenizer = MarianTokenizer.from_pretrained(model_name)
-    model = MarianMTModel.from_pretrained(model_name)
-
-    sents = [f'{LANG_CODE[target_language]} ' + sent for sent in get_sents_stanza(text)]
-
-    translated = model.generate(**tokenizer(sents, return_tensors="pt", padding=True))
-    translated = ' '.join([tokenizer.decode(t, skip_special_tokens=True) for t in translated])
+    # translation using MarianMT, in length-bucketed batches of sentences
+    translated = ' '.join(iter_translation(text, model_name, target_language, max_tokens_per_batch))
 
     return translated
 
-def get_bert_embeddings(pretrained_model, texts):
+def get_bert_embeddings(pretrained_model, texts, max_tokens_per_batch=8192, max_length=128, window_size=4096):
     """
     texts: a list of lists of sentences, each list is made up of sentences from the same document
+    returns a float32 numpy matrix of shape (number of documents, hidden size), row i is the mean of the pooled
+    sentence embeddings of document i (zeros for a document without sentences)
+
+    Sentences of all documents are flattened, sorted by length and encoded in batches of at most
+    max_tokens_per_batch padded tokens; the pooled outputs are then averaged back per document using
+    the index of the document each sentence came from.
     """
 
-    tokenizer = AutoTokenizer.from_pretrained(pretrained_model)
-    model = AutoModel.from_pretrained(pretrained_model, return_dict=False, output_hidden_states=True)
+    tokenizer = load_pretrained(AutoTokenizer, pretrained_model)
+    model = load_pretrained(AutoModel, pretrained_model, return_dict=False, output_hidden_states=True)
 
-    output_embeddings = []
+    sentences = [sentence for text in texts for sentence in text]
+    segments = np.array([i for i, text in enumerate(texts) for _ in text], dtype=np.int64)
 
-    for text in texts:
-        # get embeddings for each sentence, compute mean to represent document
-        inputs = tokenizer(text, padding=True, truncation=True, max_length=128, return_tensors='pt')
+    sums = np.zeros((len(texts), model.config.hidden_size), dtype=np.float32)
 
-        with torch.no_grad():
-            model_output = model(**inputs)
+    for start in range(0, len(sentences), window_size):
+        input_ids = tokenizer(sentences[start:start + window_size], truncation=True, max_length=max_length)["input_ids"]
+        window_segments = segments[start:start + window_size]
 
-        pooled_output = model_output[1]
-        mean_embedding = torch.mean(pooled_output, axis=0)
+        for batch in _length_buckets([len(ids) for ids in input_ids], max_tokens_per_batch):
+            inputs = tokenizer.pad({"input_ids": [input_ids[i] for i in batch]}, return_tensors="pt")
+            inputs = {k: v.to(model.device) for k, v in inputs.items()}
 
-        output_embeddings.append(mean_embedding.numpy())
+            with torch.inference_mode():
+                pooled_output = model(**inputs)[1]
+
+            np.add.at(sums, window_segments[batch], pooled_output.float().cpu().numpy())
+
+    counts = np.bincount(segments, minlength=len(texts)).astype(np.float32)
+    output_embeddings = sums / np.maximum(counts, 1)[:, None]
 
     return output_embeddings
 
@@ -71,7 +135,7 @@ def get_single_summary(text, model_name="t5-small", min_length=50, max_length=20
     '''
     # choices: '`bart-large-cnn`', '`t5-small`', '`t5-base`', '`t5-large`', '`t5-3b`', '`t5-11b`'
 
-    classifier = pipeline("summarization", model=model_name, tokenizer=model_name)
+    classifier = load_hf_pipeline("summarization", model=model_name, tokenizer=model_name)
     res = classifier(text, min_length=min_length, max_length=max_length)
     final_summary = []
 
@@ -82,6 +146,21 @@ def get_single_summary(text, model_name="t5-small", min_length=50, max_length=20
 
     return final_summary
 
+def batch_single_summary(texts, model_name="t5-small", min_length=50, max_length=200, batch_size=8):
+    '''
+    summarizes every text of an iterable with one pipeline call, letting the pipeline batch the inputs
+    :param texts: an iterable of strings
+    :param batch_size: number of texts sent to the model at once
+    :return: a generator of summary strings, in input order
+    '''
+    classifier = load_hf_pipeline("summarization", model=model_name, tokenizer=model_name)
+    res = classifier((text for text in texts), min_length=min_length, max_length=max_length, batch_size=batch_size)
+
+    for summaries in res:
+        if isinstance(summaries, dict):
+            summaries = [summaries]
+        yield '\n\n'.join([summary['summary_text'] for summary in summaries])
+
 def get_multi_summary_joint(text, model_name="osama7/t5-summarization-multinews", min_length=50, max_length=200):
     '''
     Join all the input documents as a long document, then do single document summarization
@@ -93,7 +172,7 @@ def get_multi_summary_joint(text, model_name="osama7/t5-summarization-multinews"
     '''
     # choices: '`bart-large-cnn`', '`t5-small`', '`t5-base`', '`t5-large`', '`t5-3b`', '`t5-11b`'
 
-    classifier = pipeline("summarization", model=model_name, tokenizer=model_name)
+    classifier = load_hf_pipeline("summarization", model=model_name, tokenizer=model_name)
     text = ' '.join(text)
     res = classifier(text, min_length=min_length, max_length=max_length)
     final_summary = []
@@ -112,13 +191,13 @@ def get_span_answer(question, context,model_name="sultan/BioM-ELECTRA-Large-SQuA
     # result is a dictionary, i.e., {'score': 0.9190713763237, 'start': 34, 'end': 40, 'answer': 'Berlin'}; we return the answer token directly
     # for testing purpose: question='Where do I live?', context="My name is Wolfgang and I live in Berlin"
 
-    bot =  pipeline(model=model_name)
+    bot = load_hf_pipeline(model=model_name)
     answer = bot(question=question, context=context)
     return answer['answer']
     
 def get_question(context, model_name="AnonymousSub/SciFive_MedQuAD_question_generation"):
     # generate a question given the input content
-    bot =  pipeline(model=model_name)
+    bot = load_hf_pipeline(model=model_name)
     question = bot(context)
     
     return question
@@ -185,8 +264,8 @@ def get_choice(text, question, choices, num_labels, model_checkpoint="microsoft/
     They can be added.
     '''
 
-    tokenizer = AutoTokenizer.from_pretrained(model_checkpoint)
-    model = AutoModelForMultipleChoice.from_pretrained(model_checkpoint, num_labels=num_labels)
+    tokenizer = load_pretrained(AutoTokenizer, model_checkpoint)
+    model = load_pretrained(AutoModelForMultipleChoice, model_checkpoint, num_labels=num_labels)
 
     choice_inputs = []
     for choice in choices:
@@ -209,7 +288,7 @@ def get_choice(text, question, choices, num_labels, model_checkpoint="microsoft/
     
 def get_med_question(context, model_name="AnonymousSub/SciFive_MedQuAD_question_generation"):
     # generate a question given the input content
-    bot =  pipeline("text2text-generation", model=model_name)
+    bot = load_hf_pipeline("text2text-generation", model=model_name)
     question = bot(context)[0]
     question = question['generated_text']
     return question
@@ -223,7 +302,7 @@ def get_layman_text(text, model_name="ireneli1024/bart-large-elife-finetuned",mi
     :param max_length: max length in summary
     :return: summary string
     '''
-    classifier = pipeline("summarization", model=model_name, tokenizer=model_name,min_length=min_length, max_length=max_length)
+    classifier = load_hf_pipeline("summarization", model=model_name, tokenizer=model_name, min_length=min_length, max_length=max_length)
     res = classifier(text)
     final_summary = []
 
@@ -234,11 +313,25 @@ def get_layman_text(text, model_name="ireneli1024/bart-large-elife-finetuned",mi
 
     return lay_summary
 
+def batch_layman_text(texts, model_name="ireneli1024/bart-large-elife-finetuned", min_length=50, max_length=200, batch_size=8):
+    '''
+    batched version of get_layman_text
+    :param texts: an iterable of strings
+    :return: a generator of lay summaries, in input order
+    '''
+    classifier = load_hf_pipeline("summarization", model=model_name, tokenizer=model_name, min_length=min_length, max_length=max_length)
+    res = classifier((text for text in texts), batch_size=batch_size)
+
+    for summaries in res:
+        if isinstance(summaries, dict):
+            summaries = [summaries]
+        yield '\n\n'.join([summary['summary_text'] for summary in summaries])
+
 def get_dialogpt():
     
 
-    tokenizer = AutoTokenizer.from_pretrained("microsoft/DialoGPT-medium")
-    model = AutoModelForCausalLM.from_pretrained("microsoft/DialoGPT-medium")
+    tokenizer = load_pretrained(AutoTokenizer, "microsoft/DialoGPT-medium")
+    model = load_pretrained(AutoModelForCausalLM, "microsoft/DialoGPT-medium")
 
     # Let's chat for 5 lines
     for step in range(5):
@@ -262,7 +355,7 @@ def get_pos_tagging_hf(text,model_name="flair/pos-english"):
     :return: a list of token/pos tag with a score. 
     '''
     
-    tagger = SequenceTagger.load(model_name)
+    tagger = load_model('flair', model_name, lambda: SequenceTagger.load(model_name))
     
      # make example sentence
     sentence = Sentence(text)
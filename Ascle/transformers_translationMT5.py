@@ -6,11 +6,14 @@ FilePath: /Irene_Qingcheng/transformers_MT.py
 '''
 import transformers
 from transformers import MT5Tokenizer,MT5ForConditionalGeneration
+from model_registry import load_pretrained
+from transformer_functions import generate_in_batches
+from utils import get_sents_stanza
 
-def get_mT5_translation(text,target_language):
+def iter_mT5_translation(text, target_language, max_tokens_per_batch=4096):
     """
-    This function generates a translated text from English to target language
-    using multilingual T5.
+    Translates text sentence by sentence from English to target language
+    using multilingual T5, yields the translated sentences in order.
     """
     lang_code = {"French":"fr","Polish":"pl","German":"de","Romanian":"ro",
                  "Hungarian":"hu","Spanish":"es","Swedish":"sv","Czech":"cs"}
@@ -24,12 +27,20 @@ def get_mT5_translation(text,target_language):
         target_language = lang_code[target_language]
     
     model_name = "qcz/en-{}-UFAL-medical".format(target_language)
-    model = MT5ForConditionalGeneration.from_pretrained(model_name)
-    tokenizer = MT5Tokenizer.from_pretrained(model_name)
+    model = load_pretrained(MT5ForConditionalGeneration, model_name)
+    tokenizer = load_pretrained(MT5Tokenizer, model_name)
 
     prefix = "translate English to {}: ".format(reversed_code[target_language])
-    input_ids = tokenizer(prefix+text,return_tensors="pt")["input_ids"]
-    generated_ids = model.generate(input_ids, max_new_tokens=512)
-    prediction = tokenizer.decode(generated_ids[0], skip_special_tokens=True)
+    # long notes are split into sentences instead of being squeezed into a single 512-token generate call
+    sents = [prefix + sent for sent in get_sents_stanza(text)]
+
+    yield from generate_in_batches(model, tokenizer, sents, max_tokens_per_batch, max_new_tokens=512)
+
+def get_mT5_translation(text, target_language, max_tokens_per_batch=4096):
+    """
+    This function generates a translated text from English to target language
+    using multilingual T5.
+    """
+    prediction = ' '.join(iter_mT5_translation(text, target_language, max_tokens_per_batch))
 
     return prediction
\ No newline at end of file
@@ -1,16 +1,33 @@
 import torch
 import numpy as np
 import re
+import atexit
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from transformers import AutoModel, AutoTokenizer
 from sklearn.metrics.pairwise import cosine_similarity
 from sentence_transformers.cross_encoder import CrossEncoder
+from umls_store import UMLSStore, UMLSResponseCache, RelationEmbeddingStore
+from model_registry import load_model, load_pretrained
+from vector_index import top_k_indices
+
+# local UMLS store (built with umls_store.py) and REST response cache used by get_umls_api
+UMLS_STORE = os.environ.get('UMLS_STORE', 'umls_store.sqlite')
+UMLS_CACHE = os.environ.get('UMLS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ascle', 'umls_responses.sqlite'))
+# persistent store of the UMLSBERT embeddings of the relations of each CUI, see embed_relations
+UMLS_EMBEDDINGS = os.environ.get('UMLS_EMBEDDINGS', os.path.join(os.path.expanduser('~'), '.cache', 'ascle', 'umls_relation_embeddings.sqlite'))
+UMLSBERT_MODEL = "GanjinZero/UMLSBert_ENG"
+CROSS_ENCODER_MODEL = "ncbi/MedCPT-Cross-Encoder"
 
 class UMLSBERT:
     def __init__(self):
-        self.tokenizer = AutoTokenizer.from_pretrained("GanjinZero/UMLSBert_ENG")
-        self.model = AutoModel.from_pretrained("GanjinZero/UMLSBert_ENG")
+        self.tokenizer = load_pretrained(AutoTokenizer, UMLSBERT_MODEL)
+        self.model = load_pretrained(AutoModel, UMLSBERT_MODEL)
 
     def mean_pooling(self, model_output, attention_mask):
         token_embeddings = model_output[0]  
@@ -34,7 +51,8 @@ def get_similarity(query_vec, rel_vec):
 
 class UMLS_CrossEncoder:
     def __init__(self):
-        self.model = CrossEncoder("ncbi/MedCPT-Cross-Encoder")
+        self.model = load_model('sentence_transformers.CrossEncoder', CROSS_ENCODER_MODEL,
+                                lambda: CrossEncoder(CROSS_ENCODER_MODEL))
 
     def score(self, query, rels):
         if not rels:
@@ -43,34 +61,110 @@ class UMLS_CrossEncoder:
         scores = self.model.predict(pairs)
         return scores
 
+class RateLimiter:
+    """
+    Thread-safe limiter allowing at most rate calls of wait() per second (the UTS API accepts 20 requests per second)
+    """
+    def __init__(self, rate=20):
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
 class UMLS_API:
-    def __init__(self, apikey, version="current"):
+    """
+    UTS REST API client. With a local UMLSStore, concepts found in the store are answered from it (definitions
+    and relations only if the store was built with MRDEF and MRREL); the other calls go to the REST service and, with a UMLSResponseCache, successful responses are cached.
+
+    Requests share a pooled session, are rate limited (rate requests per second) and retried up to retries times
+    with exponential backoff on connection errors, 429 and 5xx responses. Relation pages and the terms of
+    lookup_terms are fetched concurrently by up to max_workers threads. close() (or leaving a with block) shuts
+    the threads and the session down.
+    """
+    def __init__(self, apikey, version="current", store=None, cache=None, max_workers=8, rate=20, retries=3,
+                 backoff=0.5, timeout=10):
         self.apikey = apikey
         self.version = version
+        self.store = store
+        self.cache = cache
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # a pool of its own for lookup_terms: lookup_term waits on definitions and relation pages submitted to
+        # self._executor, so terms running in self._executor could take all its threads and wait on each other forever
+        self._term_executor = ThreadPoolExecutor(max_workers=max_workers)
         self.search_url = f"https://uts-ws.nlm.nih.gov/rest/search/{version}"
         self.content_url = f"https://uts-ws.nlm.nih.gov/rest/content/{version}"
         self.content_suffix = "/CUI/{}/{}?apiKey={}"
 
+    def _cached(self, key):
+        if self.cache is None:
+            return None
+        return self.cache.get(f"{self.version}|{key}")
+
+    def _cache(self, key, value):
+        if self.cache is not None:
+            self.cache.put(f"{self.version}|{key}", value)
+
+    def _get(self, url, params=None):
+        """
+        GET url and return its json, None for a 404 (e.g. a relation page after the last one)
+        """
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait()
+            try:
+                r = self.session.get(url, params=params, timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                if attempt == self.retries:
+                    raise
+            else:
+                if r.status_code == 404:
+                    return None
+                if r.status_code != 429 and r.status_code < 500 or attempt == self.retries:
+                    r.raise_for_status()
+                    r.encoding = "utf-8"
+                    return r.json()
+            time.sleep(self.backoff * 2 ** attempt)
+
     def search_cui(self, query):
+        if self.store is not None:
+            cui_results = self.store.search_cui(query)
+            if cui_results:
+                return cui_results
+        cached = self._cached(f"search|{query}")
+        if cached is not None:
+            return [tuple(result) for result in cached]
+
         cui_results = []
 
         try:
             page = 1
             size = 1
-            query = {"string": query, "apiKey": self.apikey, "pageNumber": page, "pageSize": size}
-            r = requests.get(self.search_url, params=query)
-            r.raise_for_status()
-            print(r.url)
-            r.encoding = 'utf-8'
-            outputs = r.json()
+            params = {"string": query, "apiKey": self.apikey, "pageNumber": page, "pageSize": size}
+            outputs = self._get(self.search_url, params)
 
-            items = outputs["result"]["results"]
+            items = outputs["result"]["results"] if outputs is not None else []
 
             if len(items) == 0:
                 print("No results found.\n")
 
             for result in items:
                 cui_results.append((result["ui"], result["name"]))
+            # an empty result may be a transient miss (e.g. a 404), it is asked again next time
+            if cui_results:
+                self._cache(f"search|{query}", cui_results)
 
         except Exception as except_error:
             print(except_error)
@@ -78,39 +172,169 @@ class UMLS_API:
         return cui_results
 
     def get_definitions(self, cui):
+        if self.store is not None and self.store.loaded('definitions') and self.store.has_concept(cui):
+            return self.store.get_definitions(cui)
+        cached = self._cached(f"definitions|{cui}")
+        if cached is not None:
+            return cached
+
         try:
             suffix = self.content_suffix.format(cui, "definitions", self.apikey)
-            r = requests.get(self.content_url + suffix)
-            r.raise_for_status()
-            r.encoding = "utf-8"
-            outputs = r.json()
+            outputs = self._get(self.content_url + suffix)
+            if outputs is None:
+                return None
 
+            self._cache(f"definitions|{cui}", outputs["result"])
             return outputs["result"]
         except Exception as except_error:
             print(except_error)
 
+    def _get_relation_page(self, cui, page):
+        """
+        returns the relations of a page and the number of relation pages of cui, ([], 0) if the page is missing
+        """
+        suffix = self.content_suffix.format(cui, "relations", self.apikey) + f"&pageNumber={page}"
+        outputs = self._get(self.content_url + suffix)
+        if outputs is None:
+            return [], 0
+        return outputs.get("result", []), outputs.get("pageCount", 1)
+
     def get_relations(self, cui, pages=20):
+        if self.store is not None and self.store.loaded('relations') and self.store.has_concept(cui):
+            return self.store.get_relations(cui, pages)
+        cached = self._cached(f"relations|{pages}|{cui}")
+        if cached is not None:
+            return cached
+
         all_relations = []
+        if pages < 1:
+            return all_relations
 
         try:
-            for page in range(1, pages + 1):
-                suffix = self.content_suffix.format(cui, "relations", self.apikey) + f"&pageNumber={page}"
-                r = requests.get(self.content_url + suffix)
-                r.raise_for_status()
-                r.encoding = "utf-8"
-                outputs = r.json()
-
-                page_relations = outputs.get("result", [])
+            # the first page gives the number of pages, only the existing ones (up to pages) are requested
+            first_relations, page_count = self._get_relation_page(cui, 1)
+            all_relations.extend(first_relations)
+            numbers = range(2, min(page_count, pages) + 1)
+            for page_relations, _ in self._executor.map(lambda page: self._get_relation_page(cui, page), numbers):
                 all_relations.extend(page_relations)
+            if all_relations:
+                self._cache(f"relations|{pages}|{cui}", all_relations)
 
         except Exception as except_error:
             print(except_error)
 
         return all_relations
 
-umls_api = UMLS_API("UMLS_API")
-umlsbert = UMLSBERT()
-cross_encoder = UMLS_CrossEncoder()
+    def lookup_term(self, term, pages=20):
+        """
+        returns (cui, name, definitions, relations) of the first concept matching term, None if there is none;
+        definitions and relations are fetched concurrently
+        """
+        cuis = self.search_cui(term)
+        if len(cuis) == 0:
+            return None
+        cui, name = cuis[0]
+        definitions = self._executor.submit(self.get_definitions, cui)
+        relations = self.get_relations(cui, pages)
+        return cui, name, definitions.result(), relations
+
+    def lookup_terms(self, terms, pages=20):
+        """
+        lookup_term for every term concurrently (up to max_workers terms at a time), results in the order of terms
+        """
+        if not terms:
+            return []
+        return list(self._term_executor.map(lambda term: self.lookup_term(term, pages), terms))
+
+    def close(self):
+        """
+        shuts down the worker threads and closes the HTTP session; the store and the cache are left open
+        """
+        self._term_executor.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# created on first use by the getters below, so importing the module opens no file and starts no thread
+_umls_api = None
+_relation_store = None
+_lock = threading.Lock()
+
+def get_umls_api():
+    """
+    UMLS_API used by get_umls_keys, with the store at UMLS_STORE if it exists and the response cache at UMLS_CACHE;
+    it is closed at exit
+    """
+    global _umls_api
+    with _lock:
+        if _umls_api is None:
+            _umls_api = UMLS_API("UMLS_API",
+                                 store=UMLSStore(UMLS_STORE) if os.path.exists(UMLS_STORE) else None,
+                                 cache=UMLSResponseCache(UMLS_CACHE))
+            atexit.register(_umls_api.close)
+        return _umls_api
+
+def get_relation_store():
+    """
+    RelationEmbeddingStore at UMLS_EMBEDDINGS holding the relation embeddings of each CUI
+    """
+    global _relation_store
+    with _lock:
+        if _relation_store is None:
+            _relation_store = RelationEmbeddingStore(UMLS_EMBEDDINGS)
+            atexit.register(_relation_store.close)
+        return _relation_store
+
+def relation_text(rel):
+    return f"{rel.get('relatedFromIdName', '')} {rel.get('additionalRelationLabel', '').replace('_', ' ')} {rel.get('relatedIdName', '')}"
+
+def embed_relations(relations, cui=None):
+    """
+    returns the (number of relations, dim) UMLSBERT embeddings of the relation texts. With the cui the relations
+    belong to, the embeddings stored for it are reused and only relations missing from its entry are encoded
+    (the entry is then updated); without one, every relation is encoded
+    """
+    texts = [relation_text(rel) for rel in relations]
+    stored = get_relation_store().get(UMLSBERT_MODEL, cui) if cui is not None else None
+    vectors = dict(zip(*stored)) if stored is not None else {}
+
+    missing = list(dict.fromkeys(text for text in texts if text not in vectors))
+    if missing:
+        vectors.update(zip(missing, np.asarray(UMLSBERT().batch_encode(missing), dtype=np.float32)))
+        if cui is not None:
+            get_relation_store().put(UMLSBERT_MODEL, cui, list(vectors), np.vstack(list(vectors.values())))
+    return np.vstack([vectors[text] for text in texts])
+
+def rank_relations(query_embedding, relations, top_k=200, cui=None):
+    """
+    returns [(cosine similarity, relation)] of the top_k relations most similar to the query, best first,
+    scored with one matrix-vector product; cui is passed on to embed_relations
+    """
+    if not relations:
+        return []
+    relation_embeddings = embed_relations(relations, cui)
+    relation_embeddings = relation_embeddings / np.maximum(np.linalg.norm(relation_embeddings, axis=1, keepdims=True), 1e-12)
+    query_embedding = np.asarray(query_embedding, dtype=np.float32)
+    query_embedding = query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+    similarities = relation_embeddings @ query_embedding
+    return [(float(similarities[i]), relations[i]) for i in top_k_indices(similarities, top_k)]
+
+def precompute_relation_embeddings(terms, pages=20):
+    """
+    looks up terms (e.g. the frequent terminologies of a deployment) and stores the relation embeddings of their
+    concepts, so questions about them do not encode relations at query time; returns the number of relations
+    """
+    count = 0
+    for result in get_umls_api().lookup_terms(terms, pages):
+        if result is not None and result[3]:
+            embed_relations(result[3], result[0])
+            count += len(result[3])
+    return count
 
 def get_umls_keys(query, prompt, llm):
     umls_res = {}
@@ -131,16 +355,15 @@ def get_umls_keys(query, prompt, llm):
         print(f"Error during model processing: {e}")
         return "" 
 
-    for key in keys_dict["medical terminologies"][:]:
-        cuis = umls_api.search_cui(key)
-
-        if len(cuis) == 0:
+    # every terminology is looked up concurrently, the ranking below runs one terminology at a time
+    query_embedding = None
+    cross_encoder = None
+    for result in get_umls_api().lookup_terms(keys_dict["medical terminologies"][:]):
+        if result is None:
             continue
-        cui = cuis[0][0]
-        name = cuis[0][1]
+        cui, name, definitions, relations = result
 
         defi = ""
-        definitions = umls_api.get_definitions(cui)
 
         if definitions is not None:
             msh_def = None
@@ -165,20 +388,16 @@ def get_umls_keys(query, prompt, llm):
 
             defi = msh_def or nci_def or icf_def or csp_def or hpo_def
 
-        relations = umls_api.get_relations(cui)
         rels=[]
 
         if relations is not None:
-            relation_texts = [query] + [f"{rel.get('relatedFromIdName', '')} {rel.get('additionalRelationLabel', '').replace('_', ' ')} {rel.get('relatedIdName', '')}" for rel in relations]
-            embeddings = umlsbert.batch_encode(relation_texts)
-
-            query_embedding = embeddings[0]
-            relation_embeddings = embeddings[1:]
-            relation_scores = [(get_similarity([query_embedding], [rel_emb]), rel) for rel_emb, rel in zip(relation_embeddings, relations)]
-            relation_scores.sort(key=lambda x: x[0],reverse=True)
-            rank_rels = relation_scores[:200]
+            if query_embedding is None:
+                query_embedding = UMLSBERT().batch_encode([query])[0]
+            rank_rels = rank_relations(query_embedding, relations, 200, cui)
 
-            rank_rel_texts = [f"{rel[1].get('relatedFromIdName', '')} {rel[1].get('additionalRelationLabel', '').replace('_', ' ')} {rel[1].get('relatedIdName', '')}" for rel in rank_rels]
+            rank_rel_texts = [relation_text(rel[1]) for rel in rank_rels]
+            if cross_encoder is None:
+                cross_encoder = UMLS_CrossEncoder()
             scores = cross_encoder.score(query, rank_rel_texts)
             cross_encoded_scores = list(zip(scores, rank_rels))
             cross_encoded_scores.sort(key=lambda x: x[0], reverse=True)
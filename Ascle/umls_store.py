@@ -0,0 +1,288 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+# number of relations per page of the UTS REST API, UMLSStore.get_relations returns pages * RELATIONS_PAGE_SIZE at most
+RELATIONS_PAGE_SIZE = 25
+
+# columns of the UMLS Metathesaurus RRF files (see the UMLS reference manual)
+MRCONSO_COLUMNS = ['CUI', 'LAT', 'TS', 'LUI', 'STT', 'SUI', 'ISPREF', 'AUI', 'SAUI', 'SCUI', 'SDUI', 'SAB', 'TTY',
+                   'CODE', 'STR', 'SRL', 'SUPPRESS', 'CVF']
+MRDEF_COLUMNS = ['CUI', 'AUI', 'ATUI', 'SATUI', 'SAB', 'DEF', 'SUPPRESS', 'CVF']
+MRREL_COLUMNS = ['CUI1', 'AUI1', 'STYPE1', 'REL', 'CUI2', 'AUI2', 'STYPE2', 'RELA', 'RUI', 'SRUI', 'SAB', 'SL',
+                 'RG', 'DIR', 'SUPPRESS', 'CVF']
+
+
+def normalize(text):
+    return ' '.join(text.lower().split())
+
+
+def read_rrf(path, columns):
+    """yields one dict per line of a pipe-delimited UMLS .RRF file"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            values = line.rstrip('\n').split('|')
+            yield dict(zip(columns, values))
+
+
+class UMLSStore:
+    """
+    Local UMLS knowledge store: concept names, definitions and relations compiled from the Metathesaurus
+    files MRCONSO.RRF, MRDEF.RRF and MRREL.RRF into one SQLite file (see build_umls_store).
+
+    search_cui, get_definitions and get_relations answer like the UTS REST API used by umls_rerank.UMLS_API,
+    so the API can use the store first and only call the REST service for what is not in it.
+
+    Args:
+        path (str): SQLite file of the store
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS concepts (cui TEXT PRIMARY KEY, name TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS strings (norm TEXT NOT NULL, cui TEXT NOT NULL, preferred INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS definitions (cui TEXT NOT NULL, source TEXT NOT NULL, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS relations (cui TEXT NOT NULL, related_cui TEXT NOT NULL, rel TEXT NOT NULL,
+                                                  rela TEXT NOT NULL, source TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        ''')
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM concepts')[0][0]
+
+    def name(self, cui):
+        rows = self._query('SELECT name FROM concepts WHERE cui = ?', (cui,))
+        return rows[0][0] if rows else None
+
+    def search_cui(self, query, size=1):
+        """
+        returns [(cui, name)] of the concepts with a name equal to query (ignoring case and spaces),
+        concepts for which query is the preferred name first
+        """
+        rows = self._query('SELECT s.cui, c.name FROM strings s JOIN concepts c ON c.cui = s.cui WHERE s.norm = ? '
+                           'GROUP BY s.cui ORDER BY MAX(s.preferred) DESC, s.cui LIMIT ?', (normalize(query), size))
+        return [(cui, name) for cui, name in rows]
+
+    def get_definitions(self, cui):
+        """
+        returns the definitions of cui as [{"rootSource": ..., "value": ...}], None if it has none
+        """
+        rows = self._query('SELECT source, value FROM definitions WHERE cui = ?', (cui,))
+        if not rows:
+            return None
+        return [{'rootSource': source, 'value': value} for source, value in rows]
+
+    def get_relations(self, cui, pages=20):
+        """
+        returns the relations of cui in the format of the REST API (relatedFromIdName, relationLabel,
+        additionalRelationLabel, relatedIdName, rootSource), at most pages * RELATIONS_PAGE_SIZE of them
+        """
+        rows = self._query('SELECT c1.name, r.rel, r.rela, c2.name, r.source FROM relations r '
+                           'JOIN concepts c1 ON c1.cui = r.cui JOIN concepts c2 ON c2.cui = r.related_cui '
+                           'WHERE r.cui = ? LIMIT ?', (cui, pages * RELATIONS_PAGE_SIZE))
+        return [{'relatedFromIdName': from_name, 'relationLabel': rel, 'additionalRelationLabel': rela,
+                 'relatedIdName': to_name, 'rootSource': source}
+                for from_name, rel, rela, to_name, source in rows]
+
+    def has_concept(self, cui):
+        return bool(self._query('SELECT 1 FROM concepts WHERE cui = ?', (cui,)))
+
+    def loaded(self, table):
+        """
+        True if build_umls_store filled table ('definitions' from MRDEF, 'relations' from MRREL); without it,
+        the store knows nothing about the definitions or relations of its concepts
+        """
+        return bool(self._query('SELECT 1 FROM meta WHERE key = ?', (f'loaded_{table}',)))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _insert_batches(db, sql, rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            db.executemany(sql, batch)
+            batch = []
+    db.executemany(sql, batch)
+
+
+def build_umls_store(path, mrconso, mrdef=None, mrrel=None, languages=('ENG',), batch_size=100000):
+    """
+    compiles the Metathesaurus files into a UMLSStore at path (replacing its content) and returns it;
+    only strings in languages are kept, suppressed entries are skipped
+    """
+    store = UMLSStore(path)
+    db = store._db
+    with db:
+        db.executescript('''
+            DROP INDEX IF EXISTS strings_norm; DROP INDEX IF EXISTS definitions_cui; DROP INDEX IF EXISTS relations_cui;
+            DELETE FROM concepts; DELETE FROM strings; DELETE FROM definitions; DELETE FROM relations; DELETE FROM meta;
+        ''')
+        names = {}
+
+        def strings():
+            for row in read_rrf(mrconso, MRCONSO_COLUMNS):
+                if row['LAT'] not in languages or row['SUPPRESS'] not in ('N', ''):
+                    continue
+                preferred = row['TS'] == 'P' and row['STT'] == 'PF' and row['ISPREF'] == 'Y'
+                # the preferred name of the concept, otherwise its first string
+                current = names.get(row['CUI'])
+                if current is None or (preferred and not current[1]):
+                    names[row['CUI']] = (row['STR'], preferred)
+                yield normalize(row['STR']), row['CUI'], int(preferred)
+
+        _insert_batches(db, 'INSERT INTO strings (norm, cui, preferred) VALUES (?, ?, ?)', strings(), batch_size)
+        _insert_batches(db, 'INSERT INTO concepts (cui, name) VALUES (?, ?)',
+                        ((cui, name) for cui, (name, _) in names.items()), batch_size)
+        print(f'{len(names)} concepts loaded')
+
+        if mrdef is not None:
+            _insert_batches(db, 'INSERT INTO definitions (cui, source, value) VALUES (?, ?, ?)',
+                            ((row['CUI'], row['SAB'], row['DEF']) for row in read_rrf(mrdef, MRDEF_COLUMNS)
+                             if row['CUI'] in names and row['SUPPRESS'] in ('N', '')), batch_size)
+            db.execute("INSERT INTO meta (key, value) VALUES ('loaded_definitions', ?)", (mrdef,))
+        if mrrel is not None:
+            _insert_batches(db, 'INSERT INTO relations (cui, related_cui, rel, rela, source) VALUES (?, ?, ?, ?, ?)',
+                            ((row['CUI1'], row['CUI2'], row['REL'], row['RELA'], row['SAB'])
+                             for row in read_rrf(mrrel, MRREL_COLUMNS)
+                             if row['CUI1'] in names and row['CUI2'] in names and row['SUPPRESS'] in ('N', '')),
+                            batch_size)
+            db.execute("INSERT INTO meta (key, value) VALUES ('loaded_relations', ?)", (mrrel,))
+
+        db.executescript('''
+            CREATE INDEX strings_norm ON strings (norm);
+            CREATE INDEX definitions_cui ON definitions (cui);
+            CREATE INDEX relations_cui ON relations (cui);
+        ''')
+    return store
+
+
+class UMLSResponseCache:
+    """
+    Persistent cache of UTS REST API responses (json values) in a SQLite file; entries older than ttl seconds
+    are ignored and replaced by the next put.
+
+    Args:
+        path (str): SQLite file of the cache, created with its directory if needed
+        ttl (float): time to live of the entries in seconds, None to keep them forever
+    """
+    def __init__(self, path, ttl=30 * 24 * 3600):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                         'created REAL NOT NULL)')
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._db.execute('SELECT value, created FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None or (self.ttl is not None and time.time() - row[1] > self.ttl):
+            return default
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)',
+                             (key, json.dumps(value), time.time()))
+            self._db.commit()
+
+    def expire(self):
+        """
+        removes the expired entries, returns how many were removed
+        """
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            removed = self._db.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.ttl,)).rowcount
+            self._db.commit()
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class RelationEmbeddingStore:
+    """
+    Persistent store of the relation embeddings of UMLS concepts in a SQLite file, keyed by (model, CUI): the entry
+    of a concept holds the texts of its relations and their embeddings as one float32 matrix, so ranking the
+    relations of a concept reads a single row.
+
+    Args:
+        path (str): SQLite file of the store, created with its directory if needed
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS relation_embeddings (model TEXT NOT NULL, cui TEXT NOT NULL, '
+                         'texts TEXT NOT NULL, dim INTEGER NOT NULL, vectors BLOB NOT NULL, PRIMARY KEY (model, cui))')
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM relation_embeddings').fetchone()[0]
+
+    def get(self, model_name, cui):
+        """
+        returns (relation texts, float32 matrix with one embedding per text) of cui, None if it is not stored
+        """
+        with self._lock:
+            row = self._db.execute('SELECT texts, dim, vectors FROM relation_embeddings WHERE model = ? AND cui = ?',
+                                   (model_name, cui)).fetchone()
+        if row is None:
+            return None
+        texts, dim, vectors = row
+        return json.loads(texts), np.frombuffer(vectors, dtype=np.float32).reshape(-1, dim)
+
+    def put(self, model_name, cui, texts, vectors):
+        """
+        stores the relation texts of cui with their embeddings, a (number of texts, dim) matrix, replacing its entry
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO relation_embeddings (model, cui, texts, dim, vectors) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             (model_name, cui, json.dumps(list(texts)), vectors.shape[1], vectors.tobytes()))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile the UMLS Metathesaurus files into a local UMLSStore')
+    parser.add_argument('--meta_dir', required=True, type=str, help='directory containing MRCONSO.RRF, MRDEF.RRF and MRREL.RRF')
+    parser.add_argument('--store', default='umls_store.sqlite', type=str, help='SQLite file of the store')
+    parser.add_argument('--languages', default='ENG', type=str, help='comma-separated languages of the strings kept')
+    parser.add_argument('--no_relations', action='store_true', help='skip MRREL.RRF')
+
+    args = parser.parse_args()
+    mrdef_path = os.path.join(args.meta_dir, 'MRDEF.RRF')
+    mrrel_path = os.path.join(args.meta_dir, 'MRREL.RRF')
+    umls_store = build_umls_store(args.store, os.path.join(args.meta_dir, 'MRCONSO.RRF'),
+                                  mrdef_path if os.path.exists(mrdef_path) else None,
+                                  None if args.no_relations or not os.path.exists(mrrel_path) else mrrel_path,
+                                  languages=tuple(args.languages.split(',')))
+    print(f'{len(umls_store)} concepts written to {args.store}')
+    umls_store.close()
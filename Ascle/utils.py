@@ -2,27 +2,56 @@ from PyRuSH import RuSH
 import stanza
 import scispacy
 import spacy
+from model_registry import load_model, load_spacy, load_stanza
 
 def get_sents_pyrush(text):
     print("Segment into sentences using PyRuSH")
-    rush = RuSH('conf/rush_rules.tsv')
+    rush = load_model('pyrush', 'conf/rush_rules.tsv', lambda: RuSH('conf/rush_rules.tsv'))
     sentences = rush.segToSentenceSpans(text)
     return sentences
 
 def get_sents_stanza(text):
-    stanza.download('en')
-    nlp = stanza.Pipeline(lang='en', processors='tokenize')
+    nlp = load_stanza('en', processors='tokenize')
     sentences = [sentence.text for sentence in nlp(text).sentences]
     return sentences
 
 def get_multiple_sents_stanza(texts):
-    stanza.download('en')
-    nlp = stanza.Pipeline(lang='en', processors='tokenize')
+    nlp = load_stanza('en', processors='tokenize')
     sentences = [[sentence.text for sentence in nlp(text).sentences] for text in texts]
     return sentences
 
 def get_sents_scispacy(text):
-    nlp = spacy.load("en_core_sci_sm")
+    nlp = load_spacy("en_core_sci_sm")
     doc = nlp(text)
     sentences = [sentence.text for sentence in doc.sents]
-    return sentences
\ No newline at end of file
+    return sentences
+
+def iter_batches(items, batch_size):
+    """
+    splits any iterable into lists of at most batch_size items without materializing it
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def batch_stanza_documents(nlp, texts, batch_size=32):
+    """
+    runs a stanza pipeline over texts, batch_size documents at a time, yields one stanza Document per text
+    """
+    for batch in iter_batches(texts, batch_size):
+        yield from nlp([stanza.Document([], text=text) for text in batch])
+
+def batch_sents_stanza(texts, batch_size=32):
+    nlp = load_stanza('en', processors='tokenize')
+    for doc in batch_stanza_documents(nlp, texts, batch_size):
+        yield [sentence.text for sentence in doc.sentences]
+
+def batch_sents_scispacy(texts, batch_size=64, n_process=1):
+    nlp = load_spacy("en_core_sci_sm")
+    for doc in nlp.pipe(texts, batch_size=batch_size, n_process=n_process):
+        yield [sentence.text for sentence in doc.sents]
@@ -0,0 +1,288 @@
+import argparse
+import json
+import os
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+def top_k_indices(scores, top_k):
+    """
+    returns the indices of the top_k highest scores, best first, without sorting the whole score vector
+    """
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if top_k < len(scores):
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _as_list(value):
+    if value is None:
+        return None
+    if isinstance(value, (str, bytes)) or np.isscalar(value):
+        return [value]
+    return list(value)
+
+
+class VectorIndex:
+    """
+    Base class of the cosine similarity indexes. Every vector has an id (e.g. ROW_ID of NOTEEVENTS) and
+    optionally a SUBJECT_ID and a CATEGORY that searches can be restricted to.
+
+    Args:
+        dim (int): size of the vectors
+    """
+    backend = None
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.subject_ids = np.zeros(0, dtype=np.int64)
+        self.categories = np.zeros(0, dtype=object)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, vectors, ids, subject_ids=None, categories=None):
+        """
+        adds vectors (a (n, dim) matrix) with their ids, subject ids (-1 if unknown) and categories ('' if unknown)
+        """
+        vectors = _normalize(vectors)
+        n = len(vectors)
+        if len(ids) != n:
+            raise ValueError(f'got {n} vectors but {len(ids)} ids')
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f'expected vectors of size {self.dim}, got {vectors.shape[1]}')
+
+        subject_ids = np.full(n, -1, dtype=np.int64) if subject_ids is None else np.asarray(subject_ids, dtype=np.int64)
+        categories = np.full(n, '', dtype=object) if categories is None else np.asarray(categories, dtype=object)
+
+        self._add_vectors(vectors, len(self.ids))
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+        self.subject_ids = np.concatenate([self.subject_ids, subject_ids])
+        self.categories = np.concatenate([self.categories, categories])
+
+    def _mask(self, subject_id=None, category=None):
+        """
+        returns a boolean mask of the positions matching the filters, None if there is no filter
+        """
+        if subject_id is None and category is None:
+            return None
+        mask = np.ones(len(self.ids), dtype=bool)
+        if subject_id is not None:
+            mask &= np.isin(self.subject_ids, np.asarray(_as_list(subject_id), dtype=np.int64))
+        if category is not None:
+            mask &= np.isin(self.categories, np.asarray(_as_list(category), dtype=object))
+        return mask
+
+    def search(self, query, top_k=10, subject_id=None, category=None):
+        """
+        returns (ids, cosine similarities) of the top_k vectors most similar to query, best first;
+        subject_id and category (a value or a list of values) restrict the search to matching vectors
+        """
+        query = _normalize(query)[0]
+        positions, scores = self._search(query, top_k, self._mask(subject_id, category))
+        return self.ids[positions], scores
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'ids.npy'), self.ids)
+        np.save(os.path.join(path, 'subject_ids.npy'), self.subject_ids)
+        with open(os.path.join(path, 'categories.json'), 'w') as f:
+            json.dump([str(category) for category in self.categories], f)
+        with open(os.path.join(path, 'index.json'), 'w') as f:
+            json.dump(dict(self._config(), backend=self.backend, dim=self.dim, size=len(self)), f)
+        self._save_vectors(path)
+
+    def _load_metadata(self, path):
+        self.ids = np.load(os.path.join(path, 'ids.npy'))
+        self.subject_ids = np.load(os.path.join(path, 'subject_ids.npy'))
+        with open(os.path.join(path, 'categories.json')) as f:
+            self.categories = np.asarray(json.load(f), dtype=object)
+
+    def _config(self):
+        return {}
+
+
+class ExactIndex(VectorIndex):
+    """
+    Brute-force index: one matrix-vector product per query and an argpartition for the top_k.
+    Vectors are kept in a float32 matrix that grows by doubling; a loaded index is memory-mapped.
+    """
+    backend = 'exact'
+
+    def __init__(self, dim):
+        super().__init__(dim)
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+
+    @property
+    def vectors(self):
+        return self._vectors[:len(self.ids)]
+
+    def _add_vectors(self, vectors, start):
+        if start + len(vectors) > len(self._vectors):
+            capacity = max(start + len(vectors), 2 * len(self._vectors), 1024)
+            grown = np.zeros((capacity, self.dim), dtype=np.float32)
+            grown[:start] = self._vectors[:start]
+            self._vectors = grown
+        self._vectors[start:start + len(vectors)] = vectors
+
+    def _search(self, query, top_k, mask):
+        if mask is None:
+            scores = self.vectors @ query
+            positions = top_k_indices(scores, top_k)
+            return positions, scores[positions]
+        selected = np.flatnonzero(mask)
+        scores = self.vectors[selected] @ query
+        best = top_k_indices(scores, top_k)
+        return selected[best], scores[best]
+
+    def _save_vectors(self, path):
+        np.save(os.path.join(path, 'vectors.npy'), self.vectors)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, 'index.json')) as f:
+            config = json.load(f)
+        index = cls(config['dim'])
+        index._load_metadata(path)
+        index._vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r' if mmap else None)
+        return index
+
+
+class HNSWIndex(VectorIndex):
+    """
+    Approximate index based on hnswlib (pip install hnswlib). Filters are applied inside the graph search,
+    so filtered queries still return top_k results when enough vectors match.
+
+    Args:
+        dim (int): size of the vectors
+        max_elements (int): initial capacity, grown automatically when vectors are added
+        M (int), ef_construction (int): graph construction parameters
+        ef (int): size of the candidate list at query time, higher is more accurate and slower
+    """
+    backend = 'hnsw'
+
+    def __init__(self, dim, max_elements=10000, M=16, ef_construction=200, ef=100):
+        if hnswlib is None:
+            raise ImportError('HNSWIndex needs hnswlib, install it with `pip install hnswlib` or use ExactIndex')
+        super().__init__(dim)
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self._index = hnswlib.Index(space='cosine', dim=dim)
+        self._index.init_index(max_elements=max_elements, M=M, ef_construction=ef_construction)
+        self._index.set_ef(ef)
+
+    def _add_vectors(self, vectors, start):
+        if start + len(vectors) > self._index.get_max_elements():
+            self._index.resize_index(max(start + len(vectors), 2 * self._index.get_max_elements()))
+        self._index.add_items(vectors, np.arange(start, start + len(vectors)))
+
+    def _search(self, query, top_k, mask):
+        if mask is None:
+            top_k = min(top_k, len(self))
+            filter_function = None
+        else:
+            top_k = min(top_k, int(mask.sum()))
+            filter_function = lambda position: mask[position]
+        if top_k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        self._index.set_ef(max(self.ef, top_k))
+        positions, distances = self._index.knn_query(query, k=top_k, filter=filter_function)
+        return positions[0].astype(np.int64), 1 - distances[0]
+
+    def _save_vectors(self, path):
+        self._index.save_index(os.path.join(path, 'hnsw.bin'))
+
+    def _config(self):
+        return {'M': self.M, 'ef_construction': self.ef_construction, 'ef': self.ef}
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'index.json')) as f:
+            config = json.load(f)
+        index = cls(config['dim'], max_elements=max(config['size'], 1), M=config['M'],
+                    ef_construction=config['ef_construction'], ef=config['ef'])
+        index._load_metadata(path)
+        index._index.load_index(os.path.join(path, 'hnsw.bin'), max_elements=max(config['size'], 1))
+        index._index.set_ef(index.ef)
+        return index
+
+
+INDEX_BACKENDS = {'exact': ExactIndex, 'hnsw': HNSWIndex}
+
+
+def create_index(dim, backend='exact', **kwargs):
+    """
+    returns an empty index, backend is 'exact' or 'hnsw'
+    """
+    if backend not in INDEX_BACKENDS:
+        raise ValueError(f"unknown index backend '{backend}', choose from {list(INDEX_BACKENDS)}")
+    return INDEX_BACKENDS[backend](dim, **kwargs)
+
+
+def load_index(path):
+    """
+    loads an index saved with index.save(path), whatever its backend
+    """
+    with open(os.path.join(path, 'index.json')) as f:
+        backend = json.load(f)['backend']
+    return INDEX_BACKENDS[backend].load(path)
+
+
+def build_index(notes_file, bert_model, backend='exact', chunksize=1000, store=None, category=None):
+    """
+    encodes every note of a NOTEEVENTS csv and returns an index keyed by ROW_ID with SUBJECT_ID and CATEGORY filters
+    """
+    import pandas as pd
+    from multi_doc_functions import embed_documents
+
+    index = None
+    for chunk in pd.read_csv(notes_file, usecols=['ROW_ID', 'SUBJECT_ID', 'CATEGORY', 'TEXT'], chunksize=chunksize):
+        if category is not None:
+            chunk = chunk[chunk['CATEGORY'] == category]
+        if len(chunk) == 0:
+            continue
+        vectors = embed_documents(bert_model, chunk['TEXT'].fillna('').tolist(), store)
+        if index is None:
+            index = create_index(vectors.shape[1], backend)
+        index.add(vectors, chunk['ROW_ID'].values, chunk['SUBJECT_ID'].values, chunk['CATEGORY'].fillna('').values)
+        print(f'{len(index)} notes indexed')
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a similar-note index over NOTEEVENTS.csv')
+    parser.add_argument('--notes_file', default='NOTEEVENTS.csv', type=str, help='path to NOTEEVENTS.csv')
+    parser.add_argument('--index_dir', default='./note_index', type=str, help='directory the index is saved to')
+    parser.add_argument('--bert_model', default='microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract', type=str, help='pre-trained transformer used to encode the notes')
+    parser.add_argument('--backend', default='exact', choices=list(INDEX_BACKENDS), help='exact (brute force) or hnsw (approximate)')
+    parser.add_argument('--store', default=None, type=str, help='optional embedding store directory, cached notes are not encoded again')
+    parser.add_argument('--chunksize', default=1000, type=int, help='number of notes read and encoded at a time')
+    parser.add_argument('--category', default=None, type=str, help='only index notes of this CATEGORY')
+
+    args = parser.parse_args()
+    embedding_store = None
+    if args.store is not None:
+        from embedding_store import EmbeddingStore
+        embedding_store = EmbeddingStore(args.store)
+    note_index = build_index(args.notes_file, args.bert_model, args.backend, args.chunksize, embedding_store, args.category)
+    if note_index is not None:
+        note_index.save(args.index_dir)
+        print(f'saved {len(note_index)} notes to {args.index_dir}')
@@ -1,7 +1,7 @@
 import argparse
 import spacy
 from scispacy.abbreviation import AbbreviationDetector
-from utils.get_text_from_csv import get_df, get_notes_single_row_id
+from utils.get_text_from_csv import get_notes_single_row_id
 
 def get_abbreviations(model, text):
     print(f"Identifying abbrevations using {model}")
@@ -28,8 +28,9 @@ if __name__ == "__main__":
     output_file = args.output_file
     print(f"Data file: {mimic_dir}NOTEEVENTS.csv")
 
-    df = get_df(mimic_dir + 'NOTEEVENTS.csv')
-    text = get_notes_single_row_id(df, row_id)
+    # notes are streamed from the csv, only the requested ones are kept in memory
+    notes_file = mimic_dir + 'NOTEEVENTS.csv'
+    text = get_notes_single_row_id(notes_file, row_id)
     abbreviations  = get_abbreviations(model, text)
 
     with open(output_file, 'w') as f:
@@ -2,7 +2,7 @@ import argparse
 import spacy
 import scispacy
 from scispacy.hyponym_detector import HyponymDetector
-from utils.get_text_from_csv import get_df, get_notes_single_row_id 
+from utils.get_text_from_csv import get_notes_single_row_id 
 
 def get_hyponyms(model, text):
     print(f"Extracting hyponyms using {model}")
@@ -30,8 +30,9 @@ if __name__ == "__main__":
     output_file = args.output_file
     print(f"Data file: {mimic_dir}NOTEEVENTS.csv")
 
-    df = get_df(mimic_dir + 'NOTEEVENTS.csv')
-    text = get_notes_single_row_id(df, row_id)
+    # notes are streamed from the csv, only the requested ones are kept in memory
+    notes_file = mimic_dir + 'NOTEEVENTS.csv'
+    text = get_notes_single_row_id(notes_file, row_id)
     hyponyms = get_hyponyms(model, text)
 
     with open(output_file, 'w') as f:
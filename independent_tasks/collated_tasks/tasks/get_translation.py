@@ -1,6 +1,6 @@
 import argparse
 from transformers import MarianMTModel, MarianTokenizer
-from utils.get_text_from_csv import get_df, get_notes_single_row_id
+from utils.get_text_from_csv import get_notes_single_row_id
 
 LANG_CODE = {'Malay_written_with_Latin': '>>zlm_Latn<<', 'Mauritian_Creole': '>>mfe<<', 'Haitian': '>>hat<<', 'Papiamento': '>>pap<<', 'Asturian': '>>ast<<',
              'Catalan': '>>cat<<', 'Indonesian': '>>ind<<', 'Galician': '>>glg<<', 'Walloon': '>>wln<<', 'Spanish': '>>spa<<', 
@@ -39,8 +39,9 @@ if __name__ == "__main__":
 
     print(f"Data file: {mimic_dir}NOTEEVENTS.csv")
 
-    df = get_df(mimic_dir + 'NOTEEVENTS.csv')
-    text = get_notes_single_row_id(df, row_id) 
+    # notes are streamed from the csv, only the requested ones are kept in memory
+    notes_file = mimic_dir + 'NOTEEVENTS.csv'
+    text = get_notes_single_row_id(notes_file, row_id) 
         
     translated  = get_translation(text, model, target_language)
 
@@ -1,6 +1,6 @@
 from sklearn.cluster import KMeans
 import argparse
-from get_text_from_csv import get_df, get_notes_row_id
+from get_text_from_csv import get_notes_row_id
 from get_representations import get_bert_embeddings
 import stanza
 import pandas as pd
@@ -21,8 +21,9 @@ if __name__ == '__main__':
     row_ids = args.row_ids
     output_file = args.output_file
 
-    df = get_df(mimic_dir + 'NOTEEVENTS.csv')
-    notes = get_notes_row_id(df, row_ids)
+    # notes are streamed from the csv, only the requested ones are kept in memory
+    notes_file = mimic_dir + 'NOTEEVENTS.csv'
+    notes = get_notes_row_id(notes_file, row_ids)
     # tokenize into sentences usng stanza
     stanza.download('en')
     nlp = stanza.Pipeline(lang='en', processors='tokenize')
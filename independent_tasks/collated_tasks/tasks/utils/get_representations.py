@@ -1,9 +1,13 @@
 import argparse
-import numpy as np
-from get_text_from_csv import get_df, get_notes_row_id 
+import os
+import sys
+from get_text_from_csv import get_notes_row_id 
 from sklearn.feature_extraction.text import CountVectorizer
-from transformers import AutoTokenizer, AutoModel
-import torch
+
+# document embeddings come from the Ascle implementation (length-bucketed batches, shared model registry)
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+sys.path.append(os.path.join(ROOT_DIR, 'Ascle'))
+from transformer_functions import get_bert_embeddings
 
 def get_bag_of_words(corpus):
     vectorizer = CountVectorizer()
@@ -11,24 +15,6 @@ def get_bag_of_words(corpus):
     X = X.toarray()
     return X
 
-def get_bert_embeddings(pretrained_model, texts):
-    tokenizer = AutoTokenizer.from_pretrained(pretrained_model)
-    model = AutoModel.from_pretrained(pretrained_model, return_dict=False, output_hidden_states=True)
-    output_embeddings = []
-    for text in texts:
-        # print(len(text))
-        # get emebeddings for each sentence, compute mean to represent document
-        inputs = tokenizer(text, padding=True, truncation=True, max_length=128, return_tensors='pt')
-        with torch.no_grad():
-            model_output = model(**inputs)
-        pooled_output = model_output[1]
-        # print(pooled_output.shape) # (num_sentences, 768)
-        # print(pooled_output)
-        mean_embedding = torch.mean(pooled_output, axis=0)
-        # print(mean_embedding.shape)
-        output_embeddings.append(mean_embedding.numpy())
-    return output_embeddings
-
 if __name__ == "__main__":
     # parse command line arguments
     parser = argparse.ArgumentParser(description='Vectorize notes in MIMIC EVENTNOTES')
@@ -42,8 +28,9 @@ if __name__ == "__main__":
     output_file = args.output_file
     print(f"Data file: {mimic_dir}NOTEEVENTS.csv")
 
-    df = get_df(mimic_dir + 'NOTEEVENTS.csv')
-    docs = get_notes_row_id(df, row_ids)
+    # notes are streamed from the csv, only the requested ones are kept in memory
+    notes_file = mimic_dir + 'NOTEEVENTS.csv'
+    docs = get_notes_row_id(notes_file, row_ids)
     X = get_bag_of_words(docs)
     print(X)
     # save to file for further tasks
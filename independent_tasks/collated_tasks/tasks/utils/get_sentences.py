@@ -1,7 +1,7 @@
 import argparse
 from PyRuSH import RuSH
 import stanza
-from get_text_from_csv import get_df, get_notes_single_row_id
+from get_text_from_csv import get_notes_single_row_id
 
 def get_sents_pyrush(text):
     print("Segment into sentences using PyRuSH")
@@ -36,8 +36,9 @@ if __name__ == "__main__":
     tool = args.tool
     print(f"Data file: {mimic_dir}NOTEEVENTS.csv")
 
-    df = get_df(mimic_dir + 'NOTEEVENTS.csv')
-    text = get_notes_single_row_id(df, row_id)
+    # notes are streamed from the csv, only the requested ones are kept in memory
+    notes_file = mimic_dir + 'NOTEEVENTS.csv'
+    text = get_notes_single_row_id(notes_file, row_id)
     
     if tool == 'pyrush':
         sents = get_sents_pyrush(text)
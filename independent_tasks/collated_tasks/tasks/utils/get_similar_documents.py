@@ -1,7 +1,7 @@
 import argparse
 import numpy as np
 import pandas as pd
-from get_text_from_csv import get_df, get_notes_row_id, get_notes_single_row_id
+from get_text_from_csv import read_notes, get_notes_row_id, get_notes_single_row_id
 from get_representations import get_bert_embeddings
 from get_sentences import get_sents_stanza, get_multiple_sents_stanza
 from sklearn.metrics.pairwise import cosine_similarity
@@ -23,11 +23,14 @@ if __name__ == '__main__':
     candidates = args.candidates
     output_file = args.output_file
 
-    df = get_df(mimic_dir + 'NOTEEVENTS.csv')
+    # stream NOTEEVENTS.csv once, keeping only the query and candidate notes
+    df = read_notes(mimic_dir + 'NOTEEVENTS.csv', columns=['ROW_ID', 'TEXT'], row_ids=[doc_id] + list(candidates))
     query_note = get_notes_single_row_id(df, doc_id)
     candidate_notes = get_notes_row_id(df, candidates)
-    candidate_vectors = np.array(get_bert_embeddings(representation, get_multiple_sents_stanza(candidate_notes)))
-    query_vector = get_bert_embeddings(representation, [get_sents_stanza(query_note)])
+    # encode query and candidates in one pass, row 0 is the query
+    vectors = get_bert_embeddings(representation, get_multiple_sents_stanza([query_note] + list(candidate_notes)))
+    query_vector = vectors[:1]
+    candidate_vectors = vectors[1:]
     # print(query_vector)
     # print(candidate_vectors)
     # compute cosine similarity
@@ -1,30 +1,224 @@
+import argparse
+import json
+import os
+import shutil
 import pandas as pd
 import numpy as np
 
+NOTEEVENTS_DTYPES = {'ROW_ID':np.int32, 'SUBJECT_ID': np.int32,'HADM_ID': np.float64,
+                     'CHARTDATE':str,'STORETIME':str,'CHARTTIME':str,
+                     'CATEGORY': str,'DESCRIPTION':str,'CGID':str,'ISERROR':str,
+                     'TEXT':str}
+
 def get_df(file_dir):
     """Read NOTEEVENTS.csv and return a dataframe."""
     print("Reading csv file...")
-    df = pd.read_csv(file_dir, dtype={'ROW_ID':np.int32, 'SUBJECT_ID': np.int32,'HADM_ID': np.float64,
-                                        'CHARTDATE':str,'STORETIME':str,'CHARTTIME':str,
-                                        'STORETIME': str,'CATEGORY': str,'DESCRIPTION':str,'CGID':str,'ISERROR':str,
-                                            'TEXT':str}, parse_dates=['CHARTDATE'])
+    df = pd.read_csv(file_dir, dtype=NOTEEVENTS_DTYPES, parse_dates=['CHARTDATE'])
     print("Reading csv file complete!")
     return df
 
+def iter_notes(file_dir, columns=None, row_ids=None, subject_ids=None, categories=None, chunksize=10000):
+    """
+    Stream NOTEEVENTS.csv in chunks of at most chunksize rows, yielding dataframes.
+    Only the given columns (default: all) are parsed, and rows are filtered by ROW_ID, SUBJECT_ID and
+    CATEGORY while reading, so memory is bounded by the chunk size instead of the file size.
+    Reading stops early once every requested ROW_ID has been found.
+    """
+    filters = {'ROW_ID': row_ids, 'SUBJECT_ID': subject_ids, 'CATEGORY': categories}
+    filters = {column: set(values) for column, values in filters.items() if values is not None}
+    usecols = None
+    if columns is not None:
+        usecols = list(dict.fromkeys(list(columns) + list(filters)))
+    dtype = {column: t for column, t in NOTEEVENTS_DTYPES.items() if usecols is None or column in usecols}
+    parse_dates = ['CHARTDATE'] if usecols is None or 'CHARTDATE' in usecols else False
+
+    remaining = set(filters['ROW_ID']) if 'ROW_ID' in filters else None
+    for chunk in pd.read_csv(file_dir, usecols=usecols, dtype=dtype, parse_dates=parse_dates, chunksize=chunksize):
+        mask = np.ones(len(chunk), dtype=bool)
+        for column, values in filters.items():
+            mask &= chunk[column].isin(values).values
+        if mask.any():
+            selected = chunk[mask]
+            yield selected if columns is None else selected[list(columns)]
+            if remaining is not None:
+                remaining.difference_update(selected['ROW_ID'].tolist())
+        if remaining is not None and not remaining:
+            break
+
+def read_notes(file_dir, columns=None, row_ids=None, subject_ids=None, categories=None, chunksize=10000):
+    """
+    Stream NOTEEVENTS.csv and return a single dataframe with the selected columns of the matching notes;
+    ROW_ID and SUBJECT_ID lookups use the note store built next to the csv (see build_note_store) if there is one
+    """
+    notes = _open_notes(file_dir)
+    if isinstance(notes, NoteStore) and (row_ids is not None or subject_ids is not None):
+        positions = notes.lookup('ROW_ID', list(row_ids)) if row_ids is not None else None
+        if subject_ids is not None:
+            matches = notes.lookup('SUBJECT_ID', list(subject_ids))
+            positions = matches if positions is None else np.intersect1d(positions, matches)
+        if categories is not None:
+            codes = [code for code, category in enumerate(notes.categories) if category in set(categories)]
+            positions = positions[np.isin(notes.columns['CATEGORY'][positions], codes)]
+        return notes.get_frame(positions, columns if columns is not None else NoteStore.FRAME_COLUMNS)
+    chunks = list(iter_notes(file_dir, columns, row_ids, subject_ids, categories, chunksize))
+    if not chunks:
+        names = list(columns) if columns is not None else list(NOTEEVENTS_DTYPES)
+        return pd.DataFrame(columns=names)
+    return pd.concat(chunks, ignore_index=True)
+
+NOTE_STORE_COLUMNS = ['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'CHARTDATE']
+
+def default_store_path(file_dir):
+    """Directory of the columnar note store built next to a NOTEEVENTS.csv file"""
+    return os.path.splitext(file_dir)[0] + '_store'
+
+class NoteStore:
+    """
+    Columnar, memory-mapped copy of NOTEEVENTS built once with build_note_store.
+    TEXT is kept as one utf-8 blob (text.bin) with an offset array; ROW_ID, SUBJECT_ID, HADM_ID and CHARTDATE
+    are numpy arrays with a sorted index each, so lookups are binary searches plus random reads of the matching notes.
+    """
+    FRAME_COLUMNS = ('ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'CHARTDATE', 'CATEGORY', 'TEXT')
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.text = np.memmap(os.path.join(path, 'text.bin'), dtype=np.uint8, mode='r') if self.offsets[-1] else b''
+        with open(os.path.join(path, 'categories.json')) as f:
+            self.categories = json.load(f)
+        self.columns = {column: np.load(os.path.join(path, column + '.npy'), mmap_mode='r')
+                        for column in NOTE_STORE_COLUMNS + ['CATEGORY']}
+        self.indexes = {column: (np.load(os.path.join(path, column + '_order.npy'), mmap_mode='r'),
+                                 np.load(os.path.join(path, column + '_sorted.npy'), mmap_mode='r'))
+                        for column in NOTE_STORE_COLUMNS}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_text(self, position):
+        return bytes(self.text[self.offsets[position]:self.offsets[position + 1]]).decode('utf-8')
+
+    def lookup(self, column, values):
+        """positions (in file order) of the notes whose column is one of values"""
+        order, sorted_values = self.indexes[column]
+        values = np.asarray(values, dtype=sorted_values.dtype)
+        starts = np.searchsorted(sorted_values, values, side='left')
+        ends = np.searchsorted(sorted_values, values, side='right')
+        positions = [order[start:end] for start, end in zip(starts, ends) if end > start]
+        if not positions:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(positions))
+
+    def lookup_range(self, column, start, end):
+        """positions (in file order) of the notes with start <= column < end, e.g. a CHARTDATE range"""
+        order, sorted_values = self.indexes[column]
+        start, end = np.searchsorted(sorted_values, np.asarray([start, end], dtype=sorted_values.dtype))
+        return np.sort(order[start:end])
+
+    def get_frame(self, positions, columns=FRAME_COLUMNS):
+        """dataframe with the given columns of the notes at positions"""
+        positions = np.asarray(positions, dtype=np.int64)
+        data = {}
+        for column in columns:
+            if column == 'TEXT':
+                data[column] = [self.get_text(position) for position in positions]
+            elif column == 'CATEGORY':
+                data[column] = [self.categories[code] for code in self.columns['CATEGORY'][positions]]
+            else:
+                data[column] = np.asarray(self.columns[column][positions])
+        return pd.DataFrame(data, columns=list(columns))
+
+def build_note_store(file_dir, store_dir=None, chunksize=10000):
+    """One-time conversion of NOTEEVENTS.csv into a NoteStore directory, returns the opened store"""
+    store_dir = store_dir or default_store_path(file_dir)
+    # built in a temporary directory and renamed at the end, so a partial store is never picked up
+    final_dir, store_dir = store_dir, store_dir.rstrip(os.sep) + '.tmp'
+    # what an interrupted build left behind is thrown away
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.makedirs(store_dir)
+    offsets = [0]
+    columns = {column: [] for column in NOTE_STORE_COLUMNS + ['CATEGORY']}
+    categories = {}
+    with open(os.path.join(store_dir, 'text.bin'), 'wb') as text_file:
+        for chunk in iter_notes(file_dir, columns=NOTE_STORE_COLUMNS + ['CATEGORY', 'TEXT'], chunksize=chunksize):
+            for text in chunk['TEXT'].fillna(''):
+                encoded = text.encode('utf-8')
+                text_file.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+            columns['ROW_ID'].append(chunk['ROW_ID'].values.astype(np.int32))
+            columns['SUBJECT_ID'].append(chunk['SUBJECT_ID'].values.astype(np.int32))
+            columns['HADM_ID'].append(chunk['HADM_ID'].values.astype(np.float64))
+            columns['CHARTDATE'].append(pd.to_datetime(chunk['CHARTDATE']).values.astype('datetime64[D]'))
+            columns['CATEGORY'].append(np.array([categories.setdefault(category, len(categories))
+                                                 for category in chunk['CATEGORY'].fillna('')], dtype=np.int16))
+            print(f"{len(offsets) - 1} notes converted")
+
+    np.save(os.path.join(store_dir, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(store_dir, 'categories.json'), 'w') as f:
+        json.dump(sorted(categories, key=categories.get), f)
+    empty = {'ROW_ID': np.int32, 'SUBJECT_ID': np.int32, 'HADM_ID': np.float64, 'CHARTDATE': 'datetime64[D]', 'CATEGORY': np.int16}
+    for column, arrays in columns.items():
+        values = np.concatenate(arrays) if arrays else np.zeros(0, dtype=empty[column])
+        np.save(os.path.join(store_dir, column + '.npy'), values)
+        if column in NOTE_STORE_COLUMNS:
+            order = np.argsort(values, kind='stable')
+            np.save(os.path.join(store_dir, column + '_order.npy'), order)
+            np.save(os.path.join(store_dir, column + '_sorted.npy'), values[order])
+    # a rebuilt store replaces the old one, which is moved aside first since rename does not overwrite directories
+    old_dir = final_dir.rstrip(os.sep) + '.old'
+    if os.path.exists(final_dir):
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.rename(final_dir, old_dir)
+    os.rename(store_dir, final_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return NoteStore(final_dir)
+
+def _open_notes(df):
+    """
+    df can be a dataframe, a NoteStore, a NoteStore directory or the path to NOTEEVENTS.csv;
+    a csv path uses the note store built next to it if there is one, otherwise the csv is streamed
+    """
+    if isinstance(df, str):
+        if os.path.isdir(df):
+            return NoteStore(df)
+        if os.path.isdir(default_store_path(df)):
+            return NoteStore(default_store_path(df))
+    return df
+
 def get_notes_single_row_id(df, row_id):
-    """Select and return a single note"""
+    """Select and return a single note, df is a dataframe, a NoteStore or a path (see _open_notes)"""
+    df = _open_notes(df)
+    if isinstance(df, NoteStore):
+        return df.get_text(df.lookup('ROW_ID', [row_id])[0])
+    if isinstance(df, str):
+        df = read_notes(df, columns=['ROW_ID', 'TEXT'], row_ids=[row_id])
     return str(df.loc[df['ROW_ID']==row_id]['TEXT'].iloc[0])
 
 def get_notes_row_id(df, row_ids):
-    """Select and return a list of notes for given row_ids"""
+    """Select and return a list of notes for given row_ids, df is a dataframe, a NoteStore or a path (see _open_notes)"""
+    df = _open_notes(df)
+    if isinstance(df, NoteStore):
+        return [df.get_text(position) for position in df.lookup('ROW_ID', row_ids)]
+    if isinstance(df, str):
+        df = read_notes(df, columns=['ROW_ID', 'TEXT'], row_ids=row_ids)
     return df[df['ROW_ID'].isin(row_ids)]['TEXT'].tolist()
 
 def get_notes_subject_id(df, subject_ids):
-    """Select and return a list of notes for given subject_ids"""
+    """Select and return a list of notes for given subject_ids, df is a dataframe, a NoteStore or a path (see _open_notes)"""
+    df = _open_notes(df)
+    if isinstance(df, NoteStore):
+        return [df.get_text(position) for position in df.lookup('SUBJECT_ID', subject_ids)]
+    if isinstance(df, str):
+        df = read_notes(df, columns=['SUBJECT_ID', 'TEXT'], subject_ids=subject_ids)
     return df[df['SUBJECT_ID'].isin(subject_ids)]['TEXT'].tolist()
 
-#if __name__ == '__main__':
-#    df = get_df('../../../EHRKit_org/tutorials/data/mimic_data/NOTEEVENTS.csv')
-#    #notes = get_notes_row_id('../../../EHRKit_org/tutorials/data/mimic_data/NOTEEVENTS.csv', [174, 178])   
-#    notes = get_notes_subject_id(df, [22532])
-#    print(notes)
+if __name__ == '__main__':
+    # one-time conversion of NOTEEVENTS.csv into a columnar note store, used by get_notes_* afterwards
+    parser = argparse.ArgumentParser(description='Convert NOTEEVENTS.csv into a columnar note store')
+    parser.add_argument('--mimic_dir', default='../../../tutorials/data/mimic_data/', type=str, help='directory to mimic data')
+    parser.add_argument('--store_dir', default=None, type=str, help='directory of the note store, default to NOTEEVENTS_store in mimic_dir')
+    parser.add_argument('--chunksize', default=10000, type=int, help='number of csv rows read at a time')
+
+    args = parser.parse_args()
+    note_store = build_note_store(args.mimic_dir + 'NOTEEVENTS.csv', args.store_dir, args.chunksize)
+    print(f"{len(note_store)} notes written to {note_store.path}")
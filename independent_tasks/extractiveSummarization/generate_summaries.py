@@ -1,6 +1,8 @@
 import sys, os
+import csv
 import glob
 import itertools
+import multiprocessing
 import shutil
 import time
 from pathlib import Path
@@ -10,82 +12,164 @@ from summarizers import Lexrank
 import argparse
 parser = argparse.ArgumentParser()
 
-parser.add_argument('--train', action='store', metavar='path', type=str, required=True,  help='Directory path containing training documents. If test path not specified, also treated as testing documents.')
+parser.add_argument('--train', action='store', metavar='path', type=str, help='Directory path containing training documents. If test path not specified, also treated as testing documents.')
 parser.add_argument('--saveto', action='store', metavar='path', type=str, required=True, help='directory path for saving summaries produced')
 parser.add_argument('--test', action='store', metavar='path', type=str, help='directory path containing testing documents')
 parser.add_argument('--ntrain', action='store', type=int, metavar='n', help='First n number of documents to train on')
 parser.add_argument('--ntest', action='store', type=int, metavar='n', help='First n number of documents to produce summaries for')
 parser.add_argument('--threshold', action='store', type=float, help="default 0.03")
 parser.add_argument('--size', action='store', type=int, help='summary size. default 1')
+parser.add_argument('--saveidf', action='store', metavar='path', type=str, help='file path (.npz) for saving the idf scores computed on the training documents')
+parser.add_argument('--loadidf', action='store', metavar='path', type=str, help='file path (.npz) of idf scores saved with --saveidf, used instead of training')
+parser.add_argument('--workers', action='store', type=int, metavar='n', help='number of worker processes producing summaries. default 1')
+parser.add_argument('--timings', action='store', metavar='path', type=str, help='csv file path for per-document timings')
+parser.add_argument('--overwrite', action='store_true', help='summarize documents whose .sum file already exists instead of skipping them')
 
-args = parser.parse_args()
+# Lexrank shared (read-only) by the worker processes, set before the pool is created so forked workers inherit it
+lxr = None
 
-train_dir_path = args.train
-test_dir_path = args.test
-saveto_dir_path = args.saveto
-threshold = args.threshold or 0.03
-summary_size = args.size or 1
 
-if not os.path.isdir(train_dir_path):
-    print('The train path specified does not exist')
-    sys.exit()
-
-if test_dir_path and not os.path.isdir(test_dir_path):
-    print('The test path specified does not exist')
-    sys.exit()
-
-if not os.path.isdir(saveto_dir_path):
-    print('The save to path specified does not exist')
-    sys.exit()
-
-if args.ntest and args.ntest < 1:
-    print('ntest should be greater than 0')
-
-if args.ntrain and args.ntrain < 1:
-    print('ntrain should be greater than 0')
-
-start = time.time()
-
-train_documents = {}
-test_documents = {}
-
-for i, filepath in enumerate(glob.glob(os.path.join(train_dir_path, '*'))):
+def read_sentences(filepath):
     with open(filepath) as fp:
-        fname = Path(filepath).stem
-        sentences = [] 
+        sentences = []
         for line in fp.readlines():
             sentences.extend(sent_tokenize(line))
-        train_documents[fname] = sentences
-        if args.ntrain and i == args.ntrain - 1:
-            break
-
-if test_dir_path:
-    for i, filepath in enumerate(glob.glob(os.path.join(test_dir_path, '*'))):
-        with open(filepath) as fp:
-            fname = Path(filepath).stem
-            sentences = [] 
-            for line in fp.readlines():
-                sentences.extend(sent_tokenize(line))
-            test_documents[fname] = sentences
-        if args.ntest and i == args.ntest - 1:
-            break
-
-lxr = Lexrank(train_documents.values(), threshold=threshold)
-
-if test_dir_path:
-    documents = test_documents
-else:
-    documents = train_documents
-
-for i, fname in enumerate(documents):
-    summary = lxr.get_summary(documents[fname], summary_size=summary_size)#, threshold=.1)
-    joined_summary = " ".join(summary)
-    summary_path = os.path.join(saveto_dir_path, fname + ".sum")
-    with open(summary_path, 'w') as sum:
+    return sentences
+
+
+def _init_worker(idf_path, threshold):
+    # only used when workers cannot be forked: every worker loads the saved idf scores once
+    global lxr
+    lxr = Lexrank.from_idf(idf_path, threshold=threshold)
+
+
+def summarize_file(task):
+    """
+    summarizes one document and writes it atomically (temporary file + rename), so an interrupted run never
+    leaves a partial .sum behind; returns (file name, number of sentences, seconds)
+    """
+    filepath, summary_path, summary_size = task
+    start = time.time()
+    sentences = read_sentences(filepath)
+    joined_summary = ""
+    if sentences:
+        summary = lxr.get_summary(sentences, summary_size=summary_size)#, threshold=.1)
+        joined_summary = " ".join(summary)
+    tmp_path = summary_path + ".tmp%d" % os.getpid()
+    with open(tmp_path, 'w') as sum:
         sum.write(joined_summary)
-    if args.ntest and i == args.ntest - 1:
-        break
-
-end = time.time()
-#print("----Summary----")
-print("Runtime " + str(end - start))
+    os.replace(tmp_path, summary_path)
+    return Path(filepath).stem, len(sentences), time.time() - start
+
+
+def run(tasks, workers, timings_path=None, idf_path=None, threshold=0.03):
+    """
+    summarizes the (filepath, summary_path, summary_size) tasks with a pool of workers, writing timings as they finish
+    """
+    timings_file = open(timings_path, 'w', newline='') if timings_path else None
+    writer = csv.writer(timings_file) if timings_file else None
+    if writer:
+        writer.writerow(['document', 'sentences', 'seconds'])
+
+    if workers > 1:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            pool = multiprocessing.get_context('fork').Pool(workers)
+        else:
+            pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(idf_path, threshold))
+        results = pool.imap_unordered(summarize_file, tasks, chunksize=16)
+    else:
+        pool = None
+        results = map(summarize_file, tasks)
+
+    try:
+        for i, (fname, n_sentences, seconds) in enumerate(results):
+            if writer:
+                writer.writerow([fname, n_sentences, '%.4f' % seconds])
+            if (i + 1) % 1000 == 0:
+                print("%d summaries written" % (i + 1))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if timings_file:
+            timings_file.close()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    train_dir_path = args.train
+    test_dir_path = args.test
+    saveto_dir_path = args.saveto
+    threshold = args.threshold or 0.03
+    summary_size = args.size or 1
+    workers = args.workers or 1
+
+    if not train_dir_path and not args.loadidf:
+        print('Either a train path or an idf file (--loadidf) should be specified')
+        sys.exit()
+
+    if train_dir_path and not os.path.isdir(train_dir_path):
+        print('The train path specified does not exist')
+        sys.exit()
+
+    if args.loadidf and not os.path.isfile(args.loadidf):
+        print('The idf file specified does not exist')
+        sys.exit()
+
+    if args.loadidf and not test_dir_path:
+        print('A test path should be specified when loading idf scores')
+        sys.exit()
+
+    if test_dir_path and not os.path.isdir(test_dir_path):
+        print('The test path specified does not exist')
+        sys.exit()
+
+    if not os.path.isdir(saveto_dir_path):
+        print('The save to path specified does not exist')
+        sys.exit()
+
+    if args.ntest and args.ntest < 1:
+        print('ntest should be greater than 0')
+
+    if args.ntrain and args.ntrain < 1:
+        print('ntrain should be greater than 0')
+
+    start = time.time()
+
+    train_paths = []
+    if train_dir_path:
+        train_paths = list(itertools.islice(glob.glob(os.path.join(train_dir_path, '*')), args.ntrain))
+
+    if args.loadidf:
+        lxr = Lexrank.from_idf(args.loadidf, threshold=threshold)
+    else:
+        lxr = Lexrank((read_sentences(filepath) for filepath in train_paths), threshold=threshold)
+
+    idf_path = args.saveidf or args.loadidf
+    if workers > 1 and not idf_path and 'fork' not in multiprocessing.get_all_start_methods():
+        # workers that are not forked load the idf scores from a file
+        idf_path = os.path.join(saveto_dir_path, 'lexrank_idf.npz')
+    if args.saveidf or (idf_path and not args.loadidf):
+        lxr.save_idf(idf_path)
+
+    if test_dir_path:
+        paths = glob.glob(os.path.join(test_dir_path, '*'))
+    else:
+        paths = train_paths
+    paths = paths[:args.ntest] if args.ntest else paths
+
+    tasks = []
+    for filepath in paths:
+        summary_path = os.path.join(saveto_dir_path, Path(filepath).stem + ".sum")
+        # resume: documents summarized by an earlier run are skipped
+        if not args.overwrite and os.path.exists(summary_path):
+            continue
+        tasks.append((filepath, summary_path, summary_size))
+    print("%d documents to summarize, %d already summarized" % (len(tasks), len(paths) - len(tasks)))
+
+    run(tasks, workers, args.timings, idf_path, threshold)
+
+    end = time.time()
+    #print("----Summary----")
+    print("Runtime " + str(end - start))
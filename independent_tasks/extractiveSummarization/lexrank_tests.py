@@ -0,0 +1,144 @@
+import unittest
+import math
+from collections import Counter
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+from summarizers import lexrank
+from summarizers.lexrank import Lexrank, degree_centrality_scores
+
+# LexRank scores of the sparse implementation are compared to the original dense one with this tolerance;
+# the original power method stopped at np.allclose's default tolerance, so it is not more precise than that
+TOLERANCE = 1e-5
+
+STOP_WORDS = {'the', 'a', 'an', 'of', 'and', 'to', 'in', 'was', 'with', 'for', 'on', 'is', 'at'}
+
+DOCUMENTS = [
+    ['The patient was admitted with chest pain and shortness of breath.',
+     'An ECG showed ST elevation in the anterior leads.',
+     'He was taken to the cath lab for primary PCI.'],
+    ['The patient presented with fever, cough and shortness of breath.',
+     'Chest x-ray showed a right lower lobe pneumonia.',
+     'She was started on ceftriaxone and azithromycin.'],
+    ['Patient admitted for diabetic ketoacidosis.',
+     'Insulin drip was started and the anion gap closed.',
+     'She was transitioned to subcutaneous insulin.'],
+    ['History of atrial fibrillation on warfarin.',
+     'INR was supratherapeutic on admission.',
+     'Warfarin was held and the INR trended down.'],
+]
+
+SENTENCES = [
+    'The patient was admitted with chest pain.',
+    'Chest pain resolved after nitroglycerin.',
+    'An ECG showed ST elevation in the anterior leads.',
+    'Troponin peaked at 12 and the ECG changes resolved.',
+    'The patient was taken to the cath lab for PCI of the LAD.',
+    'A drug eluting stent was placed in the LAD.',
+    'Shortness of breath improved with diuresis.',
+    'Chest x-ray showed mild pulmonary edema.',
+    'Furosemide was given for pulmonary edema.',
+    'Aspirin, clopidogrel and atorvastatin were started.',
+    'The patient was discharged home in stable condition.',
+    'Follow up with cardiology in two weeks.',
+    'INR was checked on admission.',
+    'Warfarin was held.',
+]
+
+
+def dense_sim_matrix(lxr, tf_scores):
+    """similarity matrix of the original implementation, one idf-modified cosine per pair of sentences"""
+    length = len(tf_scores)
+    matrix = np.zeros([length] * 2)
+    for i in range(length):
+        for j in range(i, length):
+            if i == j:
+                similarity = 1
+            else:
+                tf_i, tf_j = tf_scores[i], tf_scores[j]
+                nominator = sum(tf_i[word] * tf_j[word] * lxr.idf_score[word] ** 2 for word in set(tf_i) & set(tf_j))
+                if math.isclose(nominator, 0):
+                    continue
+                denominator_i = sum((tf_i[word] * lxr.idf_score[word]) ** 2 for word in tf_i)
+                denominator_j = sum((tf_j[word] * lxr.idf_score[word]) ** 2 for word in tf_j)
+                similarity = nominator / math.sqrt(denominator_i * denominator_j)
+            matrix[i, j] = similarity
+            matrix[j, i] = similarity
+    return matrix
+
+
+def dense_scores(sim_matrix, threshold):
+    """degree_centrality_scores of the original implementation (dense matrices, squared transition matrix)"""
+    if threshold is None:
+        weights = sim_matrix
+    else:
+        weights = (sim_matrix >= threshold).astype(np.float64)
+    markov = weights / weights.sum(axis=1, keepdims=True)
+
+    distribution = np.zeros(len(markov))
+    _, labels = connected_components(markov)
+    for tag in np.unique(labels):
+        group = np.where(labels == tag)[0]
+        transition = markov[group][:, group].transpose()
+        eigenvector = np.ones(len(group))
+        if len(group) > 1:
+            while True:
+                eigenvector_next = np.dot(transition, eigenvector)
+                if np.allclose(eigenvector_next, eigenvector):
+                    eigenvector = eigenvector_next
+                    break
+                eigenvector = eigenvector_next
+                transition = np.dot(transition, transition)
+        distribution[group] = eigenvector
+    return distribution
+
+
+@unittest.skipIf(lexrank.word_tokenize is None, "Lexrank tokenizes with nltk, which is not installed")
+class tests(unittest.TestCase):
+    def setUp(self):
+        self.lxr = Lexrank(DOCUMENTS, stop_words=STOP_WORDS, threshold=.1)
+        self.tf_scores = [Counter(self.lxr.tokenize_into_words(sentence)) for sentence in SENTENCES]
+
+    def test_sim_matrix(self):
+        sparse = self.lxr._calc_sim_matrix(self.tf_scores).toarray()
+        dense = dense_sim_matrix(self.lxr, self.tf_scores)
+        np.testing.assert_allclose(sparse, dense, rtol=0, atol=1e-12)
+
+    def test_scores(self):
+        dense = dense_sim_matrix(self.lxr, self.tf_scores)
+        for threshold in [None, 0.0, 0.03, 0.1, 0.3]:
+            self.lxr.threshold = threshold
+            scores = self.lxr.rank_sentences(SENTENCES)
+            np.testing.assert_allclose(scores, dense_scores(dense, threshold), rtol=0, atol=TOLERANCE,
+                                       err_msg='threshold %s' % threshold)
+
+    def test_summary(self):
+        # without threshold the scores have no ties, so the order of the summary is well defined
+        self.lxr.threshold = None
+        dense = dense_scores(dense_sim_matrix(self.lxr, self.tf_scores), None)
+        expected = [SENTENCES[i] for i in np.argsort(dense)[::-1][:3]]
+        self.assertEqual(self.lxr.get_summary(SENTENCES, summary_size=3), expected)
+
+    def test_eigs_fallback(self):
+        sim_matrix = self.lxr._calc_sim_matrix(self.tf_scores)
+        dense = dense_scores(dense_sim_matrix(self.lxr, self.tf_scores), None)
+        # one power iteration is not enough, so every component of more than one sentence goes through eigs
+        scores, info = degree_centrality_scores(sim_matrix, threshold=None, max_iter=1, return_info=True)
+        self.assertGreater(info['eigs_fallbacks'], 0)
+        self.assertTrue(info['converged'])
+        np.testing.assert_allclose(scores, dense, rtol=0, atol=TOLERANCE)
+
+
+class scores_tests(unittest.TestCase):
+    def test_zero_threshold(self):
+        # every pair passes a threshold of 0: the scores are all ones, without a dense n x n transition matrix
+        n = 100000
+        scores, info = degree_centrality_scores(sp.identity(n, format='csr'), threshold=0.0, return_info=True)
+        np.testing.assert_array_equal(scores, np.ones(n))
+        self.assertEqual(info['components'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
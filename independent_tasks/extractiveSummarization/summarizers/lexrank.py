@@ -28,24 +28,76 @@ import math
 import numpy as np  
 import pandas as pd 
 import re   
+import scipy.sparse as sp
 
 from collections import Counter, defaultdict
 from scipy.sparse.csgraph import connected_components
-from nltk.tokenize import word_tokenize, sent_tokenize
-from nltk.corpus import stopwords
+from scipy.sparse.linalg import eigs
+try:
+    from nltk.tokenize import word_tokenize, sent_tokenize
+    from nltk.corpus import stopwords
+except ImportError:
+    # the scoring functions below work without nltk, only Lexrank tokenizes sentences with it
+    word_tokenize = sent_tokenize = stopwords = None
+
+# stopping criteria of the power method used for the stationary distribution
+POWER_METHOD_TOL = 1e-8
+POWER_METHOD_MAX_ITER = 1000
 
 PUNCTUATION_SIGNS = set('.,;:¡!¿?…⋯&‹›«»\"“”[]()⟨⟩}{/|\\')
 
 
 class Lexrank:
     def __init__(self, documents, stop_words=None, threshold=.03, include_new_words=True):
+        self._setup(stop_words, threshold, include_new_words)
+        self.idf_score = self._calc_idf(documents)
+
+    def _setup(self, stop_words, threshold, include_new_words):
+        if word_tokenize is None:
+            raise ImportError("Lexrank needs nltk, install it with `pip install nltk`")
         if not stop_words:
             self.stopwords = set(stopwords.words('english'))
         else:
             self.stopwords = stop_words
         self.threshold = threshold
         self.include_new_words = include_new_words
-        self.idf_score = self._calc_idf(documents)
+
+    @classmethod
+    def from_idf(cls, path, stop_words=None, threshold=.03, include_new_words=None):
+        """
+        creates a Lexrank from idf scores saved with save_idf, without going through the training documents again;
+        include_new_words defaults to the value the idf scores were trained with
+        """
+        with np.load(path, allow_pickle=False) as data:
+            idf = data['idf']
+            vocabulary = data['vocabulary'].tobytes().decode('utf-8').split('\n') if len(idf) else []
+            if include_new_words is None:
+                include_new_words = bool(data['include_new_words'])
+
+        lxr = cls.__new__(cls)
+        lxr._setup(stop_words, threshold, include_new_words)
+        lxr.idf_score = lxr._idf_dict(zip(vocabulary, idf.tolist()))
+        return lxr
+
+    def save_idf(self, path):
+        """
+        saves the idf scores as a vocabulary (newline separated utf-8 words) and a float32 array of scores (numpy .npz)
+        """
+        vocabulary = np.frombuffer('\n'.join(self.idf_score.keys()).encode('utf-8'), dtype=np.uint8)
+        idf = np.fromiter(self.idf_score.values(), dtype=np.float32, count=len(self.idf_score))
+        with open(path, 'wb') as f:
+            np.savez(f, vocabulary=vocabulary, idf=idf, include_new_words=self.include_new_words)
+
+    def _idf_dict(self, scores):
+        if self.include_new_words:
+            default_value = 1
+
+        else:
+            default_value = 0
+
+        idf_score = defaultdict(lambda: default_value)
+        idf_score.update(scores)
+        return idf_score
         
     def get_summary(self, sentences, summary_size=1):
         if not isinstance(summary_size, int) or summary_size < 1:
@@ -57,15 +109,14 @@ class Lexrank:
 
         return summary
 
-    def rank_sentences(self, sentences):
+    def rank_sentences(self, sentences, return_info=False):
         tf_scores = [
             Counter(self.tokenize_into_words(sentence)) for sentence in sentences
         ]
 
         sim_matrix = self._calc_sim_matrix(tf_scores)
 
-        scores = degree_centrality_scores(sim_matrix, threshold=self.threshold)
-        return scores
+        return degree_centrality_scores(sim_matrix, threshold=self.threshold, return_info=return_info)
 
     def tokenize_into_words(self, sentence):
         tokens = word_tokenize(str(sentence).lower())
@@ -75,7 +126,9 @@ class Lexrank:
 
     def _calc_idf(self, documents):
         #print("calculating idf")
-        bags_of_words = []
+        # number of documents each word appears in, counted in a single pass over the documents
+        doc_frequency = Counter()
+        doc_number_total = 0
 
         for i, doc in enumerate(documents):
             doc_words = set()
@@ -85,135 +138,158 @@ class Lexrank:
                 doc_words.update(words)
 
             if doc_words:
-                bags_of_words.append(doc_words)
+                doc_frequency.update(doc_words)
+                doc_number_total += 1
 
-        if not bags_of_words:
+        if not doc_number_total:
             raise ValueError('bag of words is empty')
 
-        doc_number_total = len(bags_of_words)
         print("total docs processed %d" %doc_number_total)
 
-        if self.include_new_words:
-            default_value = 1
-
-        else:
-            default_value = 0
-
-        idf_score = defaultdict(lambda: default_value)
-
-        for word in set.union(*bags_of_words):
-            doc_number_word = sum(1 for bag in bags_of_words if word in bag)
-            idf_score[word] = math.log(doc_number_total / doc_number_word)
+        idf_score = self._idf_dict(
+            (word, math.log(doc_number_total / doc_number_word)) for word, doc_number_word in doc_frequency.items()
+        )
         #print("idf scores done")
         return idf_score
 
     def _calc_sim_matrix(self, tf_scores):
+        """
+        idf-modified cosine similarity of every pair of sentences as a sparse matrix:
+        sim(i, j) = sum_w tf_i(w) tf_j(w) idf(w)^2 / (|tf_i * idf| |tf_j * idf|), computed as one sparse
+        product of the row-normalized tf-idf matrix with its transpose; the diagonal is always 1
+        """
         length = len(tf_scores)
 
-        matrix = np.zeros([length] * 2)
-
-        for i in range(length):
-            for j in range(i, length):
-                similarity = self._idf_modified_cosine(tf_scores, i, j)
-
-                if similarity:
-                    matrix[i, j] = similarity
-                    matrix[j, i] = similarity
-
-        return matrix
-
-    def _idf_modified_cosine(self, tf_scores, i, j):
-        if i == j:
-            return 1
-
-        tf_i, tf_j = tf_scores[i], tf_scores[j]
-        words_i, words_j = set(tf_i.keys()), set(tf_j.keys())
-
-        nominator = 0
-
-        for word in words_i & words_j:
-            idf = self.idf_score[word]
-            nominator += tf_i[word] * tf_j[word] * idf ** 2
-
-        if math.isclose(nominator, 0):
-            return 0
+        vocabulary = {}
+        rows, cols, values = [], [], []
+        for i, tf in enumerate(tf_scores):
+            for word, count in tf.items():
+                rows.append(i)
+                cols.append(vocabulary.setdefault(word, len(vocabulary)))
+                values.append(count)
 
-        denominator_i, denominator_j = 0, 0
+        # .get keeps words of the ranked sentences out of the trained idf table
+        default_idf = self.idf_score.default_factory()
+        idf = np.array([self.idf_score.get(word, default_idf) for word in vocabulary], dtype=np.float64)
+        tfidf = sp.csr_matrix((np.array(values, dtype=np.float64) * idf[cols], (rows, cols)),
+                              shape=(length, len(vocabulary)))
 
-        for word in words_i:
-            tfidf = tf_i[word] * self.idf_score[word]
-            denominator_i += tfidf ** 2
+        norms = np.sqrt(np.asarray(tfidf.multiply(tfidf).sum(axis=1)).ravel())
+        inverse_norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+        normalized = sp.diags(inverse_norms) @ tfidf
 
-        for word in words_j:
-            tfidf = tf_j[word] * self.idf_score[word]
-            denominator_j += tfidf ** 2
+        matrix = (normalized @ normalized.T).tocsr()
+        matrix.setdiag(1)
+        matrix.eliminate_zeros()
 
-        similarity = nominator / math.sqrt(denominator_i * denominator_j)
-
-        return similarity
+        return matrix
 
 def create_markov_matrix(weights_matrix):
     n_1, n_2 = weights_matrix.shape
     if n_1 != n_2:
         raise ValueError('weights_matrix should be square')
 
-    row_sum = weights_matrix.sum(axis=1, keepdims=True)
+    weights_matrix = sp.csr_matrix(weights_matrix)
+    row_sum = np.asarray(weights_matrix.sum(axis=1)).ravel()
 
-    return weights_matrix / row_sum
+    return (sp.diags(1 / row_sum) @ weights_matrix).tocsr()
 
 
 def create_markov_matrix_discrete(weights_matrix, threshold):
-    discrete_weights_matrix = np.zeros(weights_matrix.shape)
-    ixs = np.where(weights_matrix >= threshold)
-    discrete_weights_matrix[ixs] = 1
+    if threshold <= 0:
+        # every pair, including the implicit zeros, would pass: the transition matrix is dense and uniform,
+        # degree_centrality_scores answers that case without building it
+        raise ValueError('threshold should be positive, a threshold <= 0 gives the uniform transition matrix')
+
+    discrete_weights_matrix = sp.csr_matrix(weights_matrix, copy=True)
+    discrete_weights_matrix.data = (discrete_weights_matrix.data >= threshold).astype(np.float64)
+    discrete_weights_matrix.eliminate_zeros()
 
     return create_markov_matrix(discrete_weights_matrix)
 
-def _power_method(transition_matrix):
-    eigenvector = np.ones(len(transition_matrix))
+def _power_method(transition_matrix, tol=POWER_METHOD_TOL, max_iter=POWER_METHOD_MAX_ITER, fallback=True):
+    """
+    stationary distribution (scaled to sum to the number of nodes) of a connected transition matrix,
+    by sparse matrix-vector iteration until no entry changes by more than tol; if that does not happen
+    within max_iter iterations and fallback is set, the leading eigenvector is computed with scipy's eigs.
+    returns the eigenvector and a dictionary with the number of iterations, convergence and the method used
+    """
+    n = transition_matrix.shape[0]
+    eigenvector = np.ones(n)
 
-    if len(eigenvector) == 1:
-        return eigenvector
+    if n == 1:
+        return eigenvector, {'iterations': 0, 'converged': True, 'method': 'power'}
 
-    transition = transition_matrix.transpose()
+    transition = sp.csr_matrix(transition_matrix).transpose().tocsr()
 
-    while True:
-        eigenvector_next = np.dot(transition, eigenvector)
+    for iteration in range(1, max_iter + 1):
+        eigenvector_next = transition @ eigenvector
 
-        if np.allclose(eigenvector_next, eigenvector):
-            return eigenvector_next
+        if np.allclose(eigenvector_next, eigenvector, rtol=0, atol=tol):
+            return eigenvector_next, {'iterations': iteration, 'converged': True, 'method': 'power'}
 
         eigenvector = eigenvector_next
-        #increases speed but also increases space taken
-        transition = np.dot(transition, transition)
 
-def degree_centrality_scores(sim_matrix, threshold=None):
+    if not fallback:
+        return eigenvector, {'iterations': max_iter, 'converged': False, 'method': 'power'}
+
+    if n > 2:
+        _, vectors = eigs(transition, k=1, which='LM', v0=eigenvector)
+        leading = vectors[:, 0]
+    else:
+        values, vectors = np.linalg.eig(transition.toarray())
+        leading = vectors[:, np.argmax(np.abs(values))]
+    leading = np.abs(np.real(leading))
+    eigenvector = leading * n / leading.sum()
+    return eigenvector, {'iterations': max_iter, 'converged': True, 'method': 'eigs'}
+
+def degree_centrality_scores(sim_matrix, threshold=None, tol=POWER_METHOD_TOL, max_iter=POWER_METHOD_MAX_ITER, return_info=False):
     if not (threshold is None or isinstance(threshold, float) and 0 <= threshold < 1):
         raise ValueError('threshold should be a floating-point number ''from the interval [0, 1) or None')
 
+    if threshold is not None and threshold <= 0:
+        # every pair passes: each row of the transition matrix is uniform and its stationary distribution is all ones
+        n = sim_matrix.shape[0]
+        scores = np.ones(n)
+        if return_info:
+            return scores, {'components': int(n > 0), 'iterations': 0, 'converged': True, 'eigs_fallbacks': 0}
+        return scores
+
     if threshold is None:
         markov_matrix = create_markov_matrix(sim_matrix)
     else:
         markov_matrix = create_markov_matrix_discrete(sim_matrix, threshold)
-    scores = stationary_distribution(markov_matrix, normalized=False)
-    return scores
-
-def stationary_distribution(transition_matrix, normalized=True):
+    return stationary_distribution(markov_matrix, normalized=False, tol=tol, max_iter=max_iter, return_info=return_info)
+
+def stationary_distribution(transition_matrix, normalized=True, tol=POWER_METHOD_TOL, max_iter=POWER_METHOD_MAX_ITER,
+                            fallback=True, return_info=False):
+    """
+    stationary distribution of every connected component of transition_matrix;
+    with return_info, also returns a dictionary with the number of components, the largest number of
+    power iterations, whether every component converged and how many needed the eigs fallback
+    """
     n_1, n_2 = transition_matrix.shape
     if n_1 != n_2:
         raise ValueError('transition_matrix should be square')
 
+    transition_matrix = sp.csr_matrix(transition_matrix)
     distribution = np.zeros(n_1)
     grouped_indices = connected_nodes(transition_matrix)
+    info = {'components': len(grouped_indices), 'iterations': 0, 'converged': True, 'eigs_fallbacks': 0}
 
     for group in grouped_indices:
-        t_matrix = transition_matrix[np.ix_(group, group)]
-        eigenvector = _power_method(t_matrix)
+        t_matrix = transition_matrix[group][:, group]
+        eigenvector, group_info = _power_method(t_matrix, tol=tol, max_iter=max_iter, fallback=fallback)
         distribution[group] = eigenvector
+        info['iterations'] = max(info['iterations'], group_info['iterations'])
+        info['converged'] = info['converged'] and group_info['converged']
+        info['eigs_fallbacks'] += group_info['method'] == 'eigs'
 
     if normalized:
         distribution /= n_1
 
+    if return_info:
+        return distribution, info
     return distribution
 
 def connected_nodes(matrix):
@@ -12,14 +12,28 @@ import matplotlib.pyplot as plt
 # %% [markdown]
 # Load MIMIC tables NOTEEVENTS and DIAGNOSES_ICD
 
+def read_noteevents(path, columns=('HADM_ID', 'CATEGORY', 'TEXT'), categories=None, chunksize=10000):
+    """
+    Read NOTEEVENTS.csv in chunks, parsing only the given columns and keeping only notes of the given categories,
+    so peak memory depends on the selected notes instead of the whole multi-GB file.
+    """
+    dtype = {'ROW_ID':np.int32, 'SUBJECT_ID': np.int32,'HADM_ID': np.float64, 'CHARTDATE':str,'STORETIME':str,
+             'CHARTTIME':str, 'CATEGORY': str,'DESCRIPTION':str,'CGID':str,'ISERROR':str, 'TEXT':str}
+    usecols = list(columns) + (['CATEGORY'] if categories is not None and 'CATEGORY' not in columns else [])
+    chunks = []
+    for chunk in pd.read_csv(path, usecols=usecols, dtype={c: dtype[c] for c in usecols}, chunksize=chunksize):
+        if categories is not None:
+            chunk = chunk[chunk['CATEGORY'].isin(categories)]
+        chunks.append(chunk[list(columns)])
+    return pd.concat(chunks, ignore_index=True)
+
 def run_mimic_prep(train_split=False, mimic_data_path='../data/mimic_data', output_folder ='../data', output_name='mimic_full.csv', code_mincount=1000, return_df=False, verbose=False):
     if code_mincount != 1000:
         rewrite=True
     # %%
-    NOTEEVENTS=pd.read_csv(mimic_data_path + 'NOTEEVENTS.csv',dtype={'ROW_ID':np.int32, 'SUBJECT_ID': np.int32,'HADM_ID': np.float64,
-                                        'CHARTDATE':str,'STORETIME':str,'CHARTTIME':str,
-                                        'STORETIME': str,'CATEGORY': str,'DESCRIPTION':str,'CGID':str,'ISERROR':str,
-                                            'TEXT':str}, parse_dates=['CHARTDATE'])
+    # only discharge summaries are used below, so only those are kept while reading
+    selected_doc=['Discharge summary']
+    NOTEEVENTS=read_noteevents(mimic_data_path + 'NOTEEVENTS.csv', columns=('HADM_ID', 'CATEGORY', 'TEXT'), categories=selected_doc)
     DIAGNOSES_ICD=pd.read_csv(mimic_data_path + 'DIAGNOSES_ICD.csv',dtype={'ROW_ID':np.int32, 'SUBJECT_ID': np.int32,'HADM_ID': np.int32,
                                                 'SEQ_NUM': np.float64, 'ICD9_CODE':str})
 
@@ -126,7 +140,6 @@ def run_mimic_prep(train_split=False, mimic_data_path='../data/mimic_data', outp
     # In the first place we will focus on discharge summaries.
 
     # %%
-    selected_doc=['Discharge summary']
     df=NOTEEVENTS[NOTEEVENTS['CATEGORY'].isin(selected_doc)].groupby('HADM_ID')['TEXT'].apply(lambda x: "{%s}" % ', '.join(x))
     df2=pd.DataFrame(df)
     df2.index.names = ['HADM_ID_INDEX']
@@ -0,0 +1,141 @@
+"""Bulk indexing of the abbreviations of every NOTEEVENTS note into the ehr_abbs_mimic Solr core"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import time
+from mimiciii import get_abbs_sent_ids
+from solr_lib import get_solr_client, LocalSolrIndex, SolrClient
+
+# number of fetch_size chunks of notes handed to the workers before their documents are posted
+PENDING_CHUNKS = 2
+
+
+def abbreviation_document(row):
+    """Solr document of a (ROW_ID, TEXT) row, with the fields queried by solr_lib.get_solr_response_mimic"""
+    row_id, text = row
+    text = text or ""
+    abbs_sent_ids = get_abbs_sent_ids(text)
+    return {'id': row_id,
+            'abbreviations': sorted(set(abb for abb, _ in abbs_sent_ids)),
+            'abbreviations_sent_id': ['%s:%d' % (abb, sent_id) for abb, sent_id in abbs_sent_ids],
+            'doctext_not_stored': text}
+
+
+def read_checkpoint(path):
+    """(last ROW_ID indexed, number of notes indexed) saved by index_abbreviations, (-1, 0) without checkpoint"""
+    if path is None or not os.path.exists(path):
+        return -1, 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    return checkpoint['last_row_id'], checkpoint['documents']
+
+
+def write_checkpoint(path, last_row_id, documents):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'last_row_id': last_row_id, 'documents': documents}, f)
+    os.replace(tmp_path, path)
+
+
+def index_abbreviations(ehrdb, client=None, core='ehr_abbs_mimic', workers=4, batch_size=500,
+                        commit_within=60000, checkpoint=None, fetch_size=2000):
+    """Streams NOTEEVENTS in ROW_ID order, extracts the abbreviations and their sentence ids of every note with
+    a pool of workers and posts them to client (default solr_lib.get_solr_client()) batch_size documents per
+    request, letting Solr commit within commit_within ms.
+
+    After every posted batch the last ROW_ID is written to the checkpoint file, so a stopped job started again
+    with the same checkpoint continues after the last posted note. Returns the number of notes indexed by this run.
+    """
+    client = client or get_solr_client()
+    last_row_id, total = read_checkpoint(checkpoint)
+    if last_row_id >= 0:
+        print("resuming after ROW_ID %d (%d notes already indexed)" % (last_row_id, total))
+
+    # read by this thread only; pages are fetched in full, so no connection is held while the workers run
+    chunks = ehrdb.iter_notes_after(last_row_id, fetch_size)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+
+    def documents():
+        if pool is None:
+            for rows in chunks:
+                for document in map(abbreviation_document, rows):
+                    yield document
+            return
+        # at most PENDING_CHUNKS chunks are extracted ahead of the posts, so a slow Solr does not fill the memory;
+        # results are taken in submission order, so everything up to the last posted ROW_ID is in the index
+        pending = collections.deque()
+        for rows in chunks:
+            pending.append(pool.map_async(abbreviation_document, rows, chunksize=64))
+            if len(pending) > PENDING_CHUNKS:
+                for document in pending.popleft().get():
+                    yield document
+        while pending:
+            for document in pending.popleft().get():
+                yield document
+
+    start, indexed, abbreviations = time.time(), 0, 0
+    batch = []
+
+    def post(batch):
+        client.add(core, batch, commit_within=commit_within)
+        if checkpoint is not None:
+            write_checkpoint(checkpoint, batch[-1]['id'], total + indexed + len(batch))
+
+    try:
+        for document in documents():
+            batch.append(document)
+            abbreviations += len(document['abbreviations_sent_id'])
+            if len(batch) >= batch_size:
+                post(batch)
+                indexed += len(batch)
+                batch = []
+                elapsed = max(time.time() - start, 1e-6)
+                print("%d notes indexed (%.0f notes/s, %.0f abbreviations/s)"
+                      % (total + indexed, indexed / elapsed, abbreviations / elapsed))
+        if batch:
+            post(batch)
+            indexed += len(batch)
+    finally:
+        chunks.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    client.commit(core)
+    print("%d notes (%d abbreviations) indexed in %.1fs" % (indexed, abbreviations, time.time() - start))
+    return indexed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the abbreviations of every note of NOTEEVENTS into Solr')
+    parser.add_argument('--solr_url', default=None, type=str, help='Solr server, default to $SOLR_URL')
+    parser.add_argument('--local_index', default=None, type=str, help='json lines file of a LocalSolrIndex, used instead of a Solr server')
+    parser.add_argument('--core', default='ehr_abbs_mimic', type=str, help='Solr core')
+    parser.add_argument('--sqlite', default=None, type=str, help='read the notes from a SQLite copy of MIMIC-III instead of MySQL')
+    parser.add_argument('--workers', default=4, type=int, help='number of processes extracting abbreviations')
+    parser.add_argument('--batch_size', default=500, type=int, help='number of documents posted per request')
+    parser.add_argument('--commit_within', default=60000, type=int, help='ms within which Solr commits posted documents')
+    parser.add_argument('--checkpoint', default='abbreviation_index.checkpoint.json', type=str, help='file the progress is saved to, the job resumes from it')
+
+    args = parser.parse_args()
+    import mimiciii
+    if args.sqlite is not None:
+        session = mimiciii.sqlite_session(args.sqlite)
+    else:
+        try:
+            from config import USERNAME, PASSWORD
+        except ImportError:
+            from getpass import getpass
+            USERNAME = input('DB_username?')
+            PASSWORD = getpass('DB_password?')
+        session = mimiciii.start_session(USERNAME, PASSWORD)
+    if args.local_index is not None:
+        solr = LocalSolrIndex(args.local_index)
+    elif args.solr_url is not None:
+        solr = SolrClient(args.solr_url)
+    else:
+        solr = get_solr_client()
+    index_abbreviations(session, solr, args.core, args.workers, args.batch_size, args.commit_within, args.checkpoint)
+    solr.close()
+    session.close_session()
@@ -107,6 +107,36 @@ class Patient:
         return today.year - birthdate.year - ((today.month, today.day) < (birthdate.month, birthdate.day))
 
 
+class LazySentences:
+    """Sentences of a note, split with tokenize (e.g. nltk sent_tokenize) the first time they are used.
+
+    Behaves like the list of sentences (len, indexing, iteration), the text is kept until then.
+    """
+
+    def __init__(self, text, tokenize):
+        self.text = text
+        self.tokenize = tokenize
+        self._sentences = None
+
+    @property
+    def sentences(self):
+        if self._sentences is None:
+            self._sentences = self.tokenize(self.text)
+        return self._sentences
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def __getitem__(self, i):
+        return self.sentences[i]
+
+    def __iter__(self):
+        return iter(self.sentences)
+
+    def __repr__(self):
+        state = "%d sentences" % len(self._sentences) if self._sentences is not None else "not split"
+        return "LazySentences(%d characters, %s)" % (len(self.text), state)
+
 # Disease Object
 
 class Disease:
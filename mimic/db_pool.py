@@ -0,0 +1,216 @@
+"""Connection pools for the MIMIC database used by mimiciii.ehr_db"""
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
+
+
+class ConnectionPool:
+    """Thread-safe pool of database connections.
+
+    Connections are opened lazily (at most size of them), checked with ping() when taken from the pool
+    and reopened if the server dropped them. A connection is used by one thread at a time: callers block
+    until one is free, or timeout seconds have passed. A thread that already holds every connection (e.g.
+    through unfinished streams) gets a RuntimeError instead, since no connection could ever be given back.
+
+    Args:
+        connect (callable): opens a new connection
+        size (int): maximum number of open connections
+        timeout (float): seconds to wait for a free connection, None to wait forever
+        stream_cursor: cursor class for unbuffered (server-side) cursors, None if the driver has none
+    """
+
+    def __init__(self, connect, size=4, timeout=None, stream_cursor=None):
+        if size < 1:
+            raise ValueError("pool size should be at least 1, got %d" % size)
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.stream_cursor = stream_cursor
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._closed = False
+        # number of connections lent to each thread (by thread id)
+        self._held = {}
+
+    def _acquire(self):
+        if self._closed:
+            raise RuntimeError("connection pool is closed")
+        try:
+            cnx = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    return self.connect()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            with self._lock:
+                held = self._held.get(threading.get_ident(), 0)
+            if held >= self.size:
+                raise RuntimeError("all %d connections of the pool are held by this thread (e.g. by an unfinished "
+                                   "ehr_db.stream), waiting for one would never end; finish or close the stream "
+                                   "first, or use a larger pool" % self.size)
+            try:
+                cnx = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise RuntimeError("no database connection became free in %s seconds" % self.timeout)
+        return self._check(cnx)
+
+    def _check(self, cnx):
+        """Returns cnx if it still answers, otherwise a new connection"""
+        try:
+            cnx.ping(reconnect=True)
+            return cnx
+        except Exception:
+            self._discard(cnx)
+            with self._lock:
+                self._opened += 1
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+
+    def _discard(self, cnx):
+        with self._lock:
+            self._opened -= 1
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+    def _release(self, cnx, failed=False):
+        if failed:
+            # roll back whatever the failed query left open, drop the connection if even that fails
+            try:
+                cnx.rollback()
+            except Exception:
+                self._discard(cnx)
+                return
+        if self._closed:
+            self._discard(cnx)
+        else:
+            self._idle.put(cnx)
+
+    @contextmanager
+    def connection(self):
+        """Context manager lending a connection of the pool to the calling thread"""
+        owner = threading.get_ident()
+        cnx = self._acquire()
+        with self._lock:
+            self._held[owner] = self._held.get(owner, 0) + 1
+        failed = False
+        try:
+            yield cnx
+        except BaseException:
+            # also GeneratorExit (a stream closed early) and KeyboardInterrupt, the connection is never lost
+            failed = True
+            raise
+        finally:
+            with self._lock:
+                self._held[owner] -= 1
+                if not self._held[owner]:
+                    del self._held[owner]
+            self._release(cnx, failed=failed)
+
+    def cursor(self, cnx, stream=False):
+        """Returns a cursor of cnx, unbuffered if stream is True and the driver supports it"""
+        if stream and self.stream_cursor is not None:
+            return cnx.cursor(self.stream_cursor)
+        return cnx.cursor()
+
+    def new_connection(self):
+        """Opens a connection that is not managed by the pool (e.g. for ehr_db.cur)"""
+        return self.connect()
+
+    def close(self):
+        """Closes the idle connections, connections in use are closed when they are given back"""
+        self._closed = True
+        while True:
+            try:
+                cnx = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(cnx)
+
+
+def mysql_pool(db_user, db_pass, host='localhost', port=3306, database='mimic', size=4, timeout=None):
+    """Pool of pymysql connections to the MIMIC-III MySQL database"""
+    if pymysql is None:
+        raise ImportError("mysql_pool needs pymysql, install it with `pip install pymysql`")
+
+    def connect():
+        return pymysql.connect(host=host, user=db_user, password=db_pass, port=port, database=database)
+
+    return ConnectionPool(connect, size=size, timeout=timeout, stream_cursor=pymysql.cursors.SSCursor)
+
+
+class SQLiteCursor:
+    """sqlite3 cursor accepting the pymysql "%s" parameter style, so ehr_db queries run unchanged"""
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, query, args=None):
+        if args is None:
+            return self._cur.execute(query)
+        query = query.replace("%s", "?").replace("%%", "%")
+        return self._cur.execute(query, tuple(args))
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchmany(self, size=1):
+        return self._cur.fetchmany(size)
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def close(self):
+        self._cur.close()
+
+    def __iter__(self):
+        return iter(self._cur)
+
+
+class SQLiteConnection:
+    """Test stand-in for a pymysql connection: a SQLite database file attached under the schema name "mimic",
+    so queries on mimic.NOTEEVENTS, mimic.PATIENTS, ... work as they do on MySQL
+    """
+
+    def __init__(self, path):
+        self._cnx = sqlite3.connect(":memory:", check_same_thread=False)
+        self._cnx.execute("ATTACH DATABASE ? AS mimic", (path,))
+
+    def cursor(self, cursor_class=None):
+        return SQLiteCursor(self._cnx.cursor())
+
+    def ping(self, reconnect=True):
+        self._cnx.execute("select 1")
+
+    def commit(self):
+        self._cnx.commit()
+
+    def rollback(self):
+        self._cnx.rollback()
+
+    def close(self):
+        self._cnx.close()
+
+
+def sqlite_pool(path, size=4, timeout=None):
+    """Pool of connections to a SQLite copy (or fixture) of the MIMIC-III tables, see SQLiteConnection"""
+    return ConnectionPool(lambda: SQLiteConnection(path), size=size, timeout=timeout)
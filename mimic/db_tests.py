@@ -0,0 +1,202 @@
+import unittest
+import gc
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import mimiciii
+from db_pool import sqlite_pool
+
+# Number of patients in the fixture, patient i has i % 3 notes and ROW_IDs are not contiguous.
+NUM_PATIENTS = 20
+
+NOTES = ["Service: SURGERY. Pt has CHF and COPD. Follow up with PCP.",
+         "No acute distress. BP stable, pt ambulating.",
+         "Patient with HTN and CHF. Service: MEDICINE."]
+
+
+def build_fixture(path):
+    """Writes a tiny MIMIC-III sample (the tables used by ehr_db) to the SQLite file path"""
+    cnx = sqlite3.connect(path)
+    cnx.executescript('''
+        CREATE TABLE PATIENTS (ROW_ID INT, SUBJECT_ID INT, GENDER TEXT, DOB TEXT, DOD TEXT);
+        CREATE TABLE NOTEEVENTS (ROW_ID INT, SUBJECT_ID INT, CHARTDATE TEXT, CATEGORY TEXT, TEXT TEXT);
+        CREATE TABLE DIAGNOSES_ICD (ROW_ID INT, SUBJECT_ID INT, ICD9_CODE TEXT);
+        CREATE TABLE PROCEDURES_ICD (ROW_ID INT, SUBJECT_ID INT, ICD9_CODE TEXT);
+        CREATE TABLE D_ICD_DIAGNOSES (ICD9_CODE TEXT, SHORT_TITLE TEXT, LONG_TITLE TEXT);
+        CREATE TABLE D_ICD_PROCEDURES (ICD9_CODE TEXT, SHORT_TITLE TEXT, LONG_TITLE TEXT);
+        CREATE TABLE PRESCRIPTIONS (ROW_ID INT, SUBJECT_ID INT, DRUG TEXT);
+    ''')
+    row_id = 100
+    for subject_id in range(1, NUM_PATIENTS + 1):
+        cnx.execute("INSERT INTO PATIENTS VALUES (?, ?, ?, ?, ?)",
+                    (subject_id, subject_id, "MF"[subject_id % 2], "2100-01-01", None))
+        for text in NOTES[:subject_id % 3]:
+            cnx.execute("INSERT INTO NOTEEVENTS VALUES (?, ?, ?, ?, ?)",
+                        (row_id, subject_id, "2150-01-01", "Discharge summary", text))
+            row_id += 7
+        cnx.execute("INSERT INTO DIAGNOSES_ICD VALUES (?, ?, ?)",
+                    (subject_id, subject_id, "4019" if subject_id % 4 else "9999"))
+        if subject_id % 5 == 0:
+            cnx.execute("INSERT INTO PROCEDURES_ICD VALUES (?, ?, ?)", (subject_id, subject_id, "3893"))
+    cnx.execute("INSERT INTO D_ICD_DIAGNOSES VALUES ('4019', 'Hypertension NOS', 'Unspecified essential hypertension')")
+    cnx.execute("INSERT INTO D_ICD_PROCEDURES VALUES ('3893', 'Venous cath NEC', 'Venous catheterization')")
+    for row, drug in enumerate(["Aspirin", "Heparin", "Aspirin", "Insulin", "Aspirin", "Heparin"]):
+        cnx.execute("INSERT INTO PRESCRIPTIONS VALUES (?, ?, ?)", (row, row % 3 + 1, drug))
+    cnx.commit()
+    cnx.close()
+
+
+class tests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "mimic.sqlite")
+        build_fixture(self.path)
+        self.ehrdb = mimiciii.sqlite_session(self.path, pool_size=1, timeout=2)
+        mimiciii.ICD_TITLES.clear()
+
+    def tearDown(self):
+        self.ehrdb.close_session()
+        mimiciii.ICD_TITLES.clear()
+        shutil.rmtree(self.dir)
+
+
+''' connection pool and query helpers '''
+
+
+class t1(tests):
+    def test1_1_query(self):
+        rows = self.ehrdb.query("select SUBJECT_ID from mimic.PATIENTS where GENDER = %s order by SUBJECT_ID", ("M",))
+        self.assertEqual([row[0] for row in rows], list(range(2, NUM_PATIENTS + 1, 2)))
+
+    def test1_2_stream(self):
+        chunks = list(self.ehrdb.stream("select ROW_ID from mimic.NOTEEVENTS order by ROW_ID", size=4))
+        rows = self.ehrdb.query("select ROW_ID from mimic.NOTEEVENTS order by ROW_ID")
+        self.assertTrue(all(len(chunk) == 4 for chunk in chunks[:-1]))
+        self.assertEqual([row for chunk in chunks for row in chunk], list(rows))
+
+    def test1_3_stream_closed_early(self):
+        # the pool has a single connection: a stream closed (or dropped) before its end must give it back
+        stream = self.ehrdb.stream("select ROW_ID from mimic.NOTEEVENTS", size=1)
+        next(stream)
+        stream.close()
+        self.assertEqual(self.ehrdb.count_patients(), NUM_PATIENTS)
+
+        stream = self.ehrdb.stream("select ROW_ID from mimic.NOTEEVENTS", size=1)
+        next(stream)
+        del stream
+        gc.collect()
+        self.assertEqual(self.ehrdb.count_patients(), NUM_PATIENTS)
+
+    def test1_4_failed_query(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            self.ehrdb.query("select * from mimic.NO_SUCH_TABLE")
+        self.assertEqual(self.ehrdb.count_patients(), NUM_PATIENTS)
+
+    def test1_5_interrupted(self):
+        pool = sqlite_pool(self.path, size=1, timeout=2)
+        with self.assertRaises(KeyboardInterrupt):
+            with pool.connection():
+                raise KeyboardInterrupt
+        with pool.connection() as cnx:
+            cur = pool.cursor(cnx)
+            cur.execute("select count(*) from mimic.PATIENTS")
+            self.assertEqual(cur.fetchone()[0], NUM_PATIENTS)
+        pool.close()
+
+    def test1_6_query_during_stream(self):
+        # the only connection is held by the stream: a query fails at once instead of waiting forever
+        stream = self.ehrdb.stream("select ROW_ID from mimic.NOTEEVENTS", size=1)
+        next(stream)
+        with self.assertRaises(RuntimeError):
+            self.ehrdb.count_patients()
+        stream.close()
+        self.assertEqual(self.ehrdb.count_patients(), NUM_PATIENTS)
+
+
+''' keyset-paginated id scans '''
+
+
+class t2(tests):
+    def test2_1_iter_ids(self):
+        expected = [row[0] for row in self.ehrdb.query("select ROW_ID from mimic.NOTEEVENTS order by ROW_ID")]
+        for page_size in [1, 4, len(expected), len(expected) + 1]:
+            pages = list(self.ehrdb.iter_ids("NOTEEVENTS", "ROW_ID", page_size))
+            self.assertTrue(all(len(page) == page_size for page in pages[:-1]))
+            self.assertTrue(all(page.dtype == np.int64 for page in pages))
+            self.assertEqual(np.concatenate(pages).tolist(), expected)
+
+    def test2_2_id_arrays(self):
+        self.assertEqual(self.ehrdb.patient_id_array(page_size=3).tolist(), list(range(1, NUM_PATIENTS + 1)))
+        self.assertEqual(self.ehrdb.list_all_patient_ids(), list(range(1, NUM_PATIENTS + 1)))
+        self.assertEqual(self.ehrdb.document_id_array().tolist(),
+                         [row[0] for row in self.ehrdb.query("select ROW_ID from mimic.NOTEEVENTS order by ROW_ID")])
+
+    def test2_3_unknown_column(self):
+        with self.assertRaises(ValueError):
+            list(self.ehrdb.iter_ids("NOTEEVENTS", "TEXT"))
+
+    def test2_4_iter_notes_after(self):
+        expected = self.ehrdb.query("select ROW_ID, TEXT from mimic.NOTEEVENTS order by ROW_ID")
+        for page_size in [1, 4, len(expected)]:
+            pages = []
+            for page in self.ehrdb.iter_notes_after(page_size=page_size):
+                # no connection is held between pages, other queries run on the single connection of the pool
+                self.assertEqual(self.ehrdb.get_document(page[0][0]), page[0][1])
+                pages.append(page)
+            self.assertTrue(all(len(page) == page_size for page in pages[:-1]))
+            self.assertEqual([row for page in pages for row in page], list(expected))
+        self.assertEqual([row for page in self.ehrdb.iter_notes_after(expected[4][0], 3) for row in page],
+                         list(expected[5:]))
+
+    def test2_5_count_all_prescriptions(self):
+        self.assertEqual(self.ehrdb.count_all_prescriptions(), {"Aspirin": 3, "Heparin": 2, "Insulin": 1})
+
+
+''' chunked IN queries '''
+
+
+class t3(tests):
+    def setUp(self):
+        super().setUp()
+        self.chunk_sizes = mimiciii.IN_CHUNK_SIZE, mimiciii.NOTE_SUBJECT_CHUNK_SIZE
+        # several chunks even on the fixture
+        mimiciii.IN_CHUNK_SIZE = mimiciii.NOTE_SUBJECT_CHUNK_SIZE = 3
+        self.ehrdb.get_patients(-1)
+
+    def tearDown(self):
+        mimiciii.IN_CHUNK_SIZE, mimiciii.NOTE_SUBJECT_CHUNK_SIZE = self.chunk_sizes
+        super().tearDown()
+
+    def test3_1_diagnoses(self):
+        self.ehrdb.get_diagnoses()
+        for subject_id, patient in self.ehrdb.patients.items():
+            names = [diagnosis.name for diagnosis in patient.diagnosis]
+            # 9999 has no title in D_ICD_DIAGNOSES
+            self.assertEqual(names, ["Unspecified essential hypertension" if subject_id % 4 else None])
+
+    def test3_2_procedures(self):
+        self.ehrdb.get_procedures()
+        for subject_id, patient in self.ehrdb.patients.items():
+            names = [procedure.name for procedure in patient.procedures or []]
+            self.assertEqual(names, ["Venous catheterization"] if subject_id % 5 == 0 else [])
+
+    def test3_3_note_events(self):
+        self.ehrdb.get_note_events(split_sentences=False)
+        for subject_id, patient in self.ehrdb.patients.items():
+            expected = self.ehrdb.query("select ROW_ID, TEXT from mimic.NOTEEVENTS where SUBJECT_ID = %s "
+                                        "order by ROW_ID", (subject_id,))
+            self.assertEqual(patient.note_events, [tuple(row) for row in expected])
+
+    def test3_4_queries_during_note_events(self):
+        for subject_id, docs in self.ehrdb.iter_note_events(split_sentences=False):
+            self.assertEqual([row_id for row_id, _ in docs], self.ehrdb.get_all_patient_document_ids(subject_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,26 @@
 from datetime import date
-import pymysql
+try:
+    import pymysql
+except ImportError:
+    pymysql = None
 #from sshtunnel import SSHTunnelForwarder
-from classes import Patient, Disease, Diagnosis, Prescription, Procedure
+from classes import Patient, Disease, Diagnosis, Prescription, Procedure, LazySentences
+from db_pool import ConnectionPool, mysql_pool, sqlite_pool
+from text_index import TextIndex
 from solr_lib import *
 from datetime import datetime
-from nltk.tokenize import sent_tokenize, word_tokenize
-from nltk.corpus import stopwords
-from gensim import corpora, models, similarities
+try:
+    from nltk.tokenize import sent_tokenize, word_tokenize
+except ImportError:
+    sent_tokenize = word_tokenize = None
 from collections import defaultdict
+import threading
+import numpy as np
 import re
 import sys
 import os
 import pprint
 import string
-import torch
 import requests
 from sklearn.feature_extraction.text import TfidfVectorizer
 
@@ -24,22 +31,87 @@ sys.path.append(dir_path)
 
 
 # TODO: adding external library
-import torch
-from transformers import AutoTokenizer, AutoModelWithLMHead
+
+# Number of ids sent in a single "IN (...)" query.
+IN_CHUNK_SIZE = 1000
+
+# Number of patients whose notes are requested by a single NOTEEVENTS query (iter_note_events),
+# and notes per page of iter_notes_after.
+NOTE_SUBJECT_CHUNK_SIZE = 100
+NOTE_FETCH_SIZE = 1000
+
+# Number of ids read per keyset-paginated query by iter_ids.
+ID_PAGE_SIZE = 100000
+ID_FETCH_SIZE = 10000
+
+# Integer key columns that iter_ids can scan.
+ID_COLUMNS = {("PATIENTS", "SUBJECT_ID"), ("NOTEEVENTS", "ROW_ID"), ("PRESCRIPTIONS", "ROW_ID"),
+              ("DIAGNOSES_ICD", "ROW_ID"), ("PROCEDURES_ICD", "ROW_ID")}
+
+# ICD-9 titles by table (D_ICD_DIAGNOSES, D_ICD_PROCEDURES), loaded once per process by ehr_db.get_icd_titles.
+ICD_TITLES = {}
+ICD_TITLES_LOCK = threading.Lock()
 
 class ehr_db:
     """Connection object to Tangra MySQL Server.
 
+    Methods run parameterized queries on connections borrowed from a ConnectionPool (see db_pool.py),
+    so one ehr_db can be shared by the threads of a thread pool.
+
     Attributes:
-        cnx: pymysql connection object
-        cur: pymysql cursor object
+        cnx: pymysql connection object, not used by the methods (kept for direct queries)
+        cur: pymysql cursor object of cnx
+        pool: ConnectionPool used by the methods
+        text_index: optional TextIndex (see text_index.py) answering the text queries instead of LIKE scans
     """
 
     def __init__(self, sess):
         self.cnx = sess['cnx']
         self.cur = sess['cur']
+        self.pool = sess.get('pool')
+        if self.pool is None:
+            # without a pool, the methods share the session connection one query at a time
+            self.pool = ConnectionPool(lambda: sess['cnx'], size=1,
+                                       stream_cursor=pymysql.cursors.SSCursor if pymysql is not None else None)
         self.patients = {}
         self.note_event_flag = False
+        self.text_index = None
+
+    def use_text_index(self, index):
+        """Answers get_documents_q and docs_with_phrase with a local full-text index (a TextIndex or its path)
+        built with text_index.py, instead of scanning NOTEEVENTS.TEXT with LIKE.
+        """
+        self.text_index = TextIndex(index) if isinstance(index, str) else index
+
+    def query(self, sql, args=None):
+        """Runs sql on a connection of the pool and returns all rows.
+        Values are passed in args and written as %s in sql, never formatted into the query.
+        """
+        with self.pool.connection() as cnx:
+            cur = self.pool.cursor(cnx)
+            try:
+                cur.execute(sql, args)
+                return cur.fetchall()
+            finally:
+                cur.close()
+
+    def stream(self, sql, args=None, size=1000):
+        """Yields the rows of sql in lists of at most size rows, read through an unbuffered (server-side) cursor.
+        The connection stays borrowed from the pool until the generator is exhausted or closed, so other queries
+        made while iterating need another connection (a pool of size 1 raises RuntimeError instead of waiting
+        forever). To process notes between queries, use iter_notes_after or iter_note_events, which hold no
+        connection while the caller works on a chunk.
+        """
+        with self.pool.connection() as cnx:
+            cur = self.pool.cursor(cnx, stream=True)
+            try:
+                cur.execute(sql, args)
+                rows = cur.fetchmany(size)
+                while rows:
+                    yield rows
+                    rows = cur.fetchmany(size)
+            finally:
+                cur.close()
 
 
     def get_patients(self, n):
@@ -55,10 +127,9 @@ class ehr_db:
             none
         """
         if n == -1:
-            self.cur.execute("SELECT SUBJECT_ID, GENDER, DOB, DOD FROM mimic.PATIENTS")
+            raw = self.query("SELECT SUBJECT_ID, GENDER, DOB, DOD FROM mimic.PATIENTS")
         else:
-            self.cur.execute("SELECT SUBJECT_ID, GENDER, DOB, DOD FROM mimic.PATIENTS LIMIT %d" % n)
-        raw = self.cur.fetchall()
+            raw = self.query("SELECT SUBJECT_ID, GENDER, DOB, DOD FROM mimic.PATIENTS LIMIT %s", (n,))
 
 
         for p in raw:
@@ -86,8 +157,7 @@ class ehr_db:
     def count_patients(self):
         '''Counts and returns the number of patients as an int in the database.'''
 
-        self.cur.execute("SELECT COUNT(*) FROM mimic.PATIENTS")
-        raw = self.cur.fetchall()
+        raw = self.query("SELECT COUNT(*) FROM mimic.PATIENTS")
         return int(raw[0][0])
 
     def count_docs(self, query, getAll = False, inverted = False):
@@ -98,8 +168,8 @@ class ehr_db:
         setting inverted = False returns count of rows in tables specified in *args
         setting inverted = True returns count of rows in all tables except those specified in *args
         '''
-        table_count = self.cur.execute("SELECT TABLE_NAME, TABLE_ROWS from information_schema.tables where TABLE_SCHEMA = 'mimic' ")
-        numtup = self.cur.fetchall()
+        numtup = self.query("SELECT TABLE_NAME, TABLE_ROWS from information_schema.tables where TABLE_SCHEMA = %s", ('mimic',))
+        table_count = len(numtup)
         #numtup(nested tuple) structure: ((TABLE_NAME(str), TABLE_ROWS(int)),...)
         count = 0
         if getAll:
@@ -120,22 +190,73 @@ class ehr_db:
 
     #is this redundant?
 
-    def get_note_events(self):
+    def iter_notes_after(self, row_id=-1, page_size=NOTE_FETCH_SIZE):
+        """Yields the (ROW_ID, TEXT) rows of the notes with a ROW_ID above row_id, in ROW_ID order, in lists of at most
+        page_size notes. Each page is one keyset-paginated query (ROW_ID > last one seen) fetched in full, so no
+        connection is held while the caller processes a page.
         """
-        adds note_events to patient objects in self.patients
+        sql = "select ROW_ID, TEXT from mimic.NOTEEVENTS where ROW_ID > %s order by ROW_ID limit %s"
+        while True:
+            rows = self.query(sql, (row_id, page_size))
+            if not rows:
+                return
+            yield list(rows)
+            if len(rows) < page_size:
+                return
+            row_id = rows[-1][0]
+
+    def iter_note_events(self, subject_ids=None, split_sentences=True, lazy=False):
+        """Streams the notes of subject_ids (default: every patient in self.patients) from NOTEEVENTS.
+
+        Notes of NOTE_SUBJECT_CHUNK_SIZE patients are requested per query and fetched in full before they are
+        yielded, so memory stays bounded by the notes of one chunk of patients and no connection is held while
+        the caller processes them.
+        Yields (SUBJECT_ID, [(ROW_ID, sentences), ...]) for every patient with notes, where sentences is the
+        sent_tokenize list, a LazySentences split on first use (lazy=True), or the raw text (split_sentences=False).
+        """
+        if subject_ids is None:
+            subject_ids = list(self.patients)
+        subject_ids = list(subject_ids)
+
+        if split_sentences:
+            _require_nltk()
+
+        def document(row_id, text):
+            if not split_sentences:
+                return (row_id, text)
+            if lazy:
+                return (row_id, LazySentences(text, sent_tokenize))
+            return (row_id, sent_tokenize(text))
+
+        for start in range(0, len(subject_ids), NOTE_SUBJECT_CHUNK_SIZE):
+            chunk = subject_ids[start:start + NOTE_SUBJECT_CHUNK_SIZE]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            sql = ("select SUBJECT_ID, ROW_ID, TEXT from mimic.NOTEEVENTS where SUBJECT_ID in (%s) "
+                   "order by SUBJECT_ID, ROW_ID" % placeholders)
+            current, docs = None, []
+            for subject_id, row_id, text in self.query(sql, chunk):
+                if subject_id != current:
+                    if docs:
+                        yield current, docs
+                    current, docs = subject_id, []
+                docs.append(document(row_id, text))
+            if docs:
+                yield current, docs
+
+    def get_note_events(self, split_sentences=True, lazy=False):
+        """
+        adds note_events to patient objects in self.patients, as a list of (ROW_ID, sentences) per patient
+        (see iter_note_events for split_sentences and lazy)
         depends on get_patients(have to call it first to populate ehrdb with patients)
         return: None
         """
-        #TODO: Currently only adds one NoteEvent
-        for patient in self.patients.values():
-            if patient.note_events is None:
-                self.cur.execute("select ROW_ID, TEXT from mimic.NOTEEVENTS where SUBJECT_ID = %d" %patient.id)
-                rawt = self.cur.fetchall()
-                ls = []
-                for p in rawt:
-                    sent_list = sent_tokenize(p[1])
-                    ls.append((p[0],sent_list))
-                    patient.addNE(ls)
+        pending = [patient.id for patient in self.patients.values() if patient.note_events is None]
+        for subject_id, docs in self.iter_note_events(pending, split_sentences, lazy):
+            self.patients[subject_id].addNE(docs)
+        # patients without notes get an empty list, so they are not queried again
+        for subject_id in pending:
+            if self.patients[subject_id].note_events is None:
+                self.patients[subject_id].addNE([])
         self.note_event_flag = True
 
     def longest_NE(self):
@@ -159,8 +280,7 @@ class ehr_db:
         """Returns the text of a specific patient record given the ID (row ID in NOTEEVENTS).
         """
         text = ""
-        self.cur.execute("select TEXT from mimic.NOTEEVENTS where ROW_ID = %d" % id)
-        text = self.cur.fetchall()
+        text = self.query("select TEXT from mimic.NOTEEVENTS where ROW_ID = %s", (id,))
         return text[0][0]
 
     def get_all_patient_document_ids(self, patientID):
@@ -168,33 +288,54 @@ class ehr_db:
         """Returns a list of all document IDs associated with patientID.
         """
         records = []
-        self.cur.execute("select ROW_ID from mimic.NOTEEVENTS where SUBJECT_ID = %d" % patientID)
-        records = self.cur.fetchall()
+        records = self.query("select ROW_ID from mimic.NOTEEVENTS where SUBJECT_ID = %s", (patientID,))
         return flatten(records)
 
+    def iter_ids(self, table, column, page_size=ID_PAGE_SIZE):
+        """Yields every value of an integer key column (e.g. NOTEEVENTS.ROW_ID) in increasing order, as int64 arrays
+        of at most page_size ids. Pages are read with keyset pagination (column > last id seen) through an
+        unbuffered cursor, so the first ids arrive immediately and no page is ever scanned twice.
+        """
+        if (table, column) not in ID_COLUMNS:
+            raise ValueError("unknown id column %s.%s" % (table, column))
+        sql = ("select %s from mimic.%s where %s > %%s order by %s limit %%s" % (column, table, column, column))
+        last = -1
+        while True:
+            page = [row[0] for rows in self.stream(sql, (last, page_size), ID_FETCH_SIZE) for row in rows]
+            if not page:
+                return
+            yield np.array(page, dtype=np.int64)
+            if len(page) < page_size:
+                return
+            last = page[-1]
+
+    def patient_id_array(self, page_size=ID_PAGE_SIZE):
+        """Returns all patient IDs (PATIENTS.SUBJECT_ID) as a sorted int64 numpy array.
+        """
+        return _concat_ids(self.iter_ids("PATIENTS", "SUBJECT_ID", page_size))
+
+    def document_id_array(self, page_size=ID_PAGE_SIZE):
+        """Returns all document IDs (NOTEEVENTS.ROW_ID) as a sorted int64 numpy array (16MB for the 2M notes).
+        """
+        return _concat_ids(self.iter_ids("NOTEEVENTS", "ROW_ID", page_size))
+
     def list_all_patient_ids(self):
         """Returns a list of all patient IDs in the database.
         """
-        ids = []
-        self.cur.execute("select SUBJECT_ID from mimic.PATIENTS")
-        ids = self.cur.fetchall()
-        return flatten(ids)
+        return self.patient_id_array().tolist()
 
     def list_all_document_ids(self):
 
         """Returns a list of all document IDs in the database.
         """
-        ids = []
-        self.cur.execute("select ROW_ID from mimic.NOTEEVENTS")
-        ids = self.cur.fetchall()
-        return flatten(ids)
+        return self.document_id_array().tolist()
 
     def get_document_sents(self, docID):
 
         """Returns list of sentences in a record.
         """
-        self.cur.execute("select TEXT from mimic.NOTEEVENTS where ROW_ID = %d" % docID)
-        raw = self.cur.fetchall()
+        _require_nltk()
+        raw = self.query("select TEXT from mimic.NOTEEVENTS where ROW_ID = %s", (docID,))
         sent_list = sent_tokenize(raw[0][0])
         if not sent_list:
             print("No document text found.")
@@ -204,12 +345,7 @@ class ehr_db:
         ''' Returns a list of the abbreviations in a document.
         '''
         sent_list = self.get_document_sents(doc_id)
-        abb_list = set()
-        for sent in sent_list:
-            for word in word_tokenize(sent):
-                pattern = r'[A-Z]{2}'
-                if re.match(pattern, word):
-                    abb_list.add(word)
+        abb_list = set(abb for abb, _ in sentence_abbreviations(sent_list))
 
         return list(abb_list)
 
@@ -219,22 +355,14 @@ class ehr_db:
         '''
 
         sent_list = self.get_document_sents(doc_id)
-        abb_list = []
-        for i, sent in zip(range(0, len(sent_list)), sent_list):
-            for word in word_tokenize(sent):
-                pattern = r'[A-Z]{2}'
-                if re.match(pattern, word):
-                    abb_list.append((word, i))
-
-        return list(abb_list)
+        return sentence_abbreviations(sent_list)
 
 
     def get_documents_d(self, date):
         """Returns a list of all document IDs recorded on date. Format of YYYY-MM-DD for date.
         """
         ids = []
-        self.cur.execute("select ROW_ID from mimic.NOTEEVENTS where CHARTDATE = \"%s\"" % date)
-        ids = self.cur.fetchall()
+        ids = self.query("select ROW_ID from mimic.NOTEEVENTS where CHARTDATE = %s", (date,))
         if not ids:
             print("No values returned. Note that date must be formatted YYYY-MM-DD.")
         return flatten(ids)
@@ -242,14 +370,19 @@ class ehr_db:
     def get_documents_q(self, query, n = -1):
         """returns a List of all document IDs that include this text:”Service: SURGERY”
             when n = -1, search against all getDocuments
+            with a text index (use_text_index), the query is matched as a phrase of words, ignoring case and punctuation
         """
+        if self.text_index is not None:
+            ids = self.text_index.search(query, n)
+            if not ids:
+                print("No values returned.")
+            return ids
         query = "%"+query+"%"
         ids = []
         if n == -1:
-            self.cur.execute("select ROW_ID from mimic.NOTEEVENTS where TEXT like \'%s\'" %query)
+            ids = self.query("select ROW_ID from mimic.NOTEEVENTS where TEXT like %s", (query,))
         else:
-            self.cur.execute("select ROW_ID from mimic.NOTEEVENTS where TEXT like \'%s\' limit %d" %(query,n))
-        ids = self.cur.fetchall() #tuples?, TODO: try Dict Server?
+            ids = self.query("select ROW_ID from mimic.NOTEEVENTS where TEXT like %s limit %s", (query, n))
         if not ids:
             print("No values returned. Note that the query must be formatted such as Service: Surgery")
         return flatten(ids)
@@ -260,8 +393,7 @@ class ehr_db:
         dependancy: does not depend on calling get_patients
         '''
         query = "%"+str(query)+"%"
-        self.cur.execute("select ROW_ID, ICD9_CODE from mimic.DIAGNOSES_ICD where ICD9_CODE like '%s'" %query)
-        raws = self.cur.fetchall()
+        raws = self.query("select ROW_ID, ICD9_CODE from mimic.DIAGNOSES_ICD where ICD9_CODE like %s", (query,))
         docs = []
         for raw in raws:
             print(raw)#debug
@@ -286,14 +418,13 @@ class ehr_db:
         dependancy: does not depend on calling get_patients
         '''
         code = str(code)
-        self.cur.execute("select ROW_ID from mimic.DIAGNOSES_ICD where ICD9_CODE = '%s'" % code)
-        ids = self.cur.fetchall()
+        ids = self.query("select ROW_ID from mimic.DIAGNOSES_ICD where ICD9_CODE = %s", (code,))
         if not ids:
             print("No values returned.")
             return None
-        self.cur.execute("select SHORT_TITLE from mimic.D_ICD_DIAGNOSES where ICD9_CODE ='%s'" % code)
+        titles = self.query("select SHORT_TITLE from mimic.D_ICD_DIAGNOSES where ICD9_CODE = %s", (code,))
 
-        d = {code: (flatten(self.cur.fetchall()), flatten(ids))}
+        d = {code: (flatten(titles), flatten(ids))}
 
         return d
 
@@ -301,8 +432,7 @@ class ehr_db:
         """ TODO: NEEDS TO BE FIXED. CURRENTLY HAS IDs HARDCODED IN.
         """
         for patient in self.patients.values():
-            self.cur.execute("select DRUG from mimic.PRESCRIPTIONS where ROW_ID = 2968759 or ROW_ID = 2968760")
-            drugtuple = self.cur.fetchall()
+            drugtuple = self.query("select DRUG from mimic.PRESCRIPTIONS where ROW_ID = %s or ROW_ID = %s", (2968759, 2968760))
             druglist = []
             for drug in drugtuple:
                 druglist.append(drug[0])
@@ -310,47 +440,56 @@ class ehr_db:
 
     def count_all_prescriptions(self):
         """ Returns a dictionary with each medicine in PRESCRIPTIONS as keys
-            and how many times it has been prescribed as values. Takes a long time to run.
+            and how many times it has been prescribed as values.
         """
         meds_dict = {}
-        self.cur.execute("select DRUG from mimic.PRESCRIPTIONS")
-        raw = self.cur.fetchall()
-        meds_list = flatten(raw)
-        for med in meds_list:
-            if med in meds_dict:
-                meds_dict[med] += 1
-            else:
-                meds_dict[med] = 1
-
+        # counted by the server, only one row per distinct drug is streamed back
+        for rows in self.stream("select DRUG, count(*) from mimic.PRESCRIPTIONS group by DRUG"):
+            for med, count in rows:
+                meds_dict[med] = int(count)
         return meds_dict
 
+    def get_icd_titles(self, table):
+        """Returns a dictionary ICD9_CODE -> LONG_TITLE for D_ICD_DIAGNOSES or D_ICD_PROCEDURES.
+        The table is queried once per process; later calls (from any session) use the cached dictionary.
+        """
+        if table not in ("D_ICD_DIAGNOSES", "D_ICD_PROCEDURES"):
+            raise ValueError("unknown ICD-9 table %s" % table)
+        with ICD_TITLES_LOCK:
+            if table not in ICD_TITLES:
+                ICD_TITLES[table] = dict(self.query("select ICD9_CODE, LONG_TITLE from mimic.%s" % table))
+        return ICD_TITLES[table]
+
+    def iter_patient_codes(self, table):
+        """Yields (SUBJECT_ID, ICD9_CODE) from DIAGNOSES_ICD or PROCEDURES_ICD for every patient in self.patients,
+        with one query per IN_CHUNK_SIZE patients instead of one query per patient.
+        """
+        if table not in ("DIAGNOSES_ICD", "PROCEDURES_ICD"):
+            raise ValueError("unknown ICD-9 code table %s" % table)
+        subject_ids = list(self.patients)
+        for start in range(0, len(subject_ids), IN_CHUNK_SIZE):
+            chunk = subject_ids[start:start + IN_CHUNK_SIZE]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            rows = self.query("select SUBJECT_ID, ICD9_CODE from mimic.%s where SUBJECT_ID in (%s) order by ROW_ID"
+                              % (table, placeholders), chunk)
+            for subject_id, code in rows:
+                yield subject_id, code
+
     def get_diagnoses(self):
         """Adds diagnoses (converted from ICD-9 code) from DIAGNOSES_ICD to patient.diagnoses for each patient in patients dictionary.
         """
-        codes = []
-        diags = {}
-        for patient in self.patients.values():
-            self.cur.execute("select ICD9_CODE from mimic.DIAGNOSES_ICD where SUBJECT_ID = %d" % patient.id)
-            codes = self.cur.fetchall()
-            for code in codes:
-                if code not in diags:
-                    self.cur.execute("select LONG_TITLE from mimic.D_ICD_DIAGNOSES where ICD9_CODE = \"%s\"" % code)
-                    diags[code] = self.cur.fetchall()
-                patient.diagnose(diags[code])
+        titles = self.get_icd_titles("D_ICD_DIAGNOSES")
+        for subject_id, code in self.iter_patient_codes("DIAGNOSES_ICD"):
+            # the LONG_TITLE string, None for a code missing from the dictionary table
+            self.patients[subject_id].diagnose(titles.get(code))
 
     def get_procedures(self):
         """Adds procedures (converted from ICD-9 code) from PROCEDURES_ICD to patient.procedures for each patient in patients dictionary.
         """
-        codes = []
-        procs = {}
-        for patient in self.patients.values():
-            self.cur.execute("select ICD9_CODE from mimic.PROCEDURES_ICD where SUBJECT_ID = %d" % patient.id)
-            codes = self.cur.fetchall()
-            for code in codes:
-                if code not in procs:
-                    self.cur.execute("select LONG_TITLE from mimic.D_ICD_PROCEDURES where ICD9_CODE = \"%s\"" % code)
-                    procs[code] = self.cur.fetchall()
-                patient.add_procedure(procs[code])
+        titles = self.get_icd_titles("D_ICD_PROCEDURES")
+        for subject_id, code in self.iter_patient_codes("PROCEDURES_ICD"):
+            # the LONG_TITLE string, None for a code missing from the dictionary table
+            self.patients[subject_id].add_procedure(titles.get(code))
 
     def extract_patient_words(self, patientID):
         """Uses Gensim to extract all words relevant to a patient and writes these words to a file [patientID].txt.
@@ -420,8 +559,7 @@ class ehr_db:
 
 
     def extract_phrases(self, docID):
-        self.cur.execute("SELECT TEXT FROM mimic.NOTEEVENTS WHERE ROW_ID = %d" % docID)
-        doc = self.cur.fetchall()
+        doc = self.query("SELECT TEXT FROM mimic.NOTEEVENTS WHERE ROW_ID = %s", (docID,))
         upperdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         f = open(upperdir+"/external/phrase-at-scale/data/raw_doc.txt", "w+")
         f.write(doc[0][0])
@@ -438,18 +576,15 @@ class ehr_db:
         '''
 
         #self.cur.execute('select SUBJECT_ID, count(ROW_ID) from mimic.NOTEEVENTS group by SUBJECT_ID having count(ROW_ID) > 10 limit 1')
-        self.cur.execute('select SUBJECT_ID, count(ROW_ID) from (select SUBJECT_ID, ROW_ID from mimic.NOTEEVENTS limit 10000) as SMALLNE group by SUBJECT_ID having count(ROW_ID) > 10 limit 10')
-        patients = self.cur.fetchall()
+        patients = self.query('select SUBJECT_ID, count(ROW_ID) from (select SUBJECT_ID, ROW_ID from mimic.NOTEEVENTS limit 10000) as SMALLNE group by SUBJECT_ID having count(ROW_ID) > 10 limit 10')
         print('Format: (Patient ID, Document count) \n', patients)
         for patient in patients:
             pid = patient[0]
             print('patient %d' %pid)
-            self.cur.execute('select ROW_ID from (select SUBJECT_ID, ROW_ID from mimic.NOTEEVENTS limit 10000) as SMALLNE where SUBJECT_ID = %d' %pid)
-            docids = self.cur.fetchall()
+            docids = self.query('select ROW_ID from (select SUBJECT_ID, ROW_ID from mimic.NOTEEVENTS limit 10000) as SMALLNE where SUBJECT_ID = %s', (pid,))
             for num,doctup in enumerate(docids, start = 1):
                 docid = doctup[0]
-                self.cur.execute('select TEXT from mimic.NOTEEVENTS where ROW_ID = %d' %docid)
-                doctext = self.cur.fetchall()
+                doctext = self.query('select TEXT from mimic.NOTEEVENTS where ROW_ID = %s', (docid,))
                 try:
                     os.makedirs(directory+'patient%d' %pid)
                     docpath = os.path.join(directory, 'patient%d' %pid)
@@ -468,8 +603,7 @@ class ehr_db:
         '''
 
         #self.cur.execute('select SUBJECT_ID, count(ROW_ID) from mimic.NOTEEVENTS group by SUBJECT_ID having count(ROW_ID) > 10 limit 1')
-        self.cur.execute("select ROW_ID, TEXT from (select * from mimic.NOTEEVENTS limit 10000) as SMALLNE where CATEGORY = 'Discharge summary' limit 100")
-        raw = self.cur.fetchall()
+        raw = self.query("select ROW_ID, TEXT from (select * from mimic.NOTEEVENTS limit 10000) as SMALLNE where CATEGORY = %s limit 100", ('Discharge summary',))
         for doc in raw:
             docid = doc[0]
             doctext = doc[1]
@@ -497,18 +631,32 @@ class ehr_db:
             Argument gender must be a capitalized single-letter string.
         '''
 
-        self.cur.execute('SELECT COUNT(*) FROM mimic.PATIENTS WHERE GENDER = \'%s\'' % gender)
-        count = self.cur.fetchall()
+        count = self.query('SELECT COUNT(*) FROM mimic.PATIENTS WHERE GENDER = %s', (gender,))
 
         return count[0][0]
 
-    def docs_with_phrase(self, phrase):
-        ''' Writes document text containing phrase to files named with document IDs.
-        '''
+    def docs_with_phrase(self, phrase, n = 1):
+        ''' Writes document text containing phrase to files named with document IDs
+            (in docs_with_phrase_[phrase]/[ROW_ID].txt), at most n documents (-1 for all). Returns the document IDs.
 
-        self.cur.execute('SELECT ROW_ID, TEXT FROM mimic.NOTEEVENTS WHERE TEXT LIKE \'%%%s%%\' LIMIT 1' % phrase)
-        docs = self.cur.fetchall()
-        os.mkdir("docs_with_phrase_%s" % phrase)
+            Changed from the original version, which only created the directory (failing if it already existed),
+            wrote no file and returned None; n = 1 keeps its LIMIT 1. Without a text index, phrase is matched as a
+            substring (TEXT LIKE '%phrase%'); with one (use_text_index), as a phrase of words ignoring case and
+            punctuation, like get_documents_q.
+        '''
+        directory = "docs_with_phrase_%s" % phrase
+        os.makedirs(directory, exist_ok=True)
+        if self.text_index is not None:
+            ids = self.text_index.search(phrase, n)
+            docs = [(doc_id, self.get_document(doc_id)) for doc_id in ids]
+        elif n == -1:
+            docs = self.query('SELECT ROW_ID, TEXT FROM mimic.NOTEEVENTS WHERE TEXT LIKE %s', ('%' + phrase + '%',))
+        else:
+            docs = self.query('SELECT ROW_ID, TEXT FROM mimic.NOTEEVENTS WHERE TEXT LIKE %s LIMIT %s', ('%' + phrase + '%', n))
+        for doc_id, text in docs:
+            with open(os.path.join(directory, '%d.txt' % doc_id), 'w') as f:
+                f.write(text)
+        return [doc_id for doc_id, _ in docs]
 
     #TODO: bert tokenize
     def get_bert_tokenize(self, doc_id):
@@ -519,6 +667,7 @@ class ehr_db:
 
     # TODO: bart sumamrize test
     def summarize_huggingface(self, text, model_name):
+        from transformers import AutoTokenizer, AutoModelWithLMHead
         if '/' in model_name:
             path = model_name.split('/')[1]
         else:
@@ -538,6 +687,8 @@ class ehr_db:
 
     def bert_predict_masked(self, doc_id, sentence_id, mask_id):
         #TODO: FROM HUGGINGFACE LIBRARY
+        import torch
+        from transformers import AutoTokenizer, AutoModelWithLMHead
         tokenizer = AutoTokenizer.from_pretrained("bert-large-uncased-whole-word-masking")
         model = AutoModelWithLMHead.from_pretrained("bert-large-uncased-whole-word-masking")
 
@@ -567,41 +718,50 @@ class ehr_db:
         """
         #self.server.stop()
         self.cnx.close()
+        self.pool.close()
 
 ### ---------------- ###
 ### HELPER FUNCTIONS ###
 ### ---------------- ###
 
-def start_session(db_user, db_pass):
-    """Opens SQL Connection. Creates cursor
+def start_session(db_user, db_pass, host='localhost', port=3306, pool_size=4, timeout=None):
+    """Opens SQL Connection pool. Creates cursor
     for executing queries. Returns ehr_db object.
 
     Args:
 
         db_user (str): Username for MySQL DB on Tangra
         db_pass (str): Password for MySQL DB on Tangra
+        pool_size (int): Maximum number of connections used by the ehr_db methods
+        timeout (float): Seconds to wait for a free connection, None to wait forever
 
     Returns:
-        dict: Contains SSHTunnelForwarder, pymysql connection, and
-        pymysql cursor objects.
+        ehr_db: Session with a connection pool, and a pymysql connection
+        and cursor for direct queries.
     """
 
-
-    cnx = pymysql.connect(host='localhost',
-                             user=db_user,
-                             password=db_pass,port = 3306)
-                             #port=8080)
+    pool = mysql_pool(db_user, db_pass, host=host, port=port, size=pool_size, timeout=timeout)
     # Session Dictionary: Stores SSH Tunnel (server), MySQL Connection (cnx),
-    # and DB Cursor(cursor).
+    # DB Cursor(cursor) and connection pool (pool).
     #sess_dict = {'server': server, 'cnx':cnx, 'cur':cnx.cursor()}
-    sess_dict = {'cnx':cnx, 'cur':cnx.cursor()}
+    cnx = pool.new_connection()
+    sess_dict = {'cnx':cnx, 'cur':cnx.cursor(), 'pool': pool}
     # Create Session Object:
     sess = ehr_db(sess_dict)
 
-    sess.cur.execute("use mimic")
-
     return sess
 
+def sqlite_session(path, pool_size=4, timeout=None):
+    """Opens a session on a SQLite file holding (a sample of) the MIMIC-III tables, e.g. a test fixture.
+    Queries written for MySQL run unchanged as long as they use standard SQL.
+
+    Returns:
+        ehr_db: Session object, see start_session.
+    """
+    pool = sqlite_pool(path, size=pool_size, timeout=timeout)
+    cnx = pool.new_connection()
+    return ehr_db({'cnx': cnx, 'cur': cnx.cursor(), 'pool': pool})
+
 def createPatient(data):
     """Creates a single Patient object.
 
@@ -622,6 +782,12 @@ def createPatient(data):
 
     return patient
 
+def _concat_ids(pages):
+    pages = list(pages)
+    if not pages:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(pages)
+
 def flatten(lst):
     """Returns flattened list from nested list.
     """
@@ -633,6 +799,13 @@ def numbered_print(lst):
         print(num, '\n', elt)
 
 
+def _require_nltk():
+    ''' Raises ImportError if nltk, used to split notes into sentences and words, is not installed;
+        the database methods work without it.
+    '''
+    if sent_tokenize is None:
+        raise ImportError("splitting notes into sentences needs nltk, install it with `pip install nltk`")
+
 # def init_embedding_model():
 #     train_word2vec()
 
@@ -640,17 +813,27 @@ def get_abbs_sent_ids(text):
     ''' Returns a list of the abbreviations in a document along with the sentence ID they appear in
         in the format [(abbreviation, sent_id), ...]
     '''
-    sent_list = sent_tokenize(text)
+    _require_nltk()
+    return sentence_abbreviations(sent_tokenize(text))
+
+ABB_PATTERN = re.compile(r'[A-Z]{2}')
+
+def sentence_abbreviations(sent_list):
+    ''' Returns [(abbreviation, sent_id), ...] for the words starting with two capital letters in sent_list.
+        Only sentences containing two consecutive capitals are passed to word_tokenize, the others cannot have one.
+    '''
+    _require_nltk()
     abb_list = []
-    for i, sent in zip(range(0, len(sent_list)), sent_list):
+    for i, sent in enumerate(sent_list):
+        if not ABB_PATTERN.search(sent):
+            continue
         for word in word_tokenize(sent):
-            pattern = r'[A-Z]{2}'
-            if re.match(pattern, word):
+            if ABB_PATTERN.match(word):
                 abb_list.append((word, i))
+    return abb_list
 
-    return list(abb_list)
 def post_single_dict_to_solr(d: dict, core: str) -> None:
-    response = requests.post('http://tangra.cs.yale.edu:8983/solr/{}/update/json/docs'.format(core), json=d)
+    get_solr_client().add(core, [d])
 
 def abbs_disambiguate(ABB):
     long_forms, long_form_to_score_map = get_solr_response_umn_wrap(ABB)
@@ -1,8 +1,23 @@
+import json
+import math
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 logger = logging.getLogger(__name__)
-from nltk.stem import WordNetLemmatizer
-lemmatizer = WordNetLemmatizer()
+try:
+    from nltk.stem import WordNetLemmatizer
+    lemmatizer = WordNetLemmatizer()
+except ImportError:
+    # only the query builders need it, the clients and LocalSolrIndex work without nltk
+    lemmatizer = None
+
+# base url of the Solr server, can be changed with the SOLR_URL environment variable or set_solr_client
+SOLR_URL = os.environ.get('SOLR_URL', 'http://tangra.cs.yale.edu:8983/solr')
+SOLR_ROWS = 100
 
 def solr_escape(query: str) -> str:
     # These special Solr characters need to be escaped. We deal with some of them
@@ -24,18 +39,8 @@ def solr_escape(query: str) -> str:
     })
     return query.translate(char_translation_table)
 
-def get_solr_response_generic(solr_formatted_query: str, solr_core_name: str):
-    solr_response_json = requests.get(
-        url ='http://tangra.cs.yale.edu:8983/solr/{}/select?'.format(solr_core_name),
-        params={
-            'indent': 'on',
-            'q': solr_formatted_query,
-            'rows': '100',
-            'wt': 'json',
-            'fl': 'id, score'
-        }
-    ).json()
-    solr_response = solr_response_json['response']
+def get_solr_response_generic(solr_formatted_query: str, solr_core_name: str, rows: int = SOLR_ROWS, client=None):
+    solr_response = (client or get_solr_client()).select(solr_core_name, solr_formatted_query, fl='id, score', rows=rows)
     num_rows = solr_response['numFound']
     rows = solr_response['docs']
     solr_matched_ids = []
@@ -47,9 +52,15 @@ def get_solr_response_generic(solr_formatted_query: str, solr_core_name: str):
         id_to_score_map[item_id] = item_solr_score
 
     return solr_matched_ids, id_to_score_map
+def _lemmatized_words(escaped_query):
+    """quoted, lemmatized words of an escaped query"""
+    if lemmatizer is None:
+        raise ImportError("lemmatizing Solr queries needs nltk, install it with `pip install nltk`")
+    return ['"' + lemmatizer.lemmatize(word) + '"' for word in escaped_query.split()]
+
 def get_solr_response_mimic(raw_query):
     escaped_query = solr_escape(raw_query)
-    query_words = ['"' + lemmatizer.lemmatize(word) + '"' for word in escaped_query.split()]
+    query_words = _lemmatized_words(escaped_query)
     if len(query_words) > 0:
             query = ' AND '.join(query_words)
             solr_formatted_query = 'abbreviations:({}) OR abbreviations_sent_id:({}) OR doctext_not_stored:({})'.format(
@@ -60,7 +71,7 @@ def get_solr_response_mimic(raw_query):
     return get_solr_response_generic(solr_formatted_query, 'ehr_abbs_mimic')
 def get_solr_response_umn_wrap(raw_query):
     escaped_query = solr_escape(raw_query)
-    query_words = ['"' + lemmatizer.lemmatize(word) + '"' for word in escaped_query.split()]
+    query_words = _lemmatized_words(escaped_query)
     if len(query_words) > 0:
             query = ' AND '.join(query_words)
             solr_formatted_query = 'short_form:({})'.format(
@@ -70,18 +81,8 @@ def get_solr_response_umn_wrap(raw_query):
 
     return get_solr_response_umn(solr_formatted_query, 'ehr_abbsense_umn')
 
-def get_solr_response_umn(solr_formatted_query: str, solr_core_name: str):
-    solr_response_json = requests.get(
-        url ='http://tangra.cs.yale.edu:8983/solr/{}/select?'.format(solr_core_name),
-        params={
-            'indent': 'on',
-            'q': solr_formatted_query,
-            'rows': '100',
-            'wt': 'json',
-            'fl': 'id, long_form, score'
-        }
-    ).json()
-    solr_response = solr_response_json['response']
+def get_solr_response_umn(solr_formatted_query: str, solr_core_name: str, rows: int = SOLR_ROWS, client=None):
+    solr_response = (client or get_solr_client()).select(solr_core_name, solr_formatted_query, fl='id, long_form, score', rows=rows)
     num_rows = solr_response['numFound']
     rows = solr_response['docs']
     solr_matched_longforms = []
@@ -92,3 +93,238 @@ def get_solr_response_umn(solr_formatted_query: str, solr_core_name: str):
         solr_matched_longforms.append(item)
         long_form_to_score_map[item] = item_solr_score
     return solr_matched_longforms, long_form_to_score_map
+
+
+class SolrClient:
+    """Client of a Solr server sharing one pooled requests.Session between calls (and threads).
+
+    Args:
+        base_url (str): url of the Solr server, e.g. http://localhost:8983/solr
+        timeout (float): seconds before a request is abandoned
+        pool_size (int): maximum number of kept-alive connections, also the number of threads of select_many
+        retries (int): number of retries of failed connections
+    """
+
+    def __init__(self, base_url=SOLR_URL, timeout=10, pool_size=10, retries=2):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def select(self, core, q, fl='id, score', rows=SOLR_ROWS, start=0):
+        """Runs a query on core, returns the Solr response dict (numFound, start, docs)"""
+        response = self.session.get('{}/{}/select'.format(self.base_url, core), timeout=self.timeout,
+                                    params={'q': q, 'fl': fl, 'rows': rows, 'start': start, 'wt': 'json'})
+        response.raise_for_status()
+        return response.json()['response']
+
+    def iter_select(self, core, q, fl='id, score', page_size=SOLR_ROWS, max_rows=None):
+        """Yields the documents matching q, page_size at a time, until max_rows (default all) were read"""
+        return _iter_pages(self, core, q, fl, page_size, max_rows)
+
+    def select_many(self, core, queries, fl='id, score', rows=SOLR_ROWS):
+        """Runs several queries concurrently, returns their responses in the order of queries"""
+        return _select_many(self, core, queries, fl, rows, self.pool_size)
+
+    def add(self, core, docs, commit_within=None):
+        """Indexes a list of documents in one request; commit_within (ms) lets Solr commit them in the background"""
+        params = {'commitWithin': commit_within} if commit_within is not None else {}
+        response = self.session.post('{}/{}/update'.format(self.base_url, core), json=list(docs),
+                                     params=params, timeout=self.timeout)
+        response.raise_for_status()
+
+    def commit(self, core):
+        response = self.session.get('{}/{}/update'.format(self.base_url, core), params={'commit': 'true'},
+                                    timeout=self.timeout)
+        response.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+TOKEN_RE = re.compile(r"\w+")
+CLAUSE_RE = re.compile(r'(\w+):\(([^)]*)\)')
+
+# fields ending with this suffix are indexed but not kept with the documents, like Solr's not stored fields
+NOT_STORED_SUFFIX = '_not_stored'
+
+
+def _tokens(value):
+    if value is None:
+        return []
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    return [TOKEN_RE.findall(str(item).lower()) for item in value]
+
+
+def _contains(positions, phrase):
+    """True if the phrase (a token list) appears in the field, given {token: {(value index, position)}}"""
+    for value, start in positions[phrase[0]]:
+        if all((value, start + i) in positions[token] for i, token in enumerate(phrase[1:], 1)):
+            return True
+    return False
+
+
+class LocalSolrIndex:
+    """In-process stand-in for a Solr server, with the interface of SolrClient.
+
+    Documents are dicts (e.g. id, abbreviations, abbreviations_sent_id, doctext_not_stored for ehr_abbs_mimic,
+    short_form, long_form for ehr_abbsense_umn) indexed in memory with a positional inverted index per field;
+    fields ending with _not_stored are only indexed, they are not kept with the documents. It answers the
+    queries built in this module: "*:*", or field:("a" AND "b") clauses joined with OR, matched as phrases of
+    lowercased words. Scores are tf-idf sums, so results are ordered like a Solr ranking but are not identical.
+
+    Args:
+        path (str): optional json lines file the documents are loaded from; commit() appends the documents
+            added since the last commit, so saving costs the size of the new documents only
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._docs = {}
+        self._postings = {}
+        self._pending = []
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self._index(entry['core'], entry['doc'])
+
+    def add(self, core, docs, commit_within=None):
+        """Indexes docs, they are searchable at once; with commit_within they are also saved to path"""
+        with self._lock:
+            for doc in docs:
+                self._index(core, doc)
+                if self.path is not None:
+                    self._pending.append({'core': core, 'doc': doc})
+        if commit_within is not None:
+            self.commit(core)
+
+    def _index(self, core, doc):
+        core_docs = self._docs.setdefault(core, {})
+        postings = self._postings.setdefault(core, {})
+        doc_id = str(doc['id'])
+        if doc_id in core_docs:
+            self._remove(core, doc_id)
+        terms = []
+        for field, value in doc.items():
+            if field == 'id':
+                continue
+            field_postings = postings.setdefault(field, {})
+            for value_index, tokens in enumerate(_tokens(value)):
+                for position, token in enumerate(tokens):
+                    field_postings.setdefault(token, {}).setdefault(doc_id, set()).add((value_index, position))
+                    terms.append((field, token))
+        stored = {field: value for field, value in doc.items() if not field.endswith(NOT_STORED_SUFFIX)}
+        core_docs[doc_id] = (stored, set(terms))
+
+    def _remove(self, core, doc_id):
+        _, terms = self._docs[core].pop(doc_id)
+        for field, token in terms:
+            self._postings[core][field][token].pop(doc_id, None)
+
+    def commit(self, core=None):
+        if self.path is None:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if pending:
+                with open(self.path, 'a') as f:
+                    for entry in pending:
+                        f.write(json.dumps(entry) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+
+    def _score(self, core, q):
+        """{doc id: score} of the documents matching q"""
+        core_docs = self._docs.get(core, {})
+        if q.strip() == '*:*':
+            return {doc_id: 1.0 for doc_id in core_docs}
+        clauses = CLAUSE_RE.findall(q)
+        if not clauses:
+            raise ValueError('LocalSolrIndex cannot parse the query {}'.format(q))
+        scores = {}
+        for field, terms in clauses:
+            phrases = [TOKEN_RE.findall(term.lower()) for term in terms.split(' AND ')]
+            phrases = [phrase for phrase in phrases if phrase]
+            field_postings = self._postings.get(core, {}).get(field, {})
+            candidates = None
+            for phrase in phrases:
+                for token in phrase:
+                    matches = set(field_postings.get(token, {}))
+                    candidates = matches if candidates is None else candidates & matches
+            for doc_id in candidates or ():
+                positions = {token: field_postings[token][doc_id] for phrase in phrases for token in phrase}
+                if not all(len(phrase) == 1 or _contains(positions, phrase) for phrase in phrases):
+                    continue
+                score = 0.0
+                for phrase in phrases:
+                    for token in phrase:
+                        counts = field_postings[token]
+                        score += (math.sqrt(len(counts[doc_id]))
+                                  * (1 + math.log(len(core_docs) / (len(counts) + 1) + 1)))
+                scores[doc_id] = scores.get(doc_id, 0.0) + score
+        return scores
+
+    def select(self, core, q, fl='id, score', rows=SOLR_ROWS, start=0):
+        with self._lock:
+            scores = self._score(core, q)
+            ranked = sorted(scores, key=lambda doc_id: (-scores[doc_id], doc_id))
+            fields = [field.strip() for field in fl.split(',')]
+            docs = []
+            for doc_id in ranked[start:start + rows]:
+                doc = self._docs[core][doc_id][0]
+                output = {field: doc[field] for field in fields if field in doc}
+                if 'id' in fields:
+                    output['id'] = doc['id']
+                if 'score' in fields:
+                    output['score'] = scores[doc_id]
+                docs.append(output)
+        return {'numFound': len(ranked), 'start': start, 'docs': docs}
+
+    def iter_select(self, core, q, fl='id, score', page_size=SOLR_ROWS, max_rows=None):
+        return _iter_pages(self, core, q, fl, page_size, max_rows)
+
+    def select_many(self, core, queries, fl='id, score', rows=SOLR_ROWS):
+        return [self.select(core, q, fl, rows) for q in queries]
+
+    def close(self):
+        self.commit()
+
+
+def _iter_pages(client, core, q, fl, page_size, max_rows):
+    start = 0
+    while max_rows is None or start < max_rows:
+        rows = page_size if max_rows is None else min(page_size, max_rows - start)
+        response = client.select(core, q, fl=fl, rows=rows, start=start)
+        for doc in response['docs']:
+            yield doc
+        start += len(response['docs'])
+        if not response['docs'] or start >= response['numFound']:
+            return
+
+
+def _select_many(client, core, queries, fl, rows, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(lambda q: client.select(core, q, fl=fl, rows=rows), queries))
+
+
+_solr_client = None
+
+
+def get_solr_client():
+    """Client used by the get_solr_response_* functions, a SolrClient on SOLR_URL unless set_solr_client was called"""
+    global _solr_client
+    if _solr_client is None:
+        _solr_client = SolrClient()
+    return _solr_client
+
+
+def set_solr_client(client):
+    """Uses client (a SolrClient or a LocalSolrIndex) for the get_solr_response_* functions"""
+    global _solr_client
+    _solr_client = client
@@ -0,0 +1,164 @@
+import unittest
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import solr_lib
+from solr_lib import LocalSolrIndex, get_solr_response_mimic, get_solr_response_umn_wrap, set_solr_client
+
+MIMIC_DOCS = [
+    {'id': 1, 'abbreviations': ['CHF', 'COPD'], 'abbreviations_sent_id': ['CHF:0', 'COPD:0', 'CHF:2'],
+     'doctext_not_stored': 'Pt has CHF and COPD. Stable. CHF exacerbation resolved.'},
+    {'id': 2, 'abbreviations': ['CHF'], 'abbreviations_sent_id': ['CHF:1'],
+     'doctext_not_stored': 'No distress. History of CHF.'},
+    {'id': 3, 'abbreviations': ['HTN'], 'abbreviations_sent_id': ['HTN:0'],
+     'doctext_not_stored': 'HTN, well controlled. Denies chf symptoms.'},
+    {'id': 4, 'abbreviations': [], 'abbreviations_sent_id': [],
+     'doctext_not_stored': 'Ambulating without assistance.'},
+]
+
+# get_solr_response_mimic and get_solr_response_umn_wrap lemmatize the query with nltk
+needs_nltk = unittest.skipIf(solr_lib.lemmatizer is None, "nltk is not installed")
+
+UMN_DOCS = [
+    {'id': 'CHF|1', 'short_form': 'CHF', 'long_form': 'congestive heart failure'},
+    {'id': 'CHF|2', 'short_form': 'CHF', 'long_form': 'chronic heart failure'},
+    {'id': 'PT|1', 'short_form': 'PT', 'long_form': 'physical therapy'},
+    {'id': 'PT|2', 'short_form': 'PT', 'long_form': 'patient'},
+    {'id': 'PT|3', 'short_form': 'PT', 'long_form': 'prothrombin time'},
+]
+
+
+class tests(unittest.TestCase):
+    def setUp(self):
+        self.index = LocalSolrIndex()
+        self.index.add('ehr_abbs_mimic', MIMIC_DOCS)
+        self.index.add('ehr_abbsense_umn', UMN_DOCS)
+        self.client = solr_lib._solr_client
+        set_solr_client(self.index)
+
+    def tearDown(self):
+        set_solr_client(self.client)
+
+
+''' queries built by get_solr_response_mimic and get_solr_response_umn_wrap '''
+
+
+class t1(tests):
+    @needs_nltk
+    def test1_1_mimic(self):
+        ids, scores = get_solr_response_mimic('CHF')
+        # documents 1 and 2 list CHF as an abbreviation, 3 only mentions it in the text
+        self.assertEqual(sorted(ids), [1, 2, 3])
+        self.assertEqual(ids[-1], 3)
+        self.assertEqual(ids, sorted(scores, key=lambda doc_id: -scores[doc_id]))
+        # more occurrences, higher score
+        self.assertGreater(scores[1], scores[2])
+
+    @needs_nltk
+    def test1_2_mimic_all_words(self):
+        ids, _ = get_solr_response_mimic('CHF COPD')
+        self.assertEqual(ids, [1])
+        ids, _ = get_solr_response_mimic('chf exacerbation')
+        self.assertEqual(ids, [1])
+        ids, _ = get_solr_response_mimic('dyspnea')
+        self.assertEqual(ids, [])
+
+    @needs_nltk
+    def test1_3_mimic_escaped(self):
+        # ":" and "?" are escaped by solr_escape, the words around them still match
+        ids, _ = get_solr_response_mimic('History: CHF?')
+        self.assertEqual(ids, [2])
+
+    @needs_nltk
+    def test1_4_mimic_all(self):
+        ids, scores = get_solr_response_mimic('')
+        self.assertEqual(sorted(ids), [1, 2, 3, 4])
+        self.assertEqual(set(scores.values()), {1.0})
+
+    @needs_nltk
+    def test1_5_umn(self):
+        long_forms, scores = get_solr_response_umn_wrap('CHF')
+        self.assertEqual(sorted(long_forms), ['chronic heart failure', 'congestive heart failure'])
+        long_forms, _ = get_solr_response_umn_wrap('pt')
+        self.assertEqual(sorted(long_forms), ['patient', 'physical therapy', 'prothrombin time'])
+        long_forms, _ = get_solr_response_umn_wrap('COPD')
+        self.assertEqual(long_forms, [])
+
+    def test1_6_rows(self):
+        ids, _ = solr_lib.get_solr_response_generic('abbreviations:("CHF")', 'ehr_abbs_mimic', rows=1)
+        self.assertEqual(len(ids), 1)
+
+    def test1_7_unknown_query(self):
+        with self.assertRaises(ValueError):
+            self.index.select('ehr_abbs_mimic', 'CHF')
+
+
+''' paging, batched queries and persistence '''
+
+
+class t2(tests):
+    def setUp(self):
+        super().setUp()
+        self.index.add('notes', [{'id': i, 'text': 'chf ' * (i % 7 + 1) + 'note %d' % i} for i in range(1, 26)])
+
+    def test2_1_iter_select(self):
+        expected = self.index.select('notes', 'text:("chf")', rows=100)['docs']
+        self.assertEqual(len(expected), 25)
+        self.assertEqual(list(self.index.iter_select('notes', 'text:("chf")', page_size=10)), expected)
+        self.assertEqual(list(self.index.iter_select('notes', 'text:("chf")', page_size=10, max_rows=15)),
+                         expected[:15])
+        self.assertEqual(list(self.index.iter_select('notes', 'text:("missing")', page_size=10)), [])
+
+    def test2_2_select_many(self):
+        queries = ['text:("note" AND "3")', 'text:("chf")', 'text:("missing")', 'text:("note" AND "25")']
+        responses = self.index.select_many('notes', queries, rows=5)
+        self.assertEqual(responses, [self.index.select('notes', q, rows=5) for q in queries])
+        self.assertEqual([response['numFound'] for response in responses], [1, 25, 0, 1])
+
+    def test2_3_replace(self):
+        self.index.add('notes', [{'id': 3, 'text': 'replaced'}])
+        self.assertEqual(self.index.select('notes', 'text:("note" AND "3")')['numFound'], 0)
+        self.assertEqual(self.index.select('notes', 'text:("replaced")')['docs'][0]['id'], 3)
+
+    def test2_4_persistence(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'solr.jsonl')
+            index = LocalSolrIndex(path)
+            index.add('ehr_abbsense_umn', UMN_DOCS, commit_within=1000)
+            index.close()
+            reloaded = LocalSolrIndex(path)
+            self.assertEqual(reloaded.select('ehr_abbsense_umn', 'short_form:("PT")', fl='id, long_form, score'),
+                             self.index.select('ehr_abbsense_umn', 'short_form:("PT")', fl='id, long_form, score'))
+            reloaded.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test2_5_not_stored(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'solr.jsonl')
+            index = LocalSolrIndex(path)
+            for doc in MIMIC_DOCS:
+                index.add('ehr_abbs_mimic', [doc], commit_within=1000)
+            # one line appended per committed document, the file is never rewritten
+            with open(path) as f:
+                self.assertEqual(len(f.readlines()), len(MIMIC_DOCS))
+            docs = index.select('ehr_abbs_mimic', '*:*', fl='id, abbreviations, doctext_not_stored')['docs']
+            self.assertTrue(all('doctext_not_stored' not in doc for doc in docs))
+            index.close()
+
+            reloaded = LocalSolrIndex(path)
+            self.assertEqual(reloaded.select('ehr_abbs_mimic', 'doctext_not_stored:("exacerbation" AND "chf")'),
+                             self.index.select('ehr_abbs_mimic', 'doctext_not_stored:("exacerbation" AND "chf")'))
+            self.assertEqual(reloaded.select('ehr_abbs_mimic', 'doctext_not_stored:("history of chf")')['docs'][0]['id'], 2)
+            reloaded.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+"""Local positional inverted index over NOTEEVENTS.TEXT, used by ehr_db.get_documents_q and docs_with_phrase"""
+import argparse
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Lowercased word tokens of text, the unit of the index (punctuation is ignored)"""
+    return TOKEN_RE.findall(text.lower())
+
+
+class TextIndex:
+    """Positional inverted index stored in a SQLite file.
+
+    For every term, the index keeps the ROW_IDs of the notes containing it with the token positions
+    (int32 arrays), so phrase queries ("Service: SURGERY") are answered by intersecting the postings of
+    the rarest terms and checking that the positions follow each other. Notes can be added at any time;
+    build_text_index only adds the notes with a ROW_ID above the last one indexed.
+
+    Args:
+        path (str): SQLite file of the index, created if it does not exist
+
+    The SQLite connection is shared by the threads using the index (e.g. the callers of a pooled ehr_db),
+    so every query and the transaction of add_documents hold a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS terms (
+                term TEXT PRIMARY KEY, id INTEGER UNIQUE NOT NULL, df INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE IF NOT EXISTS postings (
+                term_id INTEGER NOT NULL, row_id INTEGER NOT NULL, positions BLOB NOT NULL,
+                PRIMARY KEY (term_id, row_id)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS documents (row_id INTEGER PRIMARY KEY, length INTEGER NOT NULL);
+        ''')
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM documents")[0][0]
+
+    def __contains__(self, row_id):
+        return bool(self._query("SELECT 1 FROM documents WHERE row_id = ?", (row_id,)))
+
+    def last_row_id(self):
+        """Highest ROW_ID indexed so far, -1 for an empty index"""
+        return self._query("SELECT COALESCE(MAX(row_id), -1) FROM documents")[0][0]
+
+    def add_documents(self, documents):
+        """Indexes (ROW_ID, text) pairs in one transaction; notes already in the index, and repeats of a ROW_ID
+        within documents, are skipped
+        """
+        batch = {}
+        for row_id, text in documents:
+            batch.setdefault(row_id, text)
+        row_ids = list(batch)
+        for start in range(0, len(row_ids), 500):
+            chunk = row_ids[start:start + 500]
+            query = "SELECT row_id FROM documents WHERE row_id IN (%s)" % ",".join("?" * len(chunk))
+            for (row_id,) in self._query(query, chunk):
+                del batch[row_id]
+
+        postings = {}
+        lengths = []
+        for row_id, text in batch.items():
+            positions = {}
+            tokens = tokenize(text or "")
+            for position, token in enumerate(tokens):
+                positions.setdefault(token, []).append(position)
+            for token, token_positions in positions.items():
+                postings.setdefault(token, []).append((row_id, np.array(token_positions, dtype=np.int32).tobytes()))
+            lengths.append((row_id, len(tokens)))
+        if not lengths:
+            return 0
+
+        with self._lock, self._db:
+            next_id = self._db.execute("SELECT COALESCE(MAX(id), -1) + 1 FROM terms").fetchone()[0]
+            term_ids = {}
+            terms = list(postings)
+            for start in range(0, len(terms), 500):
+                chunk = terms[start:start + 500]
+                query = "SELECT term, id FROM terms WHERE term IN (%s)" % ",".join("?" * len(chunk))
+                term_ids.update(self._db.execute(query, chunk))
+            new_terms = [term for term in terms if term not in term_ids]
+            for term in new_terms:
+                term_ids[term] = next_id
+                next_id += 1
+            self._db.executemany("INSERT INTO terms (term, id, df) VALUES (?, ?, 0)",
+                                 [(term, term_ids[term]) for term in new_terms])
+            self._db.executemany("UPDATE terms SET df = df + ? WHERE id = ?",
+                                 [(len(docs), term_ids[term]) for term, docs in postings.items()])
+            self._db.executemany("INSERT INTO postings (term_id, row_id, positions) VALUES (?, ?, ?)",
+                                 [(term_ids[term], row_id, positions)
+                                  for term, docs in postings.items() for row_id, positions in docs])
+            self._db.executemany("INSERT INTO documents (row_id, length) VALUES (?, ?)", lengths)
+        return len(lengths)
+
+    def _postings(self, term_id, row_ids=None):
+        """{ROW_ID: positions} of a term, restricted to row_ids if given"""
+        if row_ids is None:
+            rows = self._query("SELECT row_id, positions FROM postings WHERE term_id = ?", (term_id,))
+            return {row_id: np.frombuffer(positions, dtype=np.int32) for row_id, positions in rows}
+        output = {}
+        row_ids = sorted(row_ids)
+        for start in range(0, len(row_ids), 500):
+            chunk = row_ids[start:start + 500]
+            query = ("SELECT row_id, positions FROM postings WHERE term_id = ? AND row_id IN (%s)"
+                     % ",".join("?" * len(chunk)))
+            for row_id, positions in self._query(query, [term_id] + chunk):
+                output[row_id] = np.frombuffer(positions, dtype=np.int32)
+        return output
+
+    def search(self, query, n=-1):
+        """Returns the sorted ROW_IDs of the notes containing the phrase query (case and punctuation are ignored),
+        at most n of them (n = -1 for all)
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        terms = {}
+        for term in set(tokens):
+            entry = self._query("SELECT id, df FROM terms WHERE term = ?", (term,))
+            if not entry:
+                return []
+            terms[term] = entry[0]
+
+        # rarest term first, so the candidate set is as small as possible from the start
+        offsets = {}
+        for offset, token in enumerate(tokens):
+            offsets.setdefault(token, []).append(offset)
+        order = sorted(terms, key=lambda term: terms[term][1])
+        candidates = None
+        positions = {}
+        for term in order:
+            postings = self._postings(terms[term][0], candidates)
+            candidates = set(postings)
+            positions[term] = postings
+            if not candidates:
+                return []
+
+        matches = []
+        for row_id in sorted(candidates):
+            if len(tokens) == 1 or self._has_phrase(row_id, positions, offsets):
+                matches.append(row_id)
+                if n != -1 and len(matches) >= n:
+                    break
+        return matches
+
+    @staticmethod
+    def _has_phrase(row_id, positions, offsets):
+        # phrase starts are positions p such that every token i of the phrase is at p + i
+        starts = None
+        for term, term_offsets in offsets.items():
+            for offset in term_offsets:
+                shifted = positions[term][row_id] - offset
+                starts = shifted if starts is None else np.intersect1d(starts, shifted, assume_unique=True)
+                if len(starts) == 0:
+                    return False
+        return True
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def build_text_index(ehrdb, index, batch_size=1000):
+    """Adds the notes of NOTEEVENTS with a ROW_ID above the last one in the index, batch_size notes per
+    transaction, so an interrupted build resumes where it stopped; returns the number of notes added
+    """
+    start, added = time.time(), 0
+    batch = []
+    for rows in ehrdb.iter_notes_after(index.last_row_id(), batch_size):
+        batch.extend(rows)
+        if len(batch) >= batch_size:
+            added += index.add_documents(batch)
+            batch = []
+            print("%d notes indexed (%.0f notes/s)" % (added, added / max(time.time() - start, 1e-6)))
+    added += index.add_documents(batch)
+    print("%d notes indexed in %.1fs, %d in the index" % (added, time.time() - start, len(index)))
+    return added
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build (or update) the local full-text index of NOTEEVENTS')
+    parser.add_argument('--index', default='noteevents_index.sqlite', type=str, help='SQLite file of the index')
+    parser.add_argument('--sqlite', default=None, type=str, help='read the notes from a SQLite copy of MIMIC-III instead of MySQL')
+    parser.add_argument('--batch_size', default=1000, type=int, help='number of notes indexed per transaction')
+
+    args = parser.parse_args()
+    import mimiciii
+    if args.sqlite is not None:
+        session = mimiciii.sqlite_session(args.sqlite)
+    else:
+        try:
+            from config import USERNAME, PASSWORD
+        except ImportError:
+            from getpass import getpass
+            USERNAME = input('DB_username?')
+            PASSWORD = getpass('DB_password?')
+        session = mimiciii.start_session(USERNAME, PASSWORD)
+    text_index = TextIndex(args.index)
+    build_text_index(session, text_index, args.batch_size)
+    text_index.close()
+    session.close_session()
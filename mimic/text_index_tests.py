@@ -0,0 +1,151 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import mimiciii
+from db_tests import build_fixture
+from text_index import TextIndex, build_text_index, tokenize
+
+DOCUMENTS = [(1, "Service: SURGERY. Pt has CHF and COPD."),
+             (2, "service surgery"),
+             (3, "No no no pain, resting comfortably."),
+             (4, "No pain, no gain: pt ambulating."),
+             (5, "SURGERY service, then Service - surgery again."),
+             (6, None)]
+
+
+def brute_force(documents, query):
+    """ROW_IDs of the documents whose tokens contain the tokens of query one after the other"""
+    phrase = tokenize(query)
+    matches = []
+    for row_id, text in documents:
+        tokens = tokenize(text or "")
+        if any(tokens[i:i + len(phrase)] == phrase for i in range(len(tokens) - len(phrase) + 1)):
+            matches.append(row_id)
+    return matches
+
+
+class tests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = TextIndex(os.path.join(self.dir, "index.sqlite"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+
+''' phrase search '''
+
+
+class t1(tests):
+    def setUp(self):
+        super().setUp()
+        self.index.add_documents(DOCUMENTS)
+
+    def test1_1_punctuation(self):
+        self.assertEqual(self.index.search("Service: SURGERY"), [1, 2, 5])
+        self.assertEqual(self.index.search("service-surgery"), [1, 2, 5])
+        self.assertEqual(self.index.search("surgery. pt"), [1])
+
+    def test1_2_repeated_tokens(self):
+        self.assertEqual(self.index.search("no no"), [3])
+        self.assertEqual(self.index.search("no no no pain"), [3])
+        self.assertEqual(self.index.search("no no no no"), [])
+        self.assertEqual(self.index.search("no pain no"), [4])
+        self.assertEqual(self.index.search("service surgery service"), [])
+
+    def test1_3_brute_force(self):
+        for query in ["pt", "no pain", "surgery service", "CHF and COPD", "pain resting", "gain pt ambulating",
+                      "missing", "no", "surgery again"]:
+            self.assertEqual(self.index.search(query), brute_force(DOCUMENTS, query), query)
+
+    def test1_4_limit(self):
+        self.assertEqual(self.index.search("surgery", n=2), [1, 2])
+        self.assertEqual(self.index.search("..."), [])
+
+    def test1_5_documents_added_once(self):
+        self.assertEqual(self.index.add_documents(DOCUMENTS[:2]), 0)
+        self.assertEqual(len(self.index), len(DOCUMENTS))
+        self.assertEqual(self.index.last_row_id(), 6)
+        # a repeated ROW_ID is indexed once, with its first text
+        self.assertEqual(self.index.add_documents([(7, "first text"), (2, "service"), (7, "second text")]), 1)
+        self.assertEqual(self.index.search("first text"), [7])
+        self.assertEqual(self.index.search("second text"), [])
+
+    def test1_6_threads(self):
+        # searches and additions from several threads share the SQLite connection of the index
+        errors = []
+
+        def search():
+            try:
+                for _ in range(50):
+                    self.assertEqual(self.index.search("service surgery")[:3], [1, 2, 5])
+            except Exception as e:
+                errors.append(e)
+
+        def add():
+            try:
+                for row_id in range(100, 150):
+                    self.index.add_documents([(row_id, "Service: SURGERY, note %d" % row_id)])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=search) for _ in range(4)] + [threading.Thread(target=add)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.index.search("service surgery")), 53)
+
+
+''' build_text_index on a SQLite fixture of NOTEEVENTS '''
+
+
+class t2(tests):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.dir, "mimic.sqlite")
+        build_fixture(self.path)
+        self.ehrdb = mimiciii.sqlite_session(self.path)
+        self.notes = list(self.ehrdb.query("select ROW_ID, TEXT from mimic.NOTEEVENTS order by ROW_ID"))
+
+    def tearDown(self):
+        self.ehrdb.close_session()
+        super().tearDown()
+
+    def test2_1_build(self):
+        self.assertEqual(build_text_index(self.ehrdb, self.index, batch_size=4), len(self.notes))
+        self.assertEqual(self.index.last_row_id(), self.notes[-1][0])
+        for query in ["Service: MEDICINE", "CHF", "pt ambulating", "follow up with pcp"]:
+            self.assertEqual(self.index.search(query), brute_force(self.notes, query), query)
+
+    def test2_2_resume(self):
+        # an interrupted build: the first notes are indexed, the next build only adds the others
+        self.index.add_documents(self.notes[:5])
+        self.assertEqual(self.index.last_row_id(), self.notes[4][0])
+        self.assertEqual(build_text_index(self.ehrdb, self.index, batch_size=4), len(self.notes) - 5)
+
+        cnx = sqlite3.connect(self.path)
+        cnx.execute("INSERT INTO NOTEEVENTS VALUES (?, ?, ?, ?, ?)",
+                    (self.notes[-1][0] + 1, 1, "2150-01-02", "Nursing", "Service: SURGERY, new note."))
+        cnx.commit()
+        cnx.close()
+        self.assertEqual(build_text_index(self.ehrdb, self.index), 1)
+        self.assertEqual(len(self.index), len(self.notes) + 1)
+        self.assertEqual(self.index.search("surgery new note"), [self.notes[-1][0] + 1])
+
+    def test2_3_ehr_db(self):
+        build_text_index(self.ehrdb, self.index)
+        self.ehrdb.use_text_index(self.index)
+        self.assertEqual(self.ehrdb.get_documents_q("Service: SURGERY"), brute_force(self.notes, "service surgery"))
+
+
+if __name__ == '__main__':
+    unittest.main()